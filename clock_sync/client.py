@@ -10,6 +10,9 @@ t2 = None
 t3 = None
 t4 = None
 
+# Whether each of t1-t4 was taken by the kernel or is a fallback
+kernel_timestamps = {"t1": False, "t2": False, "t3": False, "t4": False}
+
 def create_client_socket():
     """
     Create a UDP client socket with timestamping enabled.
@@ -22,19 +25,20 @@ def create_client_socket():
     
     return sock
 
-def send_with_timestamp(sock: socket.socket, data: bytes, addr: tuple) -> int:
+def send_with_timestamp(sock: socket.socket, data: bytes, addr: tuple) -> tuple:
     """
-    Send data and return send timestamp in nanoseconds.
+    Send data and return (send timestamp in nanoseconds, kernel).
+    kernel is False if the kernel did not report the timestamp and the current time is used instead.
     """
-    utils.send_message(sock, data, addr)
+    tx_id = utils.send_message(sock, data, addr)
     
     # Try to get send timestamp from error queue
-    send_timestamp = utils.get_send_timestamp(sock)
+    send_timestamp = utils.get_send_timestamp(sock, tx_id)
     if send_timestamp is not None:
-        return int(send_timestamp * 1e9)
+        return send_timestamp, True
     else:
         # Fallback to current time
-        return utils.get_current_time_ns()
+        return utils.get_current_time_ns(), False
 
 def start_sync(sock: socket.socket, addr: tuple):
     """
@@ -47,7 +51,7 @@ def start_sync(sock: socket.socket, addr: tuple):
             print(f"Sent sync request to {addr}")
             
             for _ in range(2):
-                data, _, arrival_time_ns = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
+                data, _, arrival_time_ns, arrival_kernel = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
                 msg_type, timestamp = utils.parse_message_raw(data)
 
                 if msg_type == utils.PTPMsgType.PTP_BUSY.value:
@@ -57,11 +61,13 @@ def start_sync(sock: socket.socket, addr: tuple):
                 elif msg_type == utils.PTPMsgType.PTP_SYNC_RESPONSE.value:
                     global t2
                     t2 = arrival_time_ns
+                    kernel_timestamps["t2"] = arrival_kernel
                     print(f"Received sync response from {addr} at t2={t2}")
                     continue
                 elif msg_type == utils.PTPMsgType.PTP_SYNC_FOLLOW_UP.value:
                     global t1
                     t1 = timestamp
+                    kernel_timestamps["t1"] = utils.is_kernel_timestamp(data)
                     print(f"Received sync follow-up from {addr} at t1={t1}")
                     return True
                 else:
@@ -109,10 +115,10 @@ def run_client(server_ip: str):
     for _ in range(utils.MAX_SYNC_TRIES):
         try:
             request = utils.build_message(utils.PTPMsgType.PTP_DELAY_REQUEST, 0)
-            send_time_ns = send_with_timestamp(sock, request, addr)
+            send_time_ns, kernel_timestamps["t3"] = send_with_timestamp(sock, request, addr)
             print(f"Sent delay request to {addr}")
 
-            data, _, _ = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
+            data, _, _, _ = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
             msg_type, timestamp = utils.parse_message_raw(data)
 
             if msg_type != utils.PTPMsgType.PTP_DELAY_RESPONSE.value:
@@ -120,34 +126,38 @@ def run_client(server_ip: str):
                 break
             t3 = send_time_ns
             t4 = timestamp
+            kernel_timestamps["t4"] = utils.is_kernel_timestamp(data)
             print(f"Received delay response, t3={t3}, t4={t4}")
             offset = ((t2 - t1) - (t4 - t3)) / 2
             delay = ((t2 - t1) + (t4 - t3)) / 2
-            offset_list.append(offset)
-            print(f"Offset calculated: {offset} ns")
+            kernel = all(kernel_timestamps.values())
+            offset_list.append((offset, kernel))
+            print(f"Offset calculated: {offset} ns ({'kernel' if kernel else 'fallback'} timestamps)")
 
             request = utils.build_message(utils.PTPMsgType.PTP_SYNC_REQUEST, 0)
             utils.send_message(sock, request, addr)
             print(f"Sent sync request to {addr} after delay response")
             
-            data, _, arrival_time_ns = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
+            data, _, arrival_time_ns, arrival_kernel = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
             msg_type, _ = utils.parse_message_raw(data)
 
             if msg_type != utils.PTPMsgType.PTP_SYNC_RESPONSE.value:
                 print(f"Unexpected message type {msg_type} received after delay response.")
                 break
             t2 = arrival_time_ns
+            kernel_timestamps["t2"] = arrival_kernel
 
-            data, _, _ = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
+            data, _, _, _ = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
             msg_type, timestamp_ns = utils.parse_message_raw(data)
 
             if msg_type != utils.PTPMsgType.PTP_SYNC_FOLLOW_UP.value:
                 print(f"Unexpected message type {msg_type} received after sync response.")
                 break
             t1 = timestamp_ns
+            kernel_timestamps["t1"] = utils.is_kernel_timestamp(data)
             print(f"Received sync follow-up, t1={t1}")
 
-            if t1 + offset + delay - t2 < 1e-6:  # Check if the offset is within 1 ms
+            if kernel and t1 + offset + delay - t2 < 1e-6:  # Check if the offset is within 1 ms
                 print(f"Synchronization successful for client. Offset: {offset * 1e-9} seconds, Delay: {delay * 1e-9} seconds")
                 send_completed(sock, addr)
                 return offset
@@ -157,7 +167,13 @@ def run_client(server_ip: str):
             continue
 
     send_completed(sock, addr)
-    return sum(offset_list) / len(offset_list) if offset_list else None
+
+    # Fallback timestamps include scheduling delays, only average them in when there is nothing better
+    kernel_offsets = [offset for offset, kernel in offset_list if kernel]
+    if not kernel_offsets and offset_list:
+        print("No offset measured with kernel timestamps on both ends, using fallback ones.")
+    offsets = kernel_offsets or [offset for offset, _ in offset_list]
+    return sum(offsets) / len(offsets) if offsets else None
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="UDP Client for Clock Synchronization")
@@ -0,0 +1,168 @@
+import os
+import sys
+import mmap
+import math
+import time
+import socket
+import struct
+import argparse
+import tempfile
+import utils
+from client import SERVER_PORT, create_client_socket, send_with_timestamp
+
+# Shared clock state, read by get_time_offset() in final-server/utils.py.
+# Guarded by a sequence counter that is odd while an update is being written.
+# seq, ref_time (s), offset (s), skew (s/s), error (s), skew_error (s/s), updated (s)
+STATE_FORMAT = "<Qdddddd"
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+STATE_PATH = "/dev/shm/clock_sync" if sys.platform == "linux" else os.path.join(tempfile.gettempdir(), "clock_sync")
+
+class SharedClockState:
+    """
+    Publishes the current clock estimate in a small memory-mapped file.
+
+    Readers map the same file and retry while the sequence counter is odd or
+    changes under them, so they never block the daemon and never see a torn
+    update.
+    """
+    def __init__(self, path: str = STATE_PATH):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, STATE_SIZE)
+            self.map = mmap.mmap(fd, STATE_SIZE)
+        finally:
+            os.close(fd)
+        self.seq = struct.unpack_from(STATE_FORMAT, self.map)[0] & ~1
+
+    def publish(self, ref_time: float, offset: float, skew: float, error: float, skew_error: float):
+        self.seq += 1
+        struct.pack_into("<Q", self.map, 0, self.seq)
+        struct.pack_into(STATE_FORMAT, self.map, 0, self.seq, ref_time, offset, skew, error, skew_error, time.time())
+        self.seq += 1
+        struct.pack_into("<Q", self.map, 0, self.seq)
+
+    def close(self):
+        self.map.close()
+
+def exchange(sock: socket.socket, addr: tuple):
+    """
+    Run one sync and delay exchange with the server.
+    Returns (offset_ns, delay_ns, kernel), or None if the server was busy or answered out of order.
+    kernel is True only if all four timestamps were taken by the kernel.
+    """
+    request = utils.build_message(utils.PTPMsgType.PTP_SYNC_REQUEST, 0)
+    utils.send_message(sock, request, addr)
+
+    data, _, t2, t2_kernel = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
+    msg_type, _ = utils.parse_message_raw(data)
+    if msg_type != utils.PTPMsgType.PTP_SYNC_RESPONSE.value:
+        return None
+
+    data, _, _, _ = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
+    msg_type, t1 = utils.parse_message_raw(data)
+    if msg_type != utils.PTPMsgType.PTP_SYNC_FOLLOW_UP.value:
+        return None
+    t1_kernel = utils.is_kernel_timestamp(data)
+
+    request = utils.build_message(utils.PTPMsgType.PTP_DELAY_REQUEST, 0)
+    t3, t3_kernel = send_with_timestamp(sock, request, addr)
+
+    data, _, _, _ = utils.receive_with_timestamp(sock, utils.MSG_SIZE)
+    msg_type, t4 = utils.parse_message_raw(data)
+    if msg_type != utils.PTPMsgType.PTP_DELAY_RESPONSE.value:
+        return None
+    t4_kernel = utils.is_kernel_timestamp(data)
+
+    offset = ((t2 - t1) - (t4 - t3)) / 2
+    delay = ((t2 - t1) + (t4 - t3)) / 2
+    return offset, delay, t1_kernel and t2_kernel and t3_kernel and t4_kernel
+
+def sample(sock: socket.socket, addr: tuple, burst: int):
+    """
+    Run a burst of exchanges and keep the one with the smallest delay.
+    Queueing only ever adds delay, so that exchange has the least asymmetry in it.
+    Exchanges with fallback timestamps are only kept if no exchange had kernel ones.
+    Returns (local_time, offset_ns, delay_ns, kernel) or None.
+    """
+    best = None
+    try:
+        for _ in range(burst):
+            try:
+                result = exchange(sock, addr)
+            except socket.timeout:
+                result = None
+
+            if result is None:
+                # Server full or out of step, try again next interval
+                break
+            if best is None or (result[2], -result[1]) > (best[3], -best[2]):
+                best = (time.time(), result[0], result[1], result[2])
+    finally:
+        request = utils.build_message(utils.PTPMsgType.PTP_SYNC_COMPLETED, 0)
+        utils.send_message(sock, request, addr)
+        utils.clear_error_queue(sock)
+    return best
+
+def fit(samples: list) -> tuple:
+    """
+    Least squares line through the (local_time, offset) samples.
+    Returns (ref_time, offset, skew, residual, skew_error) with the offset in ns at ref_time.
+    """
+    ref_time = samples[-1][0]
+    xs = [local_time - ref_time for local_time, _, _, _ in samples]
+    ys = [offset for _, offset, _, _ in samples]
+    n = len(samples)
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    sxx = sum((x - mean_x) ** 2 for x in xs)
+    if n < 3 or sxx == 0:
+        return ref_time, ys[-1], 0.0, 0.0, 0.0
+
+    skew = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sxx
+    offset = mean_y - skew * mean_x
+    residual = math.sqrt(sum((y - offset - skew * x) ** 2 for x, y in zip(xs, ys)) / (n - 2))
+    skew_error = residual / math.sqrt(sxx)
+    # skew is in ns per second of local time
+    return ref_time, offset, skew, residual, skew_error
+
+def run_daemon(server_ip: str, interval: float, burst: int, window: int, path: str):
+    """
+    Keep the clock estimate in shared memory up to date until interrupted.
+    """
+    sock = create_client_socket()
+    addr = (server_ip, SERVER_PORT)
+    state = SharedClockState(path)
+    samples = []
+
+    print(f"Clock sync daemon tracking {addr}, publishing to {path}")
+    try:
+        while True:
+            best = sample(sock, addr, burst)
+            if best is not None:
+                samples.append(best)
+                del samples[:-window]
+
+                ref_time, offset, skew, residual, skew_error = fit(samples)
+                # The true offset is within one delay of the measured one, whatever the path asymmetry
+                error = samples[-1][2] + residual
+                state.publish(ref_time, offset / 1e9, skew / 1e9, error / 1e9, skew_error / 1e9)
+                fallbacks = sum(1 for sample in samples if not sample[3])
+                print(f"Offset {offset / 1e6:.3f} ms, error {error / 1e6:.3f} ms, drift {skew / 1e3:.2f} ppm over {len(samples)} samples ({fallbacks} with fallback timestamps)")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Clock sync daemon shutting down.")
+    finally:
+        state.close()
+        sock.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuous clock synchronization daemon")
+    parser.add_argument('--server_ip', type=str, required=True, help='IP address of the server to synchronize with')
+    parser.add_argument('--interval', type=float, default=2.0, help='Seconds between sample bursts')
+    parser.add_argument('--burst', type=int, default=8, help='Exchanges per burst, the fastest one is kept')
+    parser.add_argument('--window', type=int, default=32, help='Samples used to estimate offset and drift')
+    parser.add_argument('--path', type=str, default=STATE_PATH, help='File the clock state is shared through')
+    args = parser.parse_args()
+
+    run_daemon(args.server_ip, args.interval, args.burst, args.window, args.path)
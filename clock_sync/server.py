@@ -1,106 +1,152 @@
 import time
 import utils
 import socket
+import argparse
+from multiprocessing import Process
 
 IP = '0.0.0.0'
 PORT = 8888
 
-busy = False
-actual_client = None
+MAX_SESSIONS = 1024 # Clients served at once before answering with PTP_BUSY
+SESSION_TIMEOUT = utils.SOCKET_TIMEOUT * utils.MAX_WAIT_TRIES # seconds without a message before a session is dropped
 
-def create_server_socket():
+class Session:
+    """
+    Sync state of one client, keyed by its address in the session table.
+    """
+    def __init__(self, addr: tuple, now: float):
+        self.addr = addr
+        self.started = now
+        self.last_seen = now
+        self.exchanges = 0
+
+sessions = {}
+
+def create_server_socket(reuse_port: bool = False):
     """
     Create a UDP server socket with timestamping enabled.
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Every worker binds its own socket, the kernel keeps each client on the same one
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.settimeout(utils.SOCKET_TIMEOUT)
-    
+
     # Enable SO_TIMESTAMPING
     utils.setup_timestamping_socket(sock)
-    
+
     sock.bind((IP, PORT))
     return sock
 
 def receive_with_timestamp(sock: socket.socket):
     """
     Receive data with kernel timestamp.
-    Returns (data, addr, timestamp_ns) where timestamp_ns is in nanoseconds.
+    Returns (data, addr, timestamp_ns, kernel) where timestamp_ns is in nanoseconds.
     """
     return utils.receive_with_timestamp(sock, utils.MSG_SIZE)
 
-def handle_message(data: bytes, addr: tuple, sock: socket.socket, arrival_time_ns: int):
+def expire_sessions(now: float):
+    """
+    Drop the sessions of clients that stopped responding.
+    """
+    for addr in [addr for addr, session in sessions.items() if now - session.last_seen > SESSION_TIMEOUT]:
+        print(f"Client {addr} did not respond, dropping its session.")
+        del sessions[addr]
+
+def handle_message(data: bytes, addr: tuple, sock: socket.socket, arrival_time_ns: int, arrival_kernel: bool = True):
     """
     Handle incoming messages and send appropriate responses.
     """
-    global busy, actual_client
     msg_type = data[0]
+    now = time.monotonic()
 
-    print(f"Received message from {addr}: type={msg_type}, client={addr}")
-    
-    if addr != actual_client:
-        if busy:
-            print(f"Server is busy, sending busy response to {addr}.")
+    session = sessions.get(addr)
+    if session is None:
+        if msg_type == utils.PTPMsgType.PTP_SYNC_COMPLETED.value:
+            return True
+        if len(sessions) >= MAX_SESSIONS:
+            print(f"Server is full, sending busy response to {addr}.")
             response = utils.build_message(utils.PTPMsgType.PTP_BUSY, 0)
             utils.send_message(sock, response, addr)
-            return
-        else:
-            print(f"New client {addr} connected.")
-            actual_client = addr
-            busy = True
+            return False
+        print(f"New client {addr} connected.")
+        session = Session(addr, now)
+        sessions[addr] = session
+    session.last_seen = now
 
     if msg_type == utils.PTPMsgType.PTP_SYNC_REQUEST.value:
         response = utils.build_message(utils.PTPMsgType.PTP_SYNC_RESPONSE, 0)
-        utils.send_message(sock, response, addr)
-        print(f"Sent sync response to {addr}.")
-        
-        timestamp = int(utils.get_send_timestamp(sock) * 1e9)  # Convert to nanoseconds
+        tx_id = utils.send_message(sock, response, addr)
 
-        response = utils.build_message(utils.PTPMsgType.PTP_SYNC_FOLLOW_UP, timestamp)
+        # Looked up by packet id, timestamps of responses to other clients can't be mistaken for this one
+        timestamp = utils.get_send_timestamp(sock, tx_id)
+        kernel = timestamp is not None
+        if not kernel:
+            print(f"No send timestamp for sync response to {addr}, sending a fallback one.")
+            timestamp = utils.get_current_time_ns()
+
+        response = utils.build_message(utils.PTPMsgType.PTP_SYNC_FOLLOW_UP, timestamp, kernel)
         utils.send_message(sock, response, addr)
-        print(f"Sent sync follow-up to {addr}.")
+        session.exchanges += 1
     elif msg_type == utils.PTPMsgType.PTP_DELAY_REQUEST.value:
-        response = utils.build_message(utils.PTPMsgType.PTP_DELAY_RESPONSE, arrival_time_ns)
+        response = utils.build_message(utils.PTPMsgType.PTP_DELAY_RESPONSE, arrival_time_ns, arrival_kernel)
         utils.send_message(sock, response, addr)
-        print(f"Sent delay response to {addr}.")
     elif msg_type == utils.PTPMsgType.PTP_SYNC_COMPLETED.value:
-        print(f"Sync completed for client {addr}.")
-        utils.clear_error_queue(sock)  # Clear error queue after sync completion
-        busy = False
-        actual_client = None
+        print(f"Sync completed for client {addr} after {session.exchanges} exchanges.")
+        del sessions[addr]
     else:
         print(f"Unknown message type: {msg_type}.")
     return True
 
-def run_server():
+def run_server(reuse_port: bool = False):
     """
     Run the UDP server to listen for PTP messages with kernel timestamping.
     """
-    sock = create_server_socket()
+    sock = create_server_socket(reuse_port)
     print(f"Server listening on {IP}:{PORT} with SO_TIMESTAMPING enabled")
 
-    global busy, actual_client
     try:
-        tries_count = 0
+        last_sweep = time.monotonic()
         while True:
             try:
-                data, addr, arrival_time_ns = receive_with_timestamp(sock)
+                data, addr, arrival_time_ns, arrival_kernel = receive_with_timestamp(sock)
                 if len(data) == utils.MSG_SIZE:
-                    handle_message(data, addr, sock, arrival_time_ns)
+                    handle_message(data, addr, sock, arrival_time_ns, arrival_kernel)
                 else:
-                    print(f"Received invalid message size from {addr}: {len(data)} bytes.")                
+                    print(f"Received invalid message size from {addr}: {len(data)} bytes.")
             except socket.error as e:
-                tries_count += 1
-                if tries_count >= utils.MAX_WAIT_TRIES and busy:
-                    print("Client did not respond, freeing server for new connections.")
-                    busy = False
-                    actual_client = None
-                    tries_count = 0
-                continue
+                pass
+
+            now = time.monotonic()
+            if now - last_sweep >= utils.SOCKET_TIMEOUT:
+                expire_sessions(now)
+                last_sweep = now
     except KeyboardInterrupt:
         print("Server shutting down.")
     finally:
         sock.close()
-        
+
+def run_workers(workers: int):
+    """
+    Run one server per worker on SO_REUSEPORT sockets bound to the same port.
+    """
+    processes = [Process(target=run_server, args=(True,)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="UDP Server for Clock Synchronization")
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes sharing the port through SO_REUSEPORT')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_workers(args.workers)
+    else:
+        run_server()
@@ -1,4 +1,6 @@
 import enum
+import time
+import select
 import socket
 import struct
 
@@ -7,6 +9,7 @@ SOCKET_TIMEOUT = 1  # seconds
 MAX_CONNECTION_TRIES = 3 # Maximum number of tries to connect to the server
 MAX_SYNC_TRIES = 10 # Maximum number of tries to synchronize with the server
 MAX_WAIT_TRIES = 5 # Maximum number of tries to wait for a response from the client
+TX_TIMESTAMP_TIMEOUT = 0.01 # seconds to wait for the kernel to report a send timestamp
 
 # SO_TIMESTAMPING constants
 SOF_TIMESTAMPING_TX_HARDWARE = 1
@@ -16,9 +19,24 @@ SOF_TIMESTAMPING_RX_SOFTWARE = 8
 SOF_TIMESTAMPING_SOFTWARE = 16
 SOF_TIMESTAMPING_SYS_HARDWARE = 32
 SOF_TIMESTAMPING_RAW_HARDWARE = 64
+SOF_TIMESTAMPING_OPT_ID = 128 # Tag every TX timestamp with the id of the packet it belongs to
+SOF_TIMESTAMPING_OPT_TSONLY = 2048 # Queue only the timestamp, not a copy of the packet
 
 # Control message types
 SCM_TIMESTAMPING = 37
+IP_RECVERR = 11
+IPV6_RECVERR = 25
+
+# struct sock_extended_err: errno, origin, type, code, pad, info, data (the packet id)
+SOCK_EXTENDED_ERR_FORMAT = '=IBBBBII'
+SO_EE_ORIGIN_TIMESTAMPING = 4
+
+# Set in the message type byte when the timestamp carried is not a kernel one
+FALLBACK_TIMESTAMP_FLAG = 0x80
+
+# Per socket, the id the kernel will give the next packet sent and the TX timestamps read but not yet claimed
+_next_tx_id = {}
+_tx_timestamps = {}
 
 class PTPMsgType(enum.Enum):
     """
@@ -49,9 +67,15 @@ def setup_timestamping_socket(sock: socket.socket):
     """
     timestamping_flags = (SOF_TIMESTAMPING_RX_SOFTWARE | 
                          SOF_TIMESTAMPING_TX_SOFTWARE |
-                         SOF_TIMESTAMPING_SOFTWARE)
+                         SOF_TIMESTAMPING_SOFTWARE |
+                         SOF_TIMESTAMPING_OPT_ID |
+                         SOF_TIMESTAMPING_OPT_TSONLY)
     
     sock.setsockopt(socket.SOL_SOCKET, SCM_TIMESTAMPING, timestamping_flags)
+
+    # Enabling OPT_ID starts the kernel's packet counter at zero
+    _next_tx_id[sock.fileno()] = 0
+    _tx_timestamps[sock.fileno()] = {}
     return sock
 
 def extract_timestamp_from_cmsg(cmsg_list) -> float:
@@ -68,22 +92,69 @@ def extract_timestamp_from_cmsg(cmsg_list) -> float:
                 return sec + nsec / 1e9
     return None
 
-def get_send_timestamp(sock: socket.socket) -> float:
+def extract_tx_id_from_cmsg(cmsg_list) -> int:
     """
-    Get send timestamp from socket error queue.
-    Returns timestamp in seconds as float, or None if not available.
+    Extract the packet id a TX timestamp belongs to from an error queue control message list.
+    Returns None if the message is not a timestamp.
     """
+    for cmsg_level, cmsg_type, cmsg_data in cmsg_list:
+        if (cmsg_level, cmsg_type) in ((socket.IPPROTO_IP, IP_RECVERR), (socket.IPPROTO_IPV6, IPV6_RECVERR)):
+            _, origin, _, _, _, _, tx_id = struct.unpack_from(SOCK_EXTENDED_ERR_FORMAT, cmsg_data)
+            if origin == SO_EE_ORIGIN_TIMESTAMPING:
+                return tx_id
+    return None
+
+def read_error_queue(sock: socket.socket) -> dict:
+    """
+    Read every TX timestamp waiting in the error queue without blocking.
+    Returns a dict of packet id to timestamp in nanoseconds.
+    """
+    timestamps = {}
+    # Non-blocking, a socket timeout would otherwise be waited out once the queue is empty
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
     try:
-        data, ancdata, msg_flags, addr = sock.recvmsg(1, 1024, socket.MSG_ERRQUEUE)
-        timestamp = extract_timestamp_from_cmsg(ancdata)
-        return timestamp
+        while True:
+            data, ancdata, msg_flags, addr = sock.recvmsg(1, 1024, socket.MSG_ERRQUEUE)
+            tx_id = extract_tx_id_from_cmsg(ancdata)
+            timestamp = extract_timestamp_from_cmsg(ancdata)
+            if tx_id is not None and timestamp is not None:
+                timestamps[tx_id] = int(timestamp * 1e9)
     except socket.error:
-        return None
+        pass  # Queue is empty
+    finally:
+        sock.settimeout(timeout)
+
+    return timestamps
+
+def get_send_timestamp(sock: socket.socket, tx_id: int, timeout: float = TX_TIMESTAMP_TIMEOUT) -> int:
+    """
+    Get the send timestamp of the packet with the given id from the socket error queue.
+    Waits for the error queue to become readable for up to timeout seconds.
+    Returns timestamp in nanoseconds, or None if not available.
+    """
+    pending = _tx_timestamps.setdefault(sock.fileno(), {})
+    poller = select.poll()
+    poller.register(sock.fileno(), select.POLLERR)
+    deadline = time.monotonic() + timeout
+
+    while tx_id not in pending:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not poller.poll(remaining * 1000):
+            break
+        pending.update(read_error_queue(sock))
+
+    timestamp = pending.pop(tx_id, None)
+    # Timestamps of older packets will never be asked for
+    for stale in [stale for stale in pending if (tx_id - stale) % 2**32 < 2**31]:
+        del pending[stale]
+    return timestamp
 
 def receive_with_timestamp(sock: socket.socket, bufsize: int):
     """
     Receive data with kernel timestamp.
-    Returns (data, addr, timestamp_ns) where timestamp_ns is in nanoseconds.
+    Returns (data, addr, timestamp_ns, kernel) where timestamp_ns is in nanoseconds
+    and kernel is False if the timestamp is a fallback taken after the fact.
     """
     try:
         data, ancdata, msg_flags, addr = sock.recvmsg(bufsize, 1024)
@@ -91,51 +162,50 @@ def receive_with_timestamp(sock: socket.socket, bufsize: int):
         # Extract timestamp from control messages
         timestamp = extract_timestamp_from_cmsg(ancdata)
         if timestamp is not None:
-            timestamp_ns = int(timestamp * 1e9)
-        else:
-            # Fallback to current time if no timestamp available
-            timestamp_ns = get_current_time_ns()
-            
-        return data, addr, timestamp_ns
+            return data, addr, int(timestamp * 1e9), True
+
+        # Fallback to current time if no timestamp available
+        return data, addr, get_current_time_ns(), False
     except socket.error:
         raise
 
 def get_current_time_ns() -> int:
     """
-    Get current time in nanoseconds using kernel time.
+    Get current time in nanoseconds.
     This is a fallback when timestamps are not available.
     """
-    print("Using fallback for current time in nanoseconds.")
-    import time
-    return int(time.time() * 1e9)
+    return time.time_ns()
 
-def build_message(msg_type: PTPMsgType, timestamp: int) -> bytearray:
+def build_message(msg_type: PTPMsgType, timestamp: int, kernel: bool = True) -> bytearray:
     """
     Send a PTP message to the specified address.
     """
     message = bytearray(MSG_SIZE)
-    message[0] = msg_type.value
+    message[0] = msg_type.value if kernel else msg_type.value | FALLBACK_TIMESTAMP_FLAG
     message[1:9] = timestamp.to_bytes(8, 'big')
     
     return message
 
-def send_message(sock: socket.socket, message: bytes, addr: tuple):
+def send_message(sock: socket.socket, message: bytes, addr: tuple) -> int:
     """
     Send a PTP message to the specified address.
+    Returns the id of the packet, used to look up its send timestamp.
     """
-
     sock.sendto(message, addr)
 
+    # The kernel numbers every packet sent on the socket, keep count to know which id this one got
+    fd = sock.fileno()
+    tx_id = _next_tx_id.get(fd, 0)
+    _next_tx_id[fd] = (tx_id + 1) % 2**32
+    return tx_id
+
 def clear_error_queue(sock: socket.socket):
     """
     Clear the error queue of the socket.
     This is useful to avoid stale timestamps.
     """
-    try:
-        while True:
-            sock.recvmsg(1, 1024, socket.MSG_ERRQUEUE)
-    except socket.error:
-        pass  # Ignore errors when clearing the queue
+    read_error_queue(sock)
+    _tx_timestamps.get(sock.fileno(), {}).clear()
 
     return
 
@@ -146,7 +216,7 @@ def parse_message(data: bytes) -> PTPMessage:
     if len(data) < MSG_SIZE:
         raise ValueError("Data is too short to be a valid PTP message.")
     
-    msg_type = PTPMsgType(data[0])
+    msg_type = PTPMsgType(data[0] & ~FALLBACK_TIMESTAMP_FLAG)
     timestamp = int.from_bytes(data[1:9], 'big')
     
     return PTPMessage(msg_type, timestamp)
@@ -158,7 +228,13 @@ def parse_message_raw(data: bytes) -> tuple:
     if len(data) < MSG_SIZE:
         raise ValueError("Data is too short to be a valid PTP message.")
     
-    msg_type = data[0]
+    msg_type = data[0] & ~FALLBACK_TIMESTAMP_FLAG
     timestamp = int.from_bytes(data[1:9], 'big')
     
-    return msg_type, timestamp
\ No newline at end of file
+    return msg_type, timestamp
+
+def is_kernel_timestamp(data: bytes) -> bool:
+    """
+    Check whether the timestamp carried by a PTP message was taken by the kernel.
+    """
+    return not data[0] & FALLBACK_TIMESTAMP_FLAG
\ No newline at end of file
@@ -9,24 +9,33 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 SERVER_IP = os.getenv("SERVICES_API_HOST")
 SERVER_PORT = os.getenv("SERVICES_API_PORT")
+# http for a local tests-service started without a certificate
+SERVER_SCHEME = os.getenv("SERVICES_API_SCHEME", "https")
 
-TEST_API_URL = f"https://{SERVER_IP}:{SERVER_PORT}/v1/tests/"
+# Without a Tests API configured no test is created and nothing is measured
+ENABLED = SERVER_IP is not None
+
+TEST_API_URL = f"{SERVER_SCHEME}://{SERVER_IP}:{SERVER_PORT}/v1/tests/"
 VERIFY_SSL = False
 
+# One pooled keep-alive connection instead of a new TLS handshake per call
+session = requests.Session()
+session.verify = VERIFY_SSL
+
 class TestsAPI:
 
     @staticmethod
     def create_test(test_type, house_id, division):
-        return
+        if not ENABLED:
+            return None
         try:
-            response = requests.post(
+            response = session.post(
                 TEST_API_URL,
                 json={
                     "test_type": test_type,
                     "houseID": house_id,
                     "division": division
-                },
-                verify=VERIFY_SSL
+                }
             )
             response.raise_for_status()
             return response.json().get("test_id", None)
@@ -36,16 +45,16 @@ class TestsAPI:
         
     @staticmethod
     def update_test(test_id, start_time, notes=""):
-        return
+        if not ENABLED:
+            return None
         try:
-            response = requests.patch(
+            response = session.patch(
                 TEST_API_URL,
                 json={
                     "test_id": test_id,
                     "notes": notes,
                     "start_time": start_time
-                },
-                verify=VERIFY_SSL
+                }
             )
             response.raise_for_status()
             return True
@@ -55,16 +64,17 @@ class TestsAPI:
 
         
     @staticmethod
-    def get_tests(test_id, house_id):
-        return
+    def get_tests(test_id, house_id, **filters):
+        if not ENABLED:
+            return None
         try:
-            response = requests.get(
+            response = session.get(
                 TEST_API_URL,
                 params={
                     "test_id": test_id,
-                    "houseID": house_id
-                },
-                verify=VERIFY_SSL
+                    "houseID": house_id,
+                    **filters
+                }
             )
             response.raise_for_status()
             return response.json()
@@ -74,12 +84,12 @@ class TestsAPI:
     
     @staticmethod    
     def delete_test(test_id):
-        return
+        if not ENABLED:
+            return None
         try:
-            response = requests.delete(
+            response = session.delete(
                 TEST_API_URL,
-                params={"test_id": test_id},
-                verify=VERIFY_SSL
+                params={"test_id": test_id}
             )
             response.raise_for_status()
             return True
@@ -89,16 +99,16 @@ class TestsAPI:
         
     @staticmethod
     def add_measurement(test_id, timestamp, point):
-        return
+        if not ENABLED:
+            return None
         try:
-            response = requests.post(
+            response = session.post(
                 f"{TEST_API_URL}measurement",
                 json={
                     "test_id": test_id,
                     "timestamp": timestamp,
                     "point": point
-                },
-                verify=VERIFY_SSL
+                }
             )
             response.raise_for_status()
             return True
@@ -108,15 +118,15 @@ class TestsAPI:
         
     @staticmethod
     def add_measurement_bulk(test_id, results_list):
-        return
+        if not ENABLED:
+            return None
         try:
-            response = requests.post(
+            response = session.post(
                 f"{TEST_API_URL}measurement/bulk",
                 json={
                     "test_id": test_id,
                     "measurements": results_list,
-                },
-                verify=VERIFY_SSL
+                }
             )
             response.raise_for_status()
             return True
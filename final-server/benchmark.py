@@ -0,0 +1,248 @@
+import argparse
+import functools
+import gc
+import json
+import math
+import os
+import platform
+import timeit
+import tracemalloc
+
+import numpy as np
+
+import utils
+from landmark_trace import load_trace, landmark_dicts
+from replay import ReplayClock, load_exercises
+
+# Local and not versioned, timings only compare on the machine that recorded them.
+# Record one with `python benchmark.py --save-baseline` before making changes
+BASELINE_PATH = "benchmark_baseline.json"
+
+# Everything the processing unit and the client do per frame has to fit in this
+FRAME_BUDGET_NS = 1e9 / 30
+
+# Standing pose facing the camera, (x, y) per landmark
+_BASE_POSE = np.array([
+    (0.50, 0.20), (0.51, 0.18), (0.52, 0.18), (0.53, 0.18), (0.49, 0.18), (0.48, 0.18),
+    (0.47, 0.18), (0.55, 0.19), (0.45, 0.19), (0.51, 0.23), (0.49, 0.23), (0.58, 0.32),
+    (0.42, 0.32), (0.60, 0.45), (0.40, 0.45), (0.61, 0.57), (0.39, 0.57), (0.62, 0.60),
+    (0.38, 0.60), (0.61, 0.61), (0.39, 0.61), (0.60, 0.59), (0.40, 0.59), (0.55, 0.60),
+    (0.45, 0.60), (0.55, 0.75), (0.45, 0.75), (0.55, 0.90), (0.45, 0.90), (0.54, 0.92),
+    (0.46, 0.92), (0.57, 0.93), (0.43, 0.93),
+])
+
+_LEFT_ARM = [13, 15, 17, 19, 21]
+_RIGHT_ARM = [14, 16, 18, 20, 22]
+_LEFT_LEG = [25, 27, 29, 31]
+_RIGHT_LEG = [26, 28, 30, 32]
+
+def synthetic_sequence(frames: int = 300, fps: int = 30, seed: int = 0) -> list:
+    """Generate a deterministic pose sequence as landmark dicts.
+
+    The arms swing from the hips up to shoulder height and back every two
+    seconds, and the knees take turns lifting, so every exercise changes
+    state and counts reps along the way.
+    """
+    rng = np.random.default_rng(seed)
+    sequence = []
+    for frame in range(frames):
+        phase = 2 * math.pi * frame / (2 * fps)
+        pose = _BASE_POSE.copy()
+
+        # Rotate each arm around its shoulder, 0 is hanging down, pi/2 is horizontal
+        lift = (1 - math.cos(phase)) / 2 * (math.pi / 2)
+        for shoulder, arm, side in ((11, _LEFT_ARM, 1), (12, _RIGHT_ARM, -1)):
+            offsets = pose[arm] - pose[shoulder]
+            rotation = np.array([[math.cos(lift), side * math.sin(lift)], [-side * math.sin(lift), math.cos(lift)]])
+            pose[arm] = pose[shoulder] + offsets @ rotation.T
+
+        knee_lift = 0.08 * max(0.0, math.sin(phase))
+        pose[_LEFT_LEG, 1] -= knee_lift
+        pose[_RIGHT_LEG, 1] -= 0.08 * max(0.0, -math.sin(phase))
+
+        pose += rng.normal(0, 0.002, pose.shape)
+        sequence.append([
+            {"x": float(x), "y": float(y), "z": 0.0, "visibility": 0.95, "presence": 0.95}
+            for x, y in pose
+        ])
+    return sequence
+
+def trace_sequence(path: str) -> list:
+    trace = load_trace(path)
+    return [landmark_dicts(landmarks, detected) for landmarks, detected in zip(trace["landmarks"], trace["detected"])]
+
+def measure(function, ops: list, repeat: int = 7) -> dict:
+    """Time a callable and trace its allocations.
+
+    Args:
+        function: Runs every op once.
+        ops: The callables one call of function is made of, one per frame,
+            run one at a time to trace the allocations of each frame.
+
+    Returns:
+        ns_per_op: The median of repeat runs, each long enough to be stable.
+        bytes_per_op: The most memory allocated at once while an op runs,
+            the per-frame temporaries included, averaged over the ops.
+        allocs_per_op: Blocks an op allocated and still holds once it
+            returns, from tracemalloc snapshot diffs, averaged over the ops.
+        retained_per_op: Bytes of those blocks.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    timings = sorted(timer.repeat(repeat=repeat, number=number))
+
+    # A warm-up run fills caches that would otherwise count as the first frame's allocations
+    function()
+    traced = _trace_ops(ops)
+    # What the tracing loop allocates itself
+    overhead = _trace_ops([_noop] * len(ops))
+    bytes_total, allocs, retained = (max(0, value - base) for value, base in zip(traced, overhead))
+
+    return {
+        "ns_per_op": timings[len(timings) // 2] / number / len(ops) * 1e9,
+        "bytes_per_op": bytes_total / len(ops),
+        "allocs_per_op": allocs / len(ops),
+        "retained_per_op": retained / len(ops),
+    }
+
+def _noop():
+    pass
+
+def _trace_ops(ops: list) -> tuple:
+    """Run the ops one at a time under tracemalloc, returns (sum of per-op peaks, blocks kept, bytes kept)."""
+    gc.collect()
+    tracemalloc.start()
+    peak_bytes = 0
+    for op in ops:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        op()
+        _, peak = tracemalloc.get_traced_memory()
+        peak_bytes += peak - before
+    # Snapshots only hold what was allocated since start, so they are the diff of what the ops kept
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).statistics("filename")
+    return peak_bytes, sum(stat.count for stat in retained), sum(stat.size for stat in retained)
+
+def build_cases(sequence: list) -> dict:
+    """Build the benchmark cases as name -> (callable, the per-frame ops it runs)."""
+    cases = {}
+    frame = sequence[len(sequence) // 2]
+
+    def single(function):
+        return function, [function]
+
+    cases["get_angle_2_points_x_axis"] = single(lambda: utils.get_angle_2_points_x_axis(frame[11], frame[15]))
+    cases["get_angle_3_points"] = single(lambda: utils.get_angle_3_points(frame[11], frame[13], frame[15]))
+    cases["get_angle_4_points"] = single(lambda: utils.get_angle_4_points(frame[12], frame[11], frame[24], frame[23]))
+
+    clock = ReplayClock()
+    exercises = load_exercises(clock)
+    for name, exercise in exercises.items():
+        def step(index, exercise=exercise):
+            clock.now = index / 30
+            exercise(sequence[index], True)
+
+        def run_exercise(step=step):
+            for index in range(len(sequence)):
+                step(index)
+        cases[f"{name}_exercise"] = (run_exercise, [functools.partial(step, index) for index in range(len(sequence))])
+
+    image = np.zeros((480, 640, 3), dtype=np.uint8)
+    points = [(landmark["x"], landmark["y"]) for landmark in frame]
+    style = {"right_arm": True, "left_arm": False, "torso": True}
+    cases["draw_from_json"] = single(lambda: utils.draw_from_json(image, points, style))
+
+    colored_style = utils.get_colored_style(right_arm=utils.GREEN_STYLE, left_arm=utils.RED_STYLE, torso=utils.GREEN_STYLE)
+    connections = list(utils._POSE_CONNECTIONS)
+    cases["new_draw_landmarks"] = single(lambda: utils.new_draw_landmarks(image=image, landmark_list=frame, connections=connections, connection_drawing_spec=colored_style))
+
+    cases["result_json"] = single(lambda: json.dumps(utils.build_result(frame, style, False, 123456, 42)))
+
+    try:
+        from av import VideoFrame
+    except ImportError:
+        print("av is not installed, skipping to_ndarray")
+    else:
+        rgb = np.random.default_rng(0).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+        video_frame = VideoFrame.from_ndarray(rgb, format="rgb24").reformat(format="yuv420p")
+        cases["to_ndarray_bgr24"] = single(lambda: video_frame.to_ndarray(format="bgr24"))
+
+    return cases
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+def machine() -> str:
+    """What the timings depend on, baselines are kept per machine."""
+    return f"{platform.node()} {cpu_model()} x{os.cpu_count()} {platform.python_implementation()} {platform.python_version()}"
+
+def compare(results: dict, baseline: dict, threshold: float) -> int:
+    """Print the results next to a baseline from the same machine and count the regressions."""
+    regressions = 0
+    print(f"{'case':<28}{'ns/op':>14}{'baseline':>14}{'change':>10}{'B/op':>12}{'allocs/op':>12}")
+    for name, result in results.items():
+        reference = baseline.get(name)
+        line = f"{name:<28}{result['ns_per_op']:>14.0f}"
+        memory = f"{result['bytes_per_op']:>12.0f}{result['allocs_per_op']:>12.1f}"
+        if reference:
+            change = result["ns_per_op"] / reference["ns_per_op"] - 1
+            flag = ""
+            if change > threshold or result["bytes_per_op"] > reference["bytes_per_op"] * (1 + threshold) + 64:
+                flag = "  REGRESSION"
+                regressions += 1
+            line += f"{reference['ns_per_op']:>14.0f}{change:>+10.1%}{memory}{flag}"
+        else:
+            line += f"{'-':>14}{'-':>10}{memory}"
+        print(line)
+    return regressions
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the per-frame hot paths")
+    parser.add_argument("--trace", type=str, default=None, help="Landmark trace to use instead of the synthetic sequence")
+    parser.add_argument("--filter", type=str, default=None, help="Only run cases whose name contains this")
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH, help="Baseline file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as this machine's baseline")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Slowdown that counts as a regression, single cases are noisy below this")
+
+    args = parser.parse_args()
+
+    sequence = trace_sequence(args.trace) if args.trace else synthetic_sequence()
+    cases = build_cases(sequence)
+
+    results = {}
+    for name, (function, ops) in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(function, ops)
+
+    baselines = {"machines": {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baselines = json.load(f)
+    baseline = baselines["machines"].get(machine(), {}).get("results", {})
+    if not baseline:
+        print(f"No baseline for {machine()}, record one with --save-baseline")
+    regressions = compare(results, baseline, args.threshold)
+
+    # What the processing unit spends per frame outside the detector
+    per_frame = sum(results[name]["ns_per_op"] for name in ("arms_exercise", "result_json", "to_ndarray_bgr24") if name in results)
+    if per_frame:
+        print(f"Processing unit per-frame overhead: {per_frame / 1000:.1f} us ({per_frame / FRAME_BUDGET_NS:.2%} of a 30 fps frame)")
+
+    if args.save_baseline:
+        baselines["machines"][machine()] = {"results": results}
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    exit(1 if regressions else 0)
@@ -0,0 +1,166 @@
+import sys
+import time
+import threading
+import cv2
+import numpy as np
+from typing import Callable, Optional, Tuple
+
+# Modes most UVC webcams support natively, smallest first
+CAMERA_MODES = [
+    (320, 240),
+    (424, 240),
+    (640, 360),
+    (640, 480),
+    (848, 480),
+    (960, 540),
+    (1280, 720),
+    (1920, 1080),
+]
+
+def select_capture_size(width: int, height: int) -> Tuple[int, int]:
+    """Pick the smallest common camera mode that covers the requested size.
+
+    Modes with the requested aspect ratio win, so the frame can be sent
+    without a resize when the camera has that exact mode.
+    """
+    covering = [mode for mode in CAMERA_MODES if mode[0] >= width and mode[1] >= height]
+    if not covering:
+        return CAMERA_MODES[-1]
+    same_aspect = [mode for mode in covering if mode[0] * height == mode[1] * width]
+    return min(same_aspect or covering, key=lambda mode: mode[0] * mode[1])
+
+def open_camera(path, width: int, height: int, fps: int) -> cv2.VideoCapture:
+    """Open a camera with the backend that works best on each platform."""
+    if sys.platform == "linux":
+        cap = cv2.VideoCapture(path, cv2.CAP_V4L2)
+    elif sys.platform == "win32":
+        cap = cv2.VideoCapture(path, cv2.CAP_DSHOW)
+    else:
+        cap = cv2.VideoCapture(path, cv2.CAP_ANY)
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    cap.set(cv2.CAP_PROP_FPS, fps)
+    return cap
+
+class CaptureThread(threading.Thread):
+    """Grabs camera frames on its own thread into a preallocated ring.
+
+    Every slot holds the mirrored full resolution BGR frame (used for the local
+    overlay) and the resized RGB frame that is handed to the encoder. Flip,
+    resize and colour conversion all write into reused buffers, so steady
+    state capture allocates nothing. When the camera already delivers the
+    output size the resize is skipped.
+
+    The consumer only ever looks at the newest slot. The writer never touches
+    the newest slot nor the one the consumer is holding, so three slots are
+    enough for it to always have somewhere to write.
+    """
+
+    def __init__(self, path, width: int, height: int, fps: int, output_size: Tuple[int, int], slots: int = 3):
+        super().__init__(daemon=True)
+        if slots < 3:
+            raise ValueError("The capture ring needs at least three slots.")
+        self.cap = open_camera(path, width, height, fps)
+        self.output_size = output_size
+        self.pending_output_size = None
+        self.slots = slots
+        self.on_frame: Optional[Callable[[], None]] = None
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.failed = False
+
+        self.raw = None
+        self.resized = np.empty((output_size[1], output_size[0], 3), dtype=np.uint8)
+        self.full_frames = None
+        self.rgb_frames = [np.empty_like(self.resized) for _ in range(slots)]
+        self.capture_times = [0.0] * slots
+
+        self.sequence = 0
+        self.latest = None
+        self.held = None
+
+    def _allocate(self, shape):
+        self.full_frames = [np.empty(shape, dtype=np.uint8) for _ in range(self.slots)]
+
+    def _resize_output(self, output_size: Tuple[int, int]):
+        # Fresh arrays, so a frame the consumer still holds is left untouched
+        self.output_size = output_size
+        self.resized = np.empty((output_size[1], output_size[0], 3), dtype=np.uint8)
+        rgb_frames = [np.empty_like(self.resized) for _ in range(self.slots)]
+        with self.lock:
+            self.rgb_frames = rgb_frames
+            self.latest = None
+
+    def set_output_size(self, output_size: Tuple[int, int]):
+        """Change the size of the frames handed to the encoder from the next frame on."""
+        self.pending_output_size = output_size
+
+    def _next_slot(self) -> int:
+        with self.lock:
+            for slot in range(self.slots):
+                if slot != self.latest and slot != self.held:
+                    return slot
+
+    def run(self):
+        while not self.stop_event.is_set():
+            ret, raw = self.cap.read(self.raw)
+            capture_time = time.monotonic()
+            if not ret:
+                print("Failed to read frame from camera")
+                self.failed = True
+                break
+            self.raw = raw
+
+            output_size = self.pending_output_size
+            if output_size is not None:
+                self.pending_output_size = None
+                if output_size != self.output_size:
+                    self._resize_output(output_size)
+
+            if self.full_frames is None or self.full_frames[0].shape != raw.shape:
+                self._allocate(raw.shape)
+
+            slot = self._next_slot()
+            cv2.flip(raw, 1, dst=self.full_frames[slot])
+            if raw.shape[:2] == self.resized.shape[:2]:
+                cv2.cvtColor(self.full_frames[slot], cv2.COLOR_BGR2RGB, dst=self.rgb_frames[slot])
+            else:
+                cv2.resize(self.full_frames[slot], self.output_size, dst=self.resized)
+                cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=self.rgb_frames[slot])
+            self.capture_times[slot] = capture_time
+
+            with self.lock:
+                self.sequence += 1
+                self.latest = slot
+
+            if self.on_frame:
+                self.on_frame()
+
+        if self.on_frame:
+            self.on_frame()
+
+    def acquire(self, after_sequence: int) -> Optional[Tuple[int, np.ndarray, np.ndarray, float]]:
+        """Hold the newest frame if it is newer than after_sequence.
+
+        Returns:
+            (sequence, full_bgr, rgb, capture_time) or None if no new frame is
+            ready. capture_time is in time.monotonic() seconds. The arrays
+            stay valid until release() is called.
+        """
+        with self.lock:
+            if self.latest is None or self.sequence <= after_sequence:
+                return None
+            self.held = self.latest
+            return self.sequence, self.full_frames[self.held], self.rgb_frames[self.held], self.capture_times[self.held]
+
+    def release(self):
+        with self.lock:
+            self.held = None
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join(timeout=1)
+        self.cap.release()
@@ -2,7 +2,6 @@ import asyncio
 import fractions
 import os
 import websockets
-import cv2
 import json
 import time
 import utils
@@ -10,12 +9,19 @@ import sys
 import subprocess
 from utils import get_time_offset
 from api_interface import TestsAPI
-from aiortc import RTCConfiguration, RTCIceCandidate, RTCIceServer, RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from aiortc import RTCConfiguration, RTCIceCandidate, RTCIceServer, RTCPeerConnection, RTCRtpSender, RTCSessionDescription, VideoStreamTrack
+from aiortc.codecs import vpx
 from av import VideoFrame
 from dotenv import load_dotenv
 import logging
-from multiprocessing import Process, Queue
-from display import start_display
+from multiprocessing import Process
+from display import SharedFrameBuffer, start_display
+from capture import CaptureThread, select_capture_size
+from frame_history import FrameHistory
+from presentation import PresentationScheduler, RTP_CLOCK_RATE
+from rate_control import RateController
+from measurement_uploader import MeasurementUploader
+from local_transport import AVAILABLE as LOCAL_TRANSPORT_AVAILABLE, LocalTransportClient, get_host_id
 
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -38,6 +44,19 @@ TURN_SERVER_CREDENTIAL = os.getenv("TURN_SERVER_CREDENTIAL")
 
 FPS = 30
 
+# Offer to skip WebRTC when the unit runs on this host, set LOCAL_TRANSPORT=0 to always use WebRTC
+USE_LOCAL_TRANSPORT = LOCAL_TRANSPORT_AVAILABLE and os.getenv("LOCAL_TRANSPORT", "1") != "0"
+
+# Used until the processing unit advertises its own profile
+DEFAULT_CAPTURE_PROFILE = {
+    "width": 640,
+    "height": 480,
+    "fps": FPS,
+    "bitrate": vpx.DEFAULT_BITRATE,
+    "keyframe_interval": 0,
+    "codec": None,
+}
+
 test_id = None
 test_type = "gym"
 houseID = "house01"
@@ -47,11 +66,10 @@ id = "client_id"
 send_times = []
 arrival_times = []
 
-actual_frame = None
-
-arms_exercise_reps = 0
+# Streams point a and f marks to the Tests API while a test runs
+uploader = None
 
-frame_queue = Queue(maxsize=10)
+frame_buffer = None
 
 class WebsocketSignalingClient:
     def __init__(self, host, port, id):
@@ -66,6 +84,8 @@ class WebsocketSignalingClient:
         await self.websocket.send(json.dumps({
             "type": "connect",
             "client_id": self.id,
+            "host_id": get_host_id(),
+            "local_transport": USE_LOCAL_TRANSPORT,
         }))
 
     async def send(self, obj):
@@ -110,7 +130,7 @@ class WebsocketSignalingClient:
         await self.send(message)
         print("ICE candidate sent to signaling server")
 
-    async def handle_messages(self, pc: RTCPeerConnection):
+    async def handle_messages(self, pc: RTCPeerConnection, video_track=None, on_local_transport=None):
         errors = 0
         try:
             while True:
@@ -130,7 +150,13 @@ class WebsocketSignalingClient:
     
                     case "accepted_connection":
                         print(f"Connection accepted by server: {message.get('unit_id')}")
-                        await self.send_offer(pc)
+                        if video_track is not None:
+                            apply_capture_profile(pc, video_track, message.get("capture_profile"))
+                        if on_local_transport is not None and message.get("local_transport"):
+                            # The unit is on this host, frames go through shared memory instead
+                            await on_local_transport(message["local_transport"])
+                        else:
+                            await self.send_offer(pc)
     
                     case "answer":
                         print("Received answer")
@@ -183,53 +209,193 @@ class WebsocketSignalingClient:
             finally:
                 self.websocket = None
 
+def apply_capture_profile(pc: RTCPeerConnection, video_track, profile):
+    """Configure the track, codec and encoder for the profile a unit advertised.
+
+    Must run before the offer is created, since the codec preference is part
+    of the SDP. The bitrate is capped on this track's encoder once the sender
+    creates it, see BitrateCappedEncoder.
+    """
+    profile = {**DEFAULT_CAPTURE_PROFILE, **(profile or {})}
+    video_track.configure(profile)
+
+    codec = profile.get("codec")
+    if codec:
+        codecs = [
+            capability for capability in RTCRtpSender.getCapabilities("video").codecs
+            if capability.mimeType.lower() in (codec.lower(), "video/rtx")
+        ]
+        for transceiver in pc.getTransceivers():
+            if transceiver.sender.track is video_track and len(codecs) > 1:
+                transceiver.setCodecPreferences(codecs)
+
+    print(f"Capture profile: {profile['width']}x{profile['height']} at {profile['fps']} fps, {profile['bitrate'] // 1000} kbps")
+
+class BitrateCappedEncoder:
+    """Wraps the encoder of one sender so the bitrate never goes above the profile's.
+
+    aiortc clamps the bitrate to its codec module's MAX_BITRATE, which is
+    shared by every encoder in the process. The encoder starts at half the
+    cap and follows the receiver's estimate up from there, nothing above
+    the advertised bitrate is useful to the unit.
+    """
+
+    def __init__(self, encoder, max_bitrate: int):
+        self.encoder = encoder
+        self.max_bitrate = max_bitrate
+        self.target_bitrate = min(encoder.target_bitrate, max_bitrate // 2)
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+    @property
+    def target_bitrate(self) -> int:
+        return self.encoder.target_bitrate
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate: int):
+        self.encoder.target_bitrate = min(bitrate, self.max_bitrate)
+
 class VideoTrack(VideoStreamTrack):
     def __init__(self, path):
         super().__init__()
-        width = 1280
-        height = 720
-        cap = None
-        if sys.platform == "linux":
-            cap = cv2.VideoCapture(path, cv2.CAP_V4L2)
-        elif sys.platform == "win32":
-            cap = cv2.VideoCapture(path, cv2.CAP_DSHOW)
-        else:
-            cap = cv2.VideoCapture(path, cv2.CAP_ANY)
-        #self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
-        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
-        cap.set(cv2.CAP_PROP_FPS, FPS)
-        self.cap = cap
-        self.frame_count_division_factor = int(90000 / FPS)
+        self.path = path
+        self.capture = None
+        self.sender = None
+        self.profile = DEFAULT_CAPTURE_PROFILE
+        self.new_frame = asyncio.Event()
+        self.last_sequence = 0
+        self.start_time = None
+        self.last_timestamp = -1
         self.frame_count = -1
-        self.frames = []
-        self.last_frame_count = -1
+        self.frames = FrameHistory(capacity=2 * FPS)
+        self.scheduler = PresentationScheduler(self.frames, frame_buffer, FPS)
+        self.presentation_task = None
+        self.rate = RateController(FPS)
+        self.last_sent_time = None
+        self.sent = 0
+        self.last_stats_time = None
+        self.last_result_seq = -1
+        self.stale_results = 0
         #self.fps = 0
         #self.start_time = time.time()
 
-    async def recv(self):
+    def configure(self, profile: dict):
+        """Adopt a capture profile. Only takes effect before capture starts."""
+        if self.capture is not None:
+            return
+        self.profile = profile
+        self.scheduler.fps = profile["fps"]
+        self.rate = RateController(profile["fps"])
+
+    def start_capture(self):
+        loop = asyncio.get_running_loop()
+        output_size = (self.profile["width"], self.profile["height"])
+        width, height = select_capture_size(*output_size)
+        self.capture = CaptureThread(self.path, width, height, self.profile["fps"], output_size)
+        self.capture.on_frame = lambda: loop.call_soon_threadsafe(self.new_frame.set)
+        self.capture.start()
+        self.presentation_task = loop.create_task(self.scheduler.run())
+
+    async def capture_frame(self, consume):
+        """Wait for the next frame to send and pass it to consume(rgb_frame, timestamp).
+
+        consume runs while the capture buffer is held, so it must copy what it
+        keeps. Returns what consume returned, or None once the capture failed.
+        """
         global send_times
-        self.frame_count += 1
-        ret, frame = self.cap.read()
-
-        if not ret:
-            print("Failed to read frame from camera")
-            return None
+        if self.capture is None:
+            self.start_capture()
+
+        while True:
+            captured = self.capture.acquire(self.last_sequence)
+            if captured is not None:
+                # Below the camera rate, skip frames before they cost an encode
+                if self.last_sent_time is None or captured[3] - self.last_sent_time >= 0.9 / self.rate.fps:
+                    break
+                self.last_sequence = captured[0]
+                self.capture.release()
+                continue
+            if self.capture.failed:
+                return None
+            self.new_frame.clear()
+            await self.new_frame.wait()
+
+        sequence, frame, rgb_frame, capture_time = captured
+        if self.start_time is None:
+            self.start_time = capture_time
+
+        # Stamp frames with their real capture time on the 90 kHz RTP clock
+        timestamp = max(int((capture_time - self.start_time) * RTP_CLOCK_RATE), self.last_timestamp + 1)
+        try:
+            self.last_sequence = sequence
+            self.last_timestamp = timestamp
+            self.last_sent_time = capture_time
+            self.sent += 1
+            self.frame_count += 1
+            keyframe_interval = self.profile["keyframe_interval"]
+            if self.sender is not None:
+                self.cap_bitrate()
+            if self.sender is not None and keyframe_interval and self.frame_count % keyframe_interval == 0:
+                # Periodic keyframes let the unit recover from loss without waiting for a PLI.
+                # aiortc only forces one when a PLI or FIR arrives, through this private method
+                self.sender._send_keyframe()
+            self.frames.put(self.frame_count, frame, timestamp, capture_time)
+            consumed = consume(rgb_frame, timestamp)
+        finally:
+            self.capture.release()
 
-        frame = cv2.flip(frame, 1)
-        self.frames.append(tuple((frame, self.frame_count)))
-        frame = cv2.resize(frame, (640, 480))
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        video_frame = VideoFrame.from_ndarray(frame, format="rgb24")
-        video_frame.pts = self.frame_count
-        video_frame.time_base = fractions.Fraction(1, FPS)
         #send_times.append((self.frame_count, time.time()))
+        if uploader is not None:
+            # The unit reports the same pts, the analysis joins the points on it
+            uploader.add("point_a", timestamp, time.time() + get_time_offset())
         logging.debug(f"Sent frame {self.frame_count}")
+        return consumed
+
+    def cap_bitrate(self):
+        # The sender creates its encoder on the first frame and keeps it private
+        encoder = getattr(self.sender, "_RTCRtpSender__encoder", None)
+        if encoder is not None and not isinstance(encoder, BitrateCappedEncoder):
+            self.sender._RTCRtpSender__encoder = BitrateCappedEncoder(encoder, int(self.profile["bitrate"]))
+
+    async def recv(self):
+        video_frame = await self.capture_frame(lambda rgb_frame, _: VideoFrame.from_ndarray(rgb_frame, format="rgb24"))
+        if video_frame is None:
+            return None
+        video_frame.pts = self.last_timestamp
+        video_frame.time_base = fractions.Fraction(1, RTP_CLOCK_RATE)
         return video_frame
+
+    async def send_local(self, transport: LocalTransportClient):
+        """Feed frames to a unit on this host, copied straight into the shared ring with no encode."""
+        while await self.capture_frame(transport.send_frame) is not None:
+            pass
+
+    def stop(self):
+        super().stop()
+        if self.capture is not None:
+            self.capture.stop()
+        self.scheduler.stop()
+        print(f"Frames matched: {self.frames.matched}, evicted: {self.frames.evicted}, stale results: {self.stale_results}")
+
+    def on_stats(self, stats: dict):
+        """Adapt the send rate and resolution to a load report from the unit."""
+        now = time.monotonic()
+        if self.last_stats_time is None:
+            self.last_stats_time = now
+            self.sent = 0
+            return
+        sent_fps = self.sent / (now - self.last_stats_time)
+        self.last_stats_time = now
+        self.sent = 0
+
+        if self.rate.on_stats(stats, sent_fps) and self.capture is not None:
+            self.capture.set_output_size(self.rate.output_size(self.profile["width"], self.profile["height"]))
+            print(f"Sending at {self.rate.fps} fps, {self.rate.scale:.0%} resolution ({stats})")
     
     async def process_frame(self, message):
-        #arrival_time = time.time()
-        global arms_exercise_reps, arrival_times, actual_frame
+        arrival_time = time.time()
+        global arrival_times
         #self.fps+=1
         #if (time.time() - self.start_time > 1):
             #print(self.fps, "fps")
@@ -237,43 +403,35 @@ class VideoTrack(VideoStreamTrack):
             #self.start_time = time.time()
 
         data = json.loads(message)
-        frame_count = data.get("frame_count", -2) + 1
-        frame_count //= self.frame_count_division_factor
-        #arrival_times.append((frame_count, arrival_time))
-        if frame_count == -1 and frame_count > self.last_frame_count:
-            return
-        while self.frames:
-            frame, pts = self.frames.pop(0)
-            if pts == frame_count:
-                logging.debug(f"Received frame {frame_count}")
-                landmarks = data.get("landmarks", None)
-                if landmarks:
-                    styled_connections = data.get("style", None)
-                    #styled_connections = leg_exercise(landmarks, right_leg=True)
-                    #styled_connections = walk_exercise(landmarks)
-                    if styled_connections:
-                        utils.draw_from_json(
-                            image=frame,
-                            landmark_json=landmarks,
-                            connections_style=styled_connections,
-                        )
-                    else:
-                        utils.draw_from_json(
-                            image=frame,
-                            landmark_json=landmarks,
-                        )
-
-                    new_rep = data.get("new_rep", False)
-                    if new_rep:
-                        arms_exercise_reps += 1
-
-                actual_frame = frame
-                self.last_frame_count = frame_count
-                cv2.putText(actual_frame, f"Repetitions: {arms_exercise_reps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
-                frame_queue.put(actual_frame)
-                break
+        #arrival_times.append((data.get("frame_count"), arrival_time))
+        if uploader is not None and "frame_count" in data:
+            uploader.add("point_f", data["frame_count"], arrival_time + get_time_offset())
+        logging.debug(f"Received frame {data.get('frame_count')}")
+        if "stats" in data:
+            self.on_stats(data["stats"])
+
+        # Results arrive unordered, anything older than the newest one is useless
+        seq = data.get("seq", None)
+        if seq is not None:
+            if seq <= self.last_result_seq:
+                self.stale_results += 1
+                return
+            self.last_result_seq = seq
+
+        self.scheduler.on_result(data)
+
+    def process_control(self, message):
+        # Counts come from the unit, so nothing here depends on every result arriving
+        data = json.loads(message)
+        match data.get("event", None):
+            case "rep" | "snapshot":
+                self.scheduler.reps = data.get("reps", self.scheduler.reps)
+            case "session_end":
+                print(f"Session summary: {data}")
+                self.scheduler.reps = 0
     
 async def run(ip_address, port):
+    global uploader
 
     loop = asyncio.get_event_loop()
 
@@ -293,25 +451,59 @@ async def run(ip_address, port):
 
     pc = RTCPeerConnection(pc_config)
     video_track = VideoTrack(0)
-    pc.addTrack(video_track)
+    video_track.sender = pc.addTrack(video_track)
     print("Added video track")
 
+    local_transport = None
+    local_tasks = []
+
     def create_test(data_channel):
-        global test_id, houseID, division, test_type, time_offset
+        global test_id, houseID, division, test_type, uploader
         test_id = TestsAPI.create_test(
             test_type=test_type,
             house_id=houseID,
             division=division
         )
 
+        if test_id is not None:
+            time_offset = get_time_offset()
+            TestsAPI.update_test(
+                test_id=test_id,
+                start_time=time.time() + time_offset,
+                notes=json.dumps({"offset": time_offset, "fps": video_track.profile["fps"]})
+            )
+            uploader = MeasurementUploader(test_id)
+
         data_channel.send(json.dumps({
             "test_id": test_id
         }))
 
+    async def start_local_transport(description):
+        nonlocal local_transport
+        transport = LocalTransportClient(description["socket"], video_track.profile["width"], video_track.profile["height"])
+        try:
+            await transport.connect()
+        except OSError as e:
+            print(f"Local transport unavailable, falling back to WebRTC: {e}")
+            await transport.close()
+            await signaling.send_offer(pc)
+            return
+
+        print("Local transport connected")
+        local_transport = transport
+        create_test(transport.data_channel)
+        local_tasks.append(loop.create_task(transport.receive(
+            lambda message: loop.create_task(video_track.process_frame(message)),
+            video_track.process_control,
+        )))
+        local_tasks.append(loop.create_task(video_track.send_local(transport)))
+
     try:
         await signaling.connect()
 
+        # Control messages and rep events must arrive, per-frame results only matter while fresh
         data_channel = pc.createDataChannel("data")
+        results_channel = pc.createDataChannel("results", ordered=False, maxRetransmits=0)
 
         @data_channel.on("open")
         def on_open():
@@ -320,6 +512,10 @@ async def run(ip_address, port):
 
         @data_channel.on("message")
         def on_message(message):
+            video_track.process_control(message)
+
+        @results_channel.on("message")
+        def on_result(message):
             loop.create_task(video_track.process_frame(message))
 
         @pc.on("connectionstatechange")
@@ -339,7 +535,7 @@ async def run(ip_address, port):
         async def on_iceconnectionstatechange():
             print("ICE connection state is", pc.iceConnectionState)
 
-        await signaling.handle_messages(pc)
+        await signaling.handle_messages(pc, video_track, start_local_transport if USE_LOCAL_TRANSPORT else None)
     
     except Exception as e:
         print(e)
@@ -348,6 +544,18 @@ async def run(ip_address, port):
         await signaling.close()
         #await pc.close()
 
+        if local_transport is not None:
+            for task in local_tasks:
+                task.cancel()
+            video_track.stop()
+            await local_transport.close()
+
+        if uploader is not None:
+            # Stop collecting before flushing what is left
+            running_uploader, uploader = uploader, None
+            running_uploader.close()
+            print(f"Test ID: {test_id}")
+
 if __name__ == "__main__":
 
     time_offset = 0
@@ -374,7 +582,8 @@ if __name__ == "__main__":
             sys.exit(1)"""
 
     try:
-        display_process = Process(target=start_display, args=(frame_queue,))
+        frame_buffer = SharedFrameBuffer(1280, 720)
+        display_process = Process(target=start_display, args=(frame_buffer,))
         display_process.start()
         
         loop = asyncio.new_event_loop()
@@ -392,36 +601,7 @@ if __name__ == "__main__":
         loop.close()
         display_process.terminate()
         display_process.join()
+        frame_buffer.close()
+        frame_buffer.unlink()
         
         exit(0)
-        print("Adding measurements to the test. Please wait...")
-
-        TestsAPI.update_test(
-            test_id=test_id,
-            start_time=time.time() + time_offset,
-            notes="{\"offset\": " + str(time_offset) + ", \"fps\": " + str(FPS) + "}"
-        )
-
-        for arrival_time in arrival_times:
-            TestsAPI.add_measurement_bulk(
-                results_list= [
-                    {
-                        "point": "{\"point_f\": " + str(arrival_time[0]) + "}",
-                        "timestamp": arrival_time[1] + time_offset
-                    },
-                ],
-                test_id=test_id,
-            )
-            TestsAPI.add_measurement_bulk(
-                results_list= [
-                    {
-                        "point": "{\"point_a\": " + str(arrival_time[0]) + "}",
-                        "timestamp": send_times[arrival_time[0]][1] + time_offset
-                    },
-                ],
-                test_id=test_id,
-            )
-
-        print("Test completed and measurements added.")
-        print(f"Test ID: {test_id}")
-        exit(0)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional, Set
+
+# Share of the cores kept for the event loops, aiortc codecs and signaling of all units
+NETWORK_SHARE = float(os.getenv("NETWORK_CORE_SHARE", 0.25))
+
+# Below this many cores partitioning costs more than the interference it avoids
+MIN_PARTITION_CORES = 4
+
+def is_supported() -> bool:
+    return hasattr(os, "sched_setaffinity") and os.path.isdir("/proc/self/task")
+
+def allocation_path(server_id: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f"core_allocation-{server_id}.json")
+
+def _set_affinity(tid: int, cores) -> bool:
+    try:
+        os.sched_setaffinity(tid, cores)
+        return True
+    except (ProcessLookupError, PermissionError, OSError):
+        # The thread or process is already gone
+        return False
+
+class CoreAllocator:
+    """Partitions the cores of a node between the processing units of a MultiServer.
+
+    A NETWORK_SHARE of the cores is set aside for everything but inference,
+    shared by all units: their event loops, the aiortc encoders and decoders
+    and the signaling. The rest is split into equal inference sets, one per
+    unit, so a unit's MediaPipe threads never compete with another unit's.
+    With more units than inference cores the sets are single cores shared
+    round robin.
+
+    Every time a unit comes or goes the split is recomputed and written to
+    allocation_path, where the units pick up their new inference set with
+    UnitAffinity. New units are moved to the network cores straight away.
+    """
+
+    def __init__(self, server_id: str, cores: Optional[List[int]] = None):
+        self.path = allocation_path(server_id)
+        self.cores = sorted(cores if cores is not None else os.sched_getaffinity(0))
+        self.units: Dict[str, int] = {}
+        self.enabled = is_supported() and len(self.cores) >= MIN_PARTITION_CORES
+        if not self.enabled:
+            print(f"Core partitioning disabled with {len(self.cores)} cores")
+
+    def partition(self) -> dict:
+        """Split the cores between the units, in the order they were added."""
+        network_count = min(len(self.cores) - 1, max(1, round(len(self.cores) * NETWORK_SHARE)))
+        network, pool = self.cores[:network_count], self.cores[network_count:]
+
+        units = {}
+        unit_ids = list(self.units)
+        if unit_ids and len(unit_ids) <= len(pool):
+            share, extra = divmod(len(pool), len(unit_ids))
+            start = 0
+            for index, unit_id in enumerate(unit_ids):
+                # Contiguous ranges keep a unit on neighbouring cores, usually distinct physical ones
+                size = share + (index < extra)
+                units[unit_id] = pool[start:start + size]
+                start += size
+        else:
+            for index, unit_id in enumerate(unit_ids):
+                units[unit_id] = [pool[index % len(pool)]]
+        return {"network": network, "units": units}
+
+    def rebalance(self):
+        if not self.enabled:
+            return
+        allocation = self.partition()
+        path = f"{self.path}.tmp"
+        with open(path, "w") as f:
+            json.dump(allocation, f)
+        os.replace(path, self.path)
+        print(f"Cores: network {allocation['network']}, " + ", ".join(f"{unit_id} {cores}" for unit_id, cores in allocation["units"].items()))
+
+    def add(self, unit_id: str, pid: int):
+        """Account for a new unit and move it to the network cores until it builds its detector."""
+        self.units[unit_id] = pid
+        self.rebalance()
+        if self.enabled:
+            # Threads the unit starts from now on inherit this
+            _set_affinity(pid, self.partition()["network"])
+
+    def remove(self, unit_id: str):
+        if self.units.pop(unit_id, None) is not None:
+            self.rebalance()
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class UnitAffinity:
+    """Keeps the threads of a processing unit on the cores its MultiServer gave it.
+
+    The detector is built with inference_cores, so the MediaPipe threads
+    start there and every other thread stays on the network cores. When the
+    allocation changes the threads are moved over: those still on the old
+    inference set are the inference threads, whoever started them.
+    """
+
+    def __init__(self, unit_id: str):
+        self.unit_id = unit_id
+        # Unit ids are SERVER_ID-n and the server id may itself contain dashes
+        self.path = allocation_path(unit_id.rsplit("-", 1)[0])
+        self.enabled = is_supported()
+        self.mtime = None
+        self.network: Optional[Set[int]] = None
+        self.inference: Optional[Set[int]] = None
+        self.refresh()
+
+    @property
+    def inference_cores(self) -> Optional[Set[int]]:
+        return self.inference
+
+    def refresh(self) -> bool:
+        """Apply the allocation again if the MultiServer changed it, returns True if it did."""
+        if not self.enabled:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+
+        try:
+            with open(self.path, "r") as f:
+                allocation = json.load(f)
+        except (OSError, ValueError):
+            return False
+        cores = allocation["units"].get(self.unit_id)
+        if cores is None:
+            return False
+
+        previous = self.inference
+        self.network = set(allocation["network"])
+        self.inference = set(cores)
+        self.apply(previous)
+        return True
+
+    def apply(self, previous_inference: Optional[Set[int]] = None):
+        for tid in os.listdir("/proc/self/task"):
+            tid = int(tid)
+            try:
+                current = os.sched_getaffinity(tid)
+            except OSError:
+                continue
+            inference = previous_inference is not None and current == previous_inference and tid != os.getpid()
+            _set_affinity(tid, self.inference if inference else self.network)
+
+    async def watch(self, interval: float = 1.0):
+        """Follow allocation changes while the unit runs."""
+        while True:
+            await asyncio.sleep(interval)
+            if self.refresh():
+                print(f"Unit {self.unit_id} moved to inference cores {sorted(self.inference)}")
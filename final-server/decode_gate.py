@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import time
+from typing import Callable, Optional
+
+import aiortc.rtcrtpreceiver as rtcrtpreceiver
+from aiortc.codecs import get_decoder
+
+# What skipping an encoded frame does to the frames after it
+KEYFRAME = "keyframe"
+REFERENCE = "reference"
+NON_REFERENCE = "non_reference"
+
+# Gate policies. SAFE only skips frames no other frame depends on. KEYFRAME
+# also skips reference frames and asks the sender for a keyframe once the
+# detector needs a picture again.
+OFF = "off"
+SAFE = "safe"
+KEYFRAME_ON_DEMAND = "keyframe"
+
+def classify_vp8(data: bytes) -> str:
+    # Bit 0 of the frame tag is 0 on keyframes. Whether an inter frame
+    # refreshes a reference buffer is only in its bool-coded header, so they
+    # all count as references.
+    if data and not data[0] & 0x01:
+        return KEYFRAME
+    return REFERENCE
+
+def classify_h264(data: bytes) -> str:
+    """Classify an Annex B access unit by its slice NAL units."""
+    slices = 0
+    referenced = False
+    index = data.find(b"\x00\x00\x01")
+    while index != -1 and index + 3 < len(data):
+        header = data[index + 3]
+        nal_type = header & 0x1F
+        if nal_type == 5:
+            return KEYFRAME
+        if nal_type == 1:
+            slices += 1
+            # nal_ref_idc 0 means no other picture predicts from this one
+            referenced |= bool(header & 0x60)
+        index = data.find(b"\x00\x00\x01", index + 3)
+    return NON_REFERENCE if slices and not referenced else REFERENCE
+
+CLASSIFIERS = {
+    "vp8": classify_vp8,
+    "h264": classify_h264,
+}
+
+class DecodeGate:
+    """Skips decoding frames the detector would never see.
+
+    Frames are decoded on aiortc's decoder thread, and while the detector is
+    busy a newer frame replaces each one before it can be processed. The gate
+    looks at each encoded frame first: if another frame will arrive before
+    the detector wants one, decoding this one only matters to the frames
+    that predict from it.
+
+    Args:
+        detector_free_in: Returns in how many seconds the detector can take a
+            new frame, 0 if it can right now.
+        policy: SAFE or KEYFRAME_ON_DEMAND.
+        frame_interval: Expected time between frames in seconds.
+        pli_interval: Least time between two keyframe requests, a keyframe
+            costs several times the bits of an inter frame.
+    """
+
+    def __init__(self, detector_free_in: Callable[[], float], policy: str = SAFE,
+                 frame_interval: float = 1 / 30, pli_interval: float = 0.5):
+        self.detector_free_in = detector_free_in
+        self.policy = policy
+        self.frame_interval = frame_interval
+        self.pli_interval = pli_interval
+        self.on_skip: Optional[Callable[[], None]] = None
+
+        self.receiver = None
+        self.loop = None
+        # Set once a reference frame was skipped, nothing decodes until the next keyframe
+        self.stale = False
+        self.last_pli = 0.0
+
+        self.stats_lock = threading.Lock()
+        self.decoded = 0
+        self.skipped = 0
+        self.keyframes_requested = 0
+
+    def attach(self, receiver, loop: asyncio.AbstractEventLoop):
+        """Keyframe requests go to the sender of this receiver."""
+        self.receiver = receiver
+        self.loop = loop
+
+    def should_decode(self, kind: str) -> bool:
+        if kind == KEYFRAME:
+            self.stale = False
+            return self._count(True)
+
+        needed_soon = self.detector_free_in() <= self.frame_interval
+        if self.stale:
+            if needed_soon:
+                self.request_keyframe()
+            return self._count(False)
+
+        if needed_soon:
+            return self._count(True)
+        if kind == NON_REFERENCE:
+            return self._count(False)
+        if self.policy == KEYFRAME_ON_DEMAND:
+            self.stale = True
+            return self._count(False)
+        return self._count(True)
+
+    def _count(self, decode: bool) -> bool:
+        with self.stats_lock:
+            if decode:
+                self.decoded += 1
+            else:
+                self.skipped += 1
+        if not decode and self.on_skip is not None:
+            self.on_skip()
+        return decode
+
+    def request_keyframe(self):
+        """Send a PLI to the sender, at most once per pli_interval."""
+        now = time.monotonic()
+        if self.receiver is None or now - self.last_pli < self.pli_interval:
+            return
+        sources = self.receiver.getSynchronizationSources()
+        if not sources:
+            return
+        self.last_pli = now
+        with self.stats_lock:
+            self.keyframes_requested += 1
+        # Called from the decoder thread, RTCP goes out on the event loop
+        asyncio.run_coroutine_threadsafe(self.receiver._send_rtcp_pli(sources[0].source), self.loop)
+
+    def summary(self) -> dict:
+        with self.stats_lock:
+            return {
+                "decoded": self.decoded,
+                "skipped": self.skipped,
+                "keyframes_requested": self.keyframes_requested,
+            }
+
+class GatedDecoder:
+    """Wraps an aiortc decoder, asking the gate before decoding each frame."""
+
+    def __init__(self, decoder, classify: Callable[[bytes], str], gate: DecodeGate):
+        self.decoder = decoder
+        self.classify = classify
+        self.gate = gate
+
+    def decode(self, encoded_frame) -> list:
+        if not self.gate.should_decode(self.classify(encoded_frame.data)):
+            return []
+        return self.decoder.decode(encoded_frame)
+
+def install(gate: DecodeGate):
+    """Put the gate in front of every decoder aiortc creates from now on.
+
+    aiortc has no hook for this, its decoder thread looks get_decoder up in
+    its module when the first frame of a codec arrives.
+    """
+    def gated_get_decoder(codec):
+        decoder = get_decoder(codec)
+        classify = CLASSIFIERS.get(codec.name.lower())
+        if classify is None:
+            return decoder
+        return GatedDecoder(decoder, classify, gate)
+
+    rtcrtpreceiver.get_decoder = gated_get_decoder
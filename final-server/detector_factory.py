@@ -0,0 +1,334 @@
+import dataclasses
+import json
+import os
+import platform
+import statistics
+import time
+from dataclasses import dataclass
+from multiprocessing import get_context
+from typing import List, Optional, Set
+
+import cv2
+import mediapipe as mp
+import numpy as np
+from mediapipe.tasks.python import vision
+
+# Best first, a heavier model is only chosen when it keeps up with the frame rate
+MODEL_TIERS = {
+    "heavy": "../models/pose_landmarker_heavy.task",
+    "full": "../models/pose_landmarker_full.task",
+    "lite": "../models/pose_landmarker_lite.task",
+}
+
+DELEGATES = {
+    "cpu": mp.tasks.BaseOptions.Delegate.CPU,
+    "gpu": mp.tasks.BaseOptions.Delegate.GPU,
+}
+
+CACHE_PATH = os.getenv("DETECTOR_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "pose_detector.json"))
+
+# Processing units expected to share the machine, each gets an equal share of the cores
+UNITS_PER_NODE = int(os.getenv("UNITS_PER_NODE", 1))
+TARGET_FPS = int(os.getenv("CAPTURE_FPS", 30))
+
+# A frame with a person in it, without one only the pose detection model is timed
+CALIBRATION_IMAGE = os.getenv("CALIBRATION_IMAGE", "../models/calibration.jpg")
+CALIBRATION_FRAMES = 15
+CALIBRATION_TIMEOUT = 120
+
+# Share of the frame interval inference may take, the rest is left to decode and the exercises
+FRAME_BUDGET = 0.8
+
+# Heaviest tier chosen when calibration never got to the landmark model, the one that differs between tiers
+UNVERIFIED_TIERS = ("full", "lite")
+
+@dataclass
+class DetectorChoice:
+    """The detector configuration picked for this machine."""
+
+    delegate: str
+    tier: str
+    threads: int
+    latency_ms: float
+
+    @property
+    def model_path(self) -> str:
+        return MODEL_TIERS[self.tier]
+
+def machine_key(units: int, fps: int) -> str:
+    """Identify the hardware and the load a cached choice was calibrated for."""
+    return "|".join([
+        platform.node(),
+        platform.machine(),
+        platform.processor(),
+        str(os.cpu_count()),
+        mp.__version__,
+        f"units={units}",
+        f"fps={fps}",
+    ])
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def thread_candidates(budget: int) -> List[int]:
+    """1, 2, 4, ... up to and including the per-unit core budget."""
+    candidates = []
+    threads = 1
+    while threads < budget:
+        candidates.append(threads)
+        threads *= 2
+    candidates.append(budget)
+    return candidates
+
+def calibration_image() -> np.ndarray:
+    image = cv2.imread(CALIBRATION_IMAGE) if os.path.exists(CALIBRATION_IMAGE) else None
+    if image is None:
+        # Still times decode and the detection model, calibrate then caps the tier
+        print(f"Calibration image {CALIBRATION_IMAGE} not found, timing an empty frame")
+        image = np.full((480, 640, 3), 127, dtype=np.uint8)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def _pin_current_thread(threads: int, cores: Optional[Set[int]] = None):
+    """Restrict the calling thread to threads cores, the threads MediaPipe starts from it inherit the mask.
+
+    The Python Tasks API has no XNNPACK thread count option, limiting the
+    cores its thread pool can run on is the knob that is left. cores, when
+    given, is the exact set to use.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return None
+    previous = os.sched_getaffinity(0)
+    if cores:
+        os.sched_setaffinity(0, cores)
+        return previous
+    cores = sorted(previous)
+    if threads < len(cores):
+        # Spread the units over the cores instead of stacking them all on the first ones
+        start = os.getpid() % len(cores)
+        os.sched_setaffinity(0, {cores[(start + index) % len(cores)] for index in range(threads)})
+    return previous
+
+def _restore_current_thread(previous):
+    if previous is not None:
+        os.sched_setaffinity(0, previous)
+
+def _time_detector(delegate: str, tier: str, threads: int, image: np.ndarray, frames: int) -> Optional[tuple]:
+    """(median milliseconds per detection, whether a pose was found), None if the configuration does not work here."""
+    previous = _pin_current_thread(threads)
+    try:
+        detector = vision.PoseLandmarker.create_from_options(vision.PoseLandmarkerOptions(
+            base_options=mp.tasks.BaseOptions(model_asset_path=MODEL_TIERS[tier], delegate=DELEGATES[delegate]),
+            running_mode=vision.RunningMode.VIDEO,
+            num_poses=1,
+        ))
+    except Exception as e:
+        print(f"Detector {delegate}/{tier} unavailable: {e}")
+        return None
+    finally:
+        _restore_current_thread(previous)
+
+    try:
+        mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=image)
+        times = []
+        detected = False
+        # The first frames include graph warm-up, GPU shader compilation in particular
+        for index in range(frames + 3):
+            start = time.perf_counter()
+            result = detector.detect_for_video(mp_image, index * 33)
+            if index >= 3:
+                times.append((time.perf_counter() - start) * 1000)
+            detected |= len(result.pose_landmarks) > 0
+        return statistics.median(times), detected
+    except Exception as e:
+        print(f"Detector {delegate}/{tier} failed: {e}")
+        return None
+    finally:
+        detector.close()
+
+def _calibration_worker(conn, delegate: str, candidates: list, frames: int):
+    image = calibration_image()
+    results = []
+    for tier, threads in candidates:
+        results.append((tier, threads, _time_detector(delegate, tier, threads, image, frames)))
+        # Report as we go, so a crash keeps what was measured before it
+        conn.send(results)
+    conn.close()
+
+def _calibrate_delegate(delegate: str, candidates: list, frames: int, timeout: float) -> list:
+    """Time every (tier, threads) candidate of a delegate in a child process.
+
+    A broken GPU driver can take the whole process down instead of raising,
+    the child keeps that from reaching the unit.
+    """
+    context = get_context("spawn")
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(target=_calibration_worker, args=(child_conn, delegate, candidates, frames), daemon=True)
+    process.start()
+    child_conn.close()
+
+    results = []
+    deadline = time.monotonic() + timeout
+    try:
+        while parent_conn.poll(max(0.0, deadline - time.monotonic())):
+            results = parent_conn.recv()
+    except EOFError:
+        pass
+    process.join(max(0.0, deadline - time.monotonic()))
+    if process.is_alive():
+        print(f"Calibration of the {delegate} delegate timed out")
+        process.terminate()
+    process.join()
+    if process.exitcode not in (0, None) and len(results) < len(candidates):
+        print(f"Calibration of the {delegate} delegate crashed with exit code {process.exitcode}")
+    return results
+
+def calibrate(units: int = UNITS_PER_NODE, fps: int = TARGET_FPS, frames: int = CALIBRATION_FRAMES) -> tuple:
+    """Probe the delegates, benchmark the model tiers and pick the best one that keeps up.
+
+    Every unit gets an equal share of the cores. The chosen tier is the
+    heaviest one whose median latency fits FRAME_BUDGET of the frame
+    interval, and the thread count the smallest that gets within 10% of
+    the latency with the whole share, cores beyond that are wasted on a
+    shared machine.
+
+    Without a pose in the calibration image the landmark model never ran
+    and every tier times about the same, so the choice is capped at
+    UNVERIFIED_TIERS.
+
+    Returns:
+        (choice, whether the landmark model was timed)
+    """
+    budget = max(1, len(available_cores()) // max(1, units))
+    deadline_ms = 1000 * FRAME_BUDGET / fps
+    tiers = [tier for tier, path in MODEL_TIERS.items() if os.path.exists(path)]
+    if not tiers:
+        raise FileNotFoundError(f"No pose landmarker model found in {list(MODEL_TIERS.values())}")
+
+    measured = {}
+    verified = False
+    for delegate in DELEGATES:
+        threads = thread_candidates(budget) if delegate == "cpu" else [1]
+        candidates = [(tier, count) for tier in tiers for count in threads]
+        for tier, count, timing in _calibrate_delegate(delegate, candidates, frames, CALIBRATION_TIMEOUT):
+            if timing is not None:
+                latency, detected = timing
+                measured[(delegate, tier, count)] = latency
+                verified |= detected
+                print(f"Calibration {delegate}/{tier} with {count} threads: {latency:.1f} ms")
+    if not measured:
+        raise RuntimeError("No detector configuration works on this machine")
+    if not verified:
+        print(f"No pose found in the calibration image, the choice is capped at {UNVERIFIED_TIERS[0]}")
+        capped = [tier for tier in tiers if tier in UNVERIFIED_TIERS]
+        if capped:
+            tiers = capped
+
+    def best(tier):
+        # Fastest delegate for a tier at its full share, then the fewest threads close to it
+        options = {key: latency for key, latency in measured.items() if key[1] == tier}
+        if not options:
+            return None
+        fastest = min(options, key=options.get)
+        delegate = fastest[0]
+        close = [key for key, latency in options.items() if key[0] == delegate and latency <= options[fastest] * 1.1]
+        delegate, tier, threads = min(close, key=lambda key: key[2])
+        return DetectorChoice(delegate, tier, threads, round(options[(delegate, tier, threads)], 2))
+
+    choices = [choice for choice in (best(tier) for tier in tiers) if choice is not None]
+    fitting = [choice for choice in choices if choice.latency_ms <= deadline_ms]
+    # Tiers are ordered best first, with none fitting the fastest one will have to do
+    return (fitting[0] if fitting else min(choices, key=lambda choice: choice.latency_ms)), verified
+
+def _load_cache() -> dict:
+    try:
+        with open(CACHE_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def choose_detector(units: int = UNITS_PER_NODE, fps: int = TARGET_FPS, recalibrate: bool = False) -> DetectorChoice:
+    """Return the detector choice for this machine, calibrating only the first time.
+
+    DETECTOR_DELEGATE, DETECTOR_TIER and DETECTOR_THREADS skip calibration
+    and force a configuration.
+    """
+    if os.getenv("DETECTOR_DELEGATE") or os.getenv("DETECTOR_TIER"):
+        return DetectorChoice(
+            os.getenv("DETECTOR_DELEGATE", "cpu"),
+            os.getenv("DETECTOR_TIER", "full"),
+            int(os.getenv("DETECTOR_THREADS", max(1, len(available_cores()) // max(1, units)))),
+            0.0,
+        )
+
+    key = machine_key(units, fps)
+    if not recalibrate and key in (cached := _load_cache()):
+        return DetectorChoice(**cached[key])
+
+    os.makedirs(os.path.dirname(CACHE_PATH) or ".", exist_ok=True)
+    lock = open(f"{CACHE_PATH}.lock", "w")
+    try:
+        if os.name == "posix":
+            # Units started together wait for the first one to calibrate instead of all benchmarking at once
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = _load_cache()
+        if not recalibrate and key in cache:
+            return DetectorChoice(**cache[key])
+
+        print(f"Calibrating the pose detector for {units} units at {fps} fps...")
+        choice, verified = calibrate(units, fps)
+        print(f"Detector chosen: {choice}")
+        if not verified:
+            # A guess from timings that left the landmark model out, calibrate again next time
+            return choice
+        cache[key] = dataclasses.asdict(choice)
+        path = f"{CACHE_PATH}.tmp"
+        with open(path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(path, CACHE_PATH)
+        return choice
+    finally:
+        lock.close()
+
+def create_detector(options: vision.PoseLandmarkerOptions, choice: Optional[DetectorChoice] = None,
+                    cores: Optional[Set[int]] = None) -> vision.PoseLandmarker:
+    """Build a PoseLandmarker from options with the delegate, model and thread count chosen for this machine.
+
+    Everything in options but the base options is kept. Falls back to the
+    CPU delegate if the chosen one fails to initialize. cores are the
+    inference cores the MultiServer gave the unit, if any, and replace the
+    calibrated thread count.
+    """
+    if choice is None:
+        choice = choose_detector()
+
+    attempts = [choice]
+    if choice.delegate != "cpu":
+        attempts.append(dataclasses.replace(choice, delegate="cpu", threads=max(1, len(available_cores()) // max(1, UNITS_PER_NODE))))
+
+    for attempt in attempts:
+        base_options = mp.tasks.BaseOptions(model_asset_path=attempt.model_path, delegate=DELEGATES[attempt.delegate])
+        previous = _pin_current_thread(attempt.threads, cores) if attempt.delegate == "cpu" else None
+        try:
+            detector = vision.PoseLandmarker.create_from_options(dataclasses.replace(options, base_options=base_options))
+            threads = len(cores) if cores and attempt.delegate == "cpu" else attempt.threads
+            print(f"Pose detector: {attempt.delegate}/{attempt.tier} with {threads} threads")
+            return detector
+        except Exception as e:
+            print(f"Error creating the {attempt.delegate} pose detector: {e}")
+        finally:
+            _restore_current_thread(previous)
+    raise RuntimeError("Could not create a pose detector")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Calibrate the pose detector for this machine")
+    parser.add_argument("--units", type=int, default=UNITS_PER_NODE, help="Processing units sharing the machine")
+    parser.add_argument("--fps", type=int, default=TARGET_FPS, help="Frame rate every unit has to keep up with")
+    parser.add_argument("--recalibrate", action="store_true", help="Ignore the cached choice")
+    args = parser.parse_args()
+
+    print(choose_detector(args.units, args.fps, args.recalibrate))
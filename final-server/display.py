@@ -1,14 +1,122 @@
 import cv2
-from multiprocessing import Queue
+import numpy as np
+from multiprocessing import Condition, RawArray
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional, Tuple
 
-def start_display(frame_queue: Queue):
+_SEQUENCE = 0
+_LATEST = 1
+_READING = 2
+_SHAPES = 3
+
+class SharedFrameBuffer:
+    """Triple buffer of BGR frames shared between the client and the display.
+
+    Frames live in a single shared memory block, so handing one to the display
+    process needs no pickling and no pipe. The writer always fills a slot that
+    is neither the newest one nor the one being shown, then publishes it by
+    bumping the sequence counter. The display blocks on a condition until the
+    sequence moves instead of polling.
+
+    width and height are the largest frame the buffer holds. Smaller frames
+    are stored as they are and shown at their own size, so a client sending
+    at the inference size never pays for an upscale.
+    """
+
+    def __init__(self, width: int, height: int, slots: int = 3):
+        if slots < 3:
+            raise ValueError("The display buffer needs at least three slots.")
+        self.shape = (height, width, 3)
+        self.slots = slots
+        self.shm = SharedMemory(create=True, size=slots * height * width * 3)
+        self.condition = Condition()
+        # sequence, latest, reading, then the (height, width) stored in each slot
+        self.state = RawArray("q", [0, -1, -1] + [height, width] * slots)
+        self._attach()
+
+    def _attach(self):
+        self.frames = np.ndarray((self.slots, *self.shape), dtype=np.uint8, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("frames", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def begin_write(self, frame: np.ndarray) -> Tuple[int, np.ndarray]:
+        """Copy a frame into a free slot and return (slot, view) for drawing."""
+        with self.condition:
+            slot = next(
+                slot for slot in range(self.slots)
+                if slot != self.state[_LATEST] and slot != self.state[_READING]
+            )
+
+        height, width = frame.shape[:2]
+        if frame.shape[2:] == self.shape[2:] and height <= self.shape[0] and width <= self.shape[1]:
+            view = self.frames[slot, :height, :width]
+            np.copyto(view, frame)
+        else:
+            height, width = self.shape[:2]
+            view = self.frames[slot]
+            cv2.resize(frame, (width, height), dst=view)
+        # Only the writer touches a free slot, so the shape needs no lock
+        self.state[_SHAPES + 2 * slot] = height
+        self.state[_SHAPES + 2 * slot + 1] = width
+        return slot, view
+
+    def publish(self, slot: int):
+        with self.condition:
+            self.state[_SEQUENCE] += 1
+            self.state[_LATEST] = slot
+            self.condition.notify_all()
+
+    def wait(self, last_sequence: int, timeout: float) -> Optional[Tuple[int, np.ndarray]]:
+        """Block until a frame newer than last_sequence is published.
+
+        Returns:
+            (sequence, frame) or None on timeout. The frame stays untouched by
+            the writer until release() is called.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.state[_SEQUENCE] > last_sequence, timeout):
+                return None
+            slot = self.state[_LATEST]
+            self.state[_READING] = slot
+            height = self.state[_SHAPES + 2 * slot]
+            width = self.state[_SHAPES + 2 * slot + 1]
+            return self.state[_SEQUENCE], self.frames[slot, :height, :width]
+
+    def release(self):
+        with self.condition:
+            self.state[_READING] = -1
+
+    def close(self):
+        self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A view handed out by wait() or begin_write() is still alive
+            pass
+
+    def unlink(self):
+        self.shm.unlink()
+
+def start_display(frame_buffer: SharedFrameBuffer):
+
+    last_sequence = 0
 
     try:
         while True:
-            if not frame_queue.empty():
-                frame = frame_queue.get()
+            published = frame_buffer.wait(last_sequence, timeout=0.1)
+            if published is not None:
+                last_sequence, frame = published
                 cv2.imshow("Received Video", frame)
+                frame_buffer.release()
 
+            # Still needed to pump window events and catch the quit key
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
 
@@ -17,5 +125,5 @@ def start_display(frame_queue: Queue):
     except Exception as e:
         print(f"Error in display thread: {e}")
     finally:
-        frame_queue.close()
-        cv2.destroyAllWindows()
\ No newline at end of file
+        frame_buffer.close()
+        cv2.destroyAllWindows()
@@ -0,0 +1,99 @@
+import numpy as np
+from typing import Optional
+
+class FrameHistory:
+    """Fixed capacity ring of captured frames indexed by frame count.
+
+    Frames wait here until the processing unit returns their results. A frame
+    lives in slot frame_count % capacity, so lookup is O(1) and memory never
+    grows past capacity frames no matter how many results are late or lost.
+    Each slot also remembers the RTP timestamp the frame was sent with and
+    when it was captured, so results can be matched by timestamp and frames
+    scheduled for presentation.
+
+    Counters:
+        matched: frames that were taken for display.
+        evicted: frames that were dropped without ever being displayed, either
+            because a newer frame overwrote their slot or because a newer
+            frame was displayed first.
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.frame_ids = np.full(capacity, -1, dtype=np.int64)
+        # Kept after a frame is taken or evicted so late results still resolve
+        self.sent_ids = np.full(capacity, -1, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.capture_times = np.zeros(capacity, dtype=np.float64)
+        self.frames = None
+        self.matched = 0
+        self.evicted = 0
+
+    def _allocate(self, shape, dtype):
+        self.frames = np.empty((self.capacity, *shape), dtype=dtype)
+        self.frame_ids.fill(-1)
+        self.sent_ids.fill(-1)
+
+    def put(self, frame_count: int, frame: np.ndarray, timestamp: int = -1, capture_time: float = 0.0):
+        """Copy a frame into its slot, evicting whatever was still there."""
+        if self.frames is None or self.frames.shape[1:] != frame.shape:
+            self._allocate(frame.shape, frame.dtype)
+
+        slot = frame_count % self.capacity
+        if self.frame_ids[slot] >= 0:
+            self.evicted += 1
+        np.copyto(self.frames[slot], frame)
+        self.frame_ids[slot] = frame_count
+        self.sent_ids[slot] = frame_count
+        self.timestamps[slot] = timestamp
+        self.capture_times[slot] = capture_time
+
+    def find(self, timestamp: int, tolerance: int) -> int:
+        """Return the frame count of the recent frame sent closest to timestamp.
+
+        Frames that were already taken or evicted still count as long as
+        their slot has not been reused.
+
+        Returns:
+            The frame count, or -1 if no recent frame is within tolerance.
+        """
+        distance = np.abs(self.timestamps - timestamp)
+        distance[self.sent_ids < 0] = np.iinfo(np.int64).max
+        slot = int(np.argmin(distance))
+        if distance[slot] > tolerance:
+            return -1
+        return int(self.sent_ids[slot])
+
+    def newest_before(self, deadline: float) -> int:
+        """Return the newest stored frame captured at or before deadline, or -1."""
+        ready = (self.frame_ids >= 0) & (self.capture_times <= deadline)
+        if not ready.any():
+            return -1
+        return int(self.frame_ids[ready].max())
+
+    def capture_time(self, frame_count: int) -> Optional[float]:
+        slot = frame_count % self.capacity
+        if self.sent_ids[slot] != frame_count:
+            return None
+        return float(self.capture_times[slot])
+
+    def take(self, frame_count: int) -> Optional[np.ndarray]:
+        """Return the frame with this frame count and drop every older one.
+
+        The returned array is a view into the ring and stays valid until
+        capacity more frames have been stored.
+        """
+        stale = (self.frame_ids >= 0) & (self.frame_ids < frame_count)
+        self.evicted += int(np.count_nonzero(stale))
+        self.frame_ids[stale] = -1
+
+        slot = frame_count % self.capacity
+        if frame_count < 0 or self.frame_ids[slot] != frame_count:
+            return None
+
+        self.frame_ids[slot] = -1
+        self.matched += 1
+        return self.frames[slot]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.frame_ids >= 0))
@@ -13,7 +13,7 @@ import os
 from dotenv import load_dotenv
 
 from api_interface import TestsAPI
-from utils import get_time_offset
+from detector_factory import create_detector
 
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -39,7 +39,7 @@ send_times = []
 
 base_options = mp.tasks.BaseOptions(
     model_asset_path="../models/pose_landmarker_lite.task", # Path to the model file
-    delegate=mp.tasks.BaseOptions.Delegate.CPU, # Use GPU if available (only on Linux)
+    delegate=mp.tasks.BaseOptions.Delegate.CPU, # Replaced by the delegate calibrated for this machine
 )
 
 options = vision.PoseLandmarkerOptions(
@@ -50,7 +50,7 @@ options = vision.PoseLandmarkerOptions(
     min_tracking_confidence=0.5,
 )
 
-detector = vision.PoseLandmarker.create_from_options(options)
+detector = create_detector(options)
 
 class WebsocketSignalingServer:
     def __init__(self, host, port, id):
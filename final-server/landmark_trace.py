@@ -0,0 +1,94 @@
+import numpy as np
+from typing import List
+
+# Order of the per-landmark fields in a trace
+LANDMARK_FIELDS = ("x", "y", "z", "visibility", "presence")
+NUM_LANDMARKS = 33
+
+# Exercise names are stored per frame as an index into this tuple
+EXERCISES = ("arms", "legs", "walk")
+
+TRACE_VERSION = 1
+
+class TraceWriter:
+    """Records the landmarks a processing unit saw so the session can be replayed.
+
+    The trace is columnar: one array per field, with one row per result.
+        landmarks: float32 (N, 33, 5) with the fields in LANDMARK_FIELDS.
+        detected: bool (N,), False where no pose was found (landmarks are zero).
+        pts: int64 (N,) frame timestamps on the RTP clock.
+        wall_time: float64 (N,) time.time() when the result was handled, which
+            is the clock the exercises use for their own timers.
+        exercise: uint8 (N,) index into EXERCISES.
+        right_leg: bool (N,) the leg selected for the legs exercise.
+
+    Rows are filled into preallocated chunks, so recording costs one copy of
+    33 landmarks per frame. Everything is written with np.savez_compressed
+    when the writer is closed.
+    """
+
+    def __init__(self, path: str, chunk_size: int = 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunks: List[dict] = []
+        self.chunk = None
+        self.row = 0
+
+    def _new_chunk(self):
+        size = self.chunk_size
+        self.chunk = {
+            "landmarks": np.zeros((size, NUM_LANDMARKS, len(LANDMARK_FIELDS)), dtype=np.float32),
+            "detected": np.zeros(size, dtype=bool),
+            "pts": np.zeros(size, dtype=np.int64),
+            "wall_time": np.zeros(size, dtype=np.float64),
+            "exercise": np.zeros(size, dtype=np.uint8),
+            "right_leg": np.zeros(size, dtype=bool),
+        }
+        self.chunks.append(self.chunk)
+        self.row = 0
+
+    def record(self, landmarks: List[dict], pts: int, wall_time: float, exercise: str, right_leg: bool):
+        if self.chunk is None or self.row == self.chunk_size:
+            self._new_chunk()
+
+        row = self.row
+        if landmarks:
+            self.chunk["landmarks"][row] = [
+                [landmark[field] or 0.0 for field in LANDMARK_FIELDS] for landmark in landmarks[:NUM_LANDMARKS]
+            ]
+            self.chunk["detected"][row] = True
+        self.chunk["pts"][row] = pts
+        self.chunk["wall_time"][row] = wall_time
+        self.chunk["exercise"][row] = EXERCISES.index(exercise) if exercise in EXERCISES else 0
+        self.chunk["right_leg"][row] = bool(right_leg)
+        self.row += 1
+
+    def __len__(self):
+        if not self.chunks:
+            return 0
+        return (len(self.chunks) - 1) * self.chunk_size + self.row
+
+    def close(self):
+        if not self.chunks:
+            return
+        columns = {
+            name: np.concatenate([chunk[name] for chunk in self.chunks])[:len(self)]
+            for name in self.chunk
+        }
+        np.savez_compressed(self.path, version=TRACE_VERSION, exercises=np.array(EXERCISES), **columns)
+        self.chunks = []
+        self.chunk = None
+
+def load_trace(path: str) -> dict:
+    """Load a trace written by TraceWriter as a dict of its columns."""
+    with np.load(path) as data:
+        trace = {name: data[name] for name in data.files}
+    if int(trace.get("version", 0)) != TRACE_VERSION:
+        raise ValueError(f"Unsupported trace version in {path}")
+    return trace
+
+def landmark_dicts(landmarks: np.ndarray, detected: bool) -> List[dict]:
+    """Turn one trace row back into the landmark dicts the exercises take."""
+    if not detected:
+        return []
+    return [dict(zip(LANDMARK_FIELDS, map(float, row))) for row in landmarks]
@@ -0,0 +1,234 @@
+import argparse
+import json
+import time
+import warnings
+from datetime import datetime
+
+import numpy as np
+
+# Measurement points along a frame's path, a and f are taken on the client, b to e on the processing unit
+POINTS = ("a", "b", "c", "d", "e", "f")
+
+# name -> (from point, to point)
+STAGES = {
+    "latency": ("a", "f"),
+    "frame_send": ("a", "b"),
+    "queue": ("b", "c"),
+    "processing": ("c", "d"),
+    "results_prepare": ("d", "e"),
+    "results_send": ("e", "f"),
+}
+
+PERCENTILES = (50, 90, 95, 99)
+
+def _parse_point(point: str) -> tuple:
+    # Points are written as {"point_x": N}, slicing them is much faster than json.loads
+    if point.startswith('{"point_') and point[9:12] == '": ' and point.endswith("}"):
+        try:
+            return point[8], int(point[12:-1])
+        except ValueError:
+            pass
+    ((key, value),) = json.loads(point).items()
+    return key[-1], int(value)
+
+def _parse_timestamps(timestamps: list) -> np.ndarray:
+    """Convert measurement timestamps to seconds since the epoch.
+
+    The Tests API returns ISO 8601 strings, numpy parses them in one call.
+    Timestamps that are already numbers are used as they are.
+    """
+    if not timestamps:
+        return np.empty(0, dtype=np.float64)
+    if not isinstance(timestamps[0], str):
+        return np.asarray(timestamps, dtype=np.float64)
+    try:
+        with warnings.catch_warnings():
+            # Offsets are applied, the result is UTC either way
+            warnings.simplefilter("ignore", DeprecationWarning)
+            parsed = np.array(timestamps, dtype="datetime64[us]")
+        return parsed.astype(np.int64) / 1e6
+    except ValueError:
+        return np.array([datetime.fromisoformat(timestamp).timestamp() for timestamp in timestamps])
+
+def load_measurements(measurements: list) -> dict:
+    """Split the measurements of a test into one columnar stream per point.
+
+    Args:
+        measurements: Dicts with a "point" JSON string and a "timestamp", as
+            returned by TestsAPI.get_tests, or the columnar form the local
+            tests-service returns, {"point_x": {"values": [...], "timestamps": [...]}}.
+
+    Returns:
+        A dict of point -> (frame ids, times in seconds), both sorted by frame
+        id. The frame id is the frame's pts, which every point records as is.
+    """
+    ids = {point: [] for point in POINTS}
+    timestamps = {point: [] for point in POINTS}
+    if isinstance(measurements, dict):
+        for name, columns in measurements.items():
+            if name[-1] in ids:
+                ids[name[-1]] = columns["values"]
+                timestamps[name[-1]] = columns["timestamps"]
+    else:
+        for measurement in measurements:
+            point, value = _parse_point(measurement["point"])
+            if point in ids:
+                ids[point].append(value)
+                timestamps[point].append(measurement["timestamp"])
+
+    streams = {}
+    for point in POINTS:
+        frame_ids = np.array(ids[point], dtype=np.int64)
+        times = _parse_timestamps(timestamps[point])
+        order = np.argsort(frame_ids, kind="stable")
+        streams[point] = (frame_ids[order], times[order])
+    return streams
+
+def align(streams: dict) -> tuple:
+    """Join the point streams on frame id.
+
+    Every frame sent by the client (point a) gets one row. The other points
+    are matched with a sorted-merge join, the first measurement of a frame
+    id wins, and frames that never reached a point have NaN there.
+
+    Returns:
+        (frame ids, times) with times of shape (frames, len(POINTS)) in seconds.
+    """
+    frames, first = np.unique(streams["a"][0], return_index=True)
+    times = np.full((len(frames), len(POINTS)), np.nan)
+    times[:, 0] = streams["a"][1][first]
+
+    for column, point in enumerate(POINTS[1:], start=1):
+        point_ids, point_times = streams[point]
+        if len(point_ids) == 0:
+            continue
+        unique_ids, unique_first = np.unique(point_ids, return_index=True)
+        index = np.minimum(np.searchsorted(unique_ids, frames), len(unique_ids) - 1)
+        matched = unique_ids[index] == frames
+        times[matched, column] = point_times[unique_first[index[matched]]]
+    return frames, times
+
+def stage_latencies(times: np.ndarray) -> dict:
+    """Per-frame latency of every stage in milliseconds, NaN where a point is missing."""
+    return {
+        name: (times[:, POINTS.index(end)] - times[:, POINTS.index(start)]) * 1000
+        for name, (start, end) in STAGES.items()
+    }
+
+def summarize(latencies: dict) -> dict:
+    """Count, mean, spread and percentiles of every stage, ignoring missing frames."""
+    summary = {}
+    for name, values in latencies.items():
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            summary[name] = {"count": 0}
+            continue
+        row = {"count": int(len(values)), "mean": float(values.mean()), "std": float(values.std())}
+        for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+            row[f"p{percentile}"] = float(value)
+        row["max"] = float(values.max())
+        summary[name] = row
+    return summary
+
+def print_summary(summary: dict, frames: int):
+    columns = ["count", "mean", "std"] + [f"p{percentile}" for percentile in PERCENTILES] + ["max"]
+    print(f"{frames} frames sent, times in ms")
+    print(f"{'stage':<18}" + "".join(f"{column:>10}" for column in columns))
+    for name, row in summary.items():
+        cells = [f"{row['count']:>10}"] + [f"{row[column]:>10.2f}" if column in row else f"{'-':>10}" for column in columns[1:]]
+        print(f"{name:<18}" + "".join(cells))
+
+def save_npz(path: str, frames: np.ndarray, times: np.ndarray, latencies: dict):
+    np.savez_compressed(path, frames=frames, times=times, points=np.array(POINTS), **latencies)
+
+def save_parquet(path: str, frames: np.ndarray, times: np.ndarray, latencies: dict) -> bool:
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        print("pyarrow is not installed, skipping the Parquet output")
+        return False
+    columns = {"frame": frames}
+    columns.update({f"point_{point}": times[:, column] for column, point in enumerate(POINTS)})
+    columns.update(latencies)
+    pyarrow.parquet.write_table(pyarrow.table(columns), path)
+    return True
+
+def save_csv(path: str, frames: np.ndarray, latencies: dict):
+    # Same columns calculate_times.py used to write
+    names = ["latency", "frame_send", "processing", "results_send"]
+    header = "Id,Latency,Frame send time,Mediapipe Pose processing time,Results send time"
+    np.savetxt(path, np.column_stack([frames] + [latencies[name] for name in names]), delimiter=",", header=header, comments="", fmt="%.6f")
+
+def draw_graph(path: str, latencies: dict):
+    import matplotlib.pyplot as plt
+
+    x = np.arange(len(latencies["latency"]))
+    plt.plot(x, latencies["latency"], label='Latency')
+    plt.plot(x, latencies["frame_send"], label='Frame send time')
+    plt.plot(x, latencies["processing"], label='Mediapipe Pose processing time')
+    plt.plot(x, latencies["results_send"], label='Results send time')
+
+    plt.xlabel('Frame Number')
+    plt.ylabel('Time (milliseconds)')
+    plt.title('Latency and Processing Times')
+    plt.legend()
+    plt.grid()
+    plt.savefig(path)
+
+def load_test(test_id: str, house_id: str) -> dict:
+    from api_interface import TestsAPI
+
+    # Services that don't know columnar answer with one object per measurement, both are understood
+    test_data = TestsAPI.get_tests(test_id=test_id, house_id=house_id, columnar=True)
+    if not test_data:
+        raise SystemExit(f"Test {test_id} not found")
+    return test_data[0]
+
+def analyze(test: dict) -> tuple:
+    """Run the whole analysis on a test as returned by the Tests API.
+
+    Returns:
+        (frames, times, latencies, summary)
+    """
+    streams = load_measurements(test["measurements"])
+    frames, times = align(streams)
+    latencies = stage_latencies(times)
+    return frames, times, latencies, summarize(latencies)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Per-stage latency analysis of a test")
+    parser.add_argument("--test-id", type=str, default="test0086")
+    parser.add_argument("--house-id", type=str, default="house01")
+    parser.add_argument("--input", type=str, default=None, help="Saved Tests API response to analyze instead of fetching the test")
+    parser.add_argument("--output", type=str, default="times", help="Prefix of the output files")
+    parser.add_argument("--format", choices=["npz", "parquet", "csv"], nargs="+", default=["npz", "csv"])
+    parser.add_argument("--graph", action="store_true", help="Also plot the per-frame latencies")
+
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, "r") as f:
+            data = json.load(f)
+        test = data[0] if isinstance(data, list) else data
+    else:
+        test = load_test(args.test_id, args.house_id)
+
+    start = time.perf_counter()
+    frames, times, latencies, summary = analyze(test)
+    elapsed = time.perf_counter() - start
+
+    print_summary(summary, len(frames))
+    print(f"Analyzed {len(frames)} frames in {elapsed * 1000:.1f} ms")
+
+    if "npz" in args.format:
+        save_npz(f"{args.output}.npz", frames, times, latencies)
+    if "parquet" in args.format:
+        save_parquet(f"{args.output}.parquet", frames, times, latencies)
+    if "csv" in args.format:
+        save_csv(f"{args.output}.csv", frames, latencies)
+    with open(f"{args.output}_summary.json", "w") as f:
+        json.dump(summary, f, indent=2)
+    if args.graph:
+        draw_graph(f"{args.output}_graph.png", latencies)
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import os
+import socket
+import sys
+import tempfile
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Optional, Tuple
+
+import cv2
+import numpy as np
+from aiortc import MediaStreamError
+
+# Needs Unix sockets and a shared memory block both processes can open by name
+AVAILABLE = sys.platform != "win32" and hasattr(socket, "AF_UNIX")
+
+# Per slot: sequence, pts, height, width
+_SEQUENCE = 0
+_PTS = 1
+_HEIGHT = 2
+_WIDTH = 3
+_HEADER_FIELDS = 4
+
+# Results carry the landmarks and connection styles, well below this
+_LINE_LIMIT = 1 << 20
+
+def get_host_id() -> Optional[str]:
+    """Identify the machine, so the signaling server can tell when a client and a unit share it."""
+    for path in ("/etc/machine-id", "/var/lib/dbus/machine-id"):
+        try:
+            with open(path, "r") as f:
+                machine_id = f.read().strip()
+            if machine_id:
+                return machine_id
+        except OSError:
+            continue
+    return socket.gethostname() or None
+
+def socket_path(unit_id: str) -> str:
+    return os.path.join(tempfile.gettempdir(), f"pose-{unit_id}.sock")
+
+class FrameRing:
+    """Ring of RGB frames in shared memory, written by the client and read by a unit on the same host.
+
+    Every slot has a small header guarded like a seqlock: the writer makes
+    the slot's sequence odd while it copies a frame in and even again once
+    it is done. A reader is told (slot, sequence) over the socket, copies
+    the frame out and checks the sequence did not move meanwhile. A frame
+    the writer lapped before the unit got to it is simply gone, which is
+    what the unit wants anyway: it only ever processes the newest frame.
+
+    width and height are the largest frame the ring holds, smaller ones are
+    stored at their own size.
+    """
+
+    def __init__(self, width: int, height: int, slots: int = 4, name: Optional[str] = None):
+        self.shape = (height, width, 3)
+        self.slots = slots
+        header_size = slots * _HEADER_FIELDS * 8
+        if name is None:
+            self.shm = SharedMemory(create=True, size=header_size + slots * height * width * 3)
+            self.owner = True
+        else:
+            self.shm = SharedMemory(name=name)
+            self.owner = False
+            if os.name == "posix":
+                # The attaching side must not unlink the block when it exits
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.header = np.ndarray((slots, _HEADER_FIELDS), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((slots, *self.shape), dtype=np.uint8, buffer=self.shm.buf, offset=header_size)
+        if self.owner:
+            self.header[:] = 0
+        self.next_slot = 0
+
+    def description(self) -> dict:
+        return {"name": self.shm.name, "width": self.shape[1], "height": self.shape[0], "slots": self.slots}
+
+    @classmethod
+    def attach(cls, description: dict) -> "FrameRing":
+        return cls(description["width"], description["height"], description["slots"], description["name"])
+
+    def write(self, frame: np.ndarray, pts: int) -> Tuple[int, int]:
+        """Copy a frame into the next slot and return (slot, sequence) for the reader."""
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % self.slots
+        header = self.header[slot]
+
+        header[_SEQUENCE] += 1
+        height, width = frame.shape[:2]
+        if height <= self.shape[0] and width <= self.shape[1]:
+            np.copyto(self.frames[slot, :height, :width], frame)
+        else:
+            height, width = self.shape[:2]
+            cv2.resize(frame, (width, height), dst=self.frames[slot])
+        header[_PTS] = pts
+        header[_HEIGHT] = height
+        header[_WIDTH] = width
+        header[_SEQUENCE] += 1
+        return slot, int(header[_SEQUENCE])
+
+    def read(self, slot: int, sequence: int) -> Optional[Tuple[np.ndarray, int]]:
+        """Copy a frame out of its slot, returns (frame, pts) or None if it was overwritten."""
+        header = self.header[slot]
+        if header[_SEQUENCE] != sequence:
+            return None
+        pts, height, width = int(header[_PTS]), int(header[_HEIGHT]), int(header[_WIDTH])
+        frame = self.frames[slot, :height, :width].copy()
+        if header[_SEQUENCE] != sequence:
+            return None
+        return frame, pts
+
+    def close(self):
+        self.header = None
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def write_message(writer: asyncio.StreamWriter, label: str, payload: str):
+    # One message per line, JSON never contains a raw newline
+    writer.write(f"{label}\t{payload}\n".encode())
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[Tuple[str, str]]:
+    """Read the next (label, payload), None once the other end is gone."""
+    try:
+        line = await reader.readline()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        return None
+    if not line:
+        return None
+    label, _, payload = line.decode().rstrip("\n").partition("\t")
+    return label, payload
+
+class LocalChannel:
+    """Stands in for an RTCDataChannel, sending its messages over the local socket."""
+
+    def __init__(self, writer: asyncio.StreamWriter, label: str):
+        self.writer = writer
+        self.label = label
+
+    def send(self, data: str):
+        if self.writer.is_closing():
+            raise ConnectionError(f"Local {self.label} channel is closed")
+        write_message(self.writer, self.label, data)
+
+class LocalFrame:
+    """The parts of an av.VideoFrame the processing unit uses."""
+
+    def __init__(self, frame: np.ndarray, pts: int):
+        self.frame = frame
+        self.pts = pts
+
+    def to_ndarray(self, format: str = "rgb24") -> np.ndarray:
+        if format == "bgr24":
+            return cv2.cvtColor(self.frame, cv2.COLOR_RGB2BGR)
+        return self.frame
+
+class LocalVideoTrack:
+    """Stands in for the received video track, handing out the frames the client announces."""
+
+    kind = "video"
+
+    def __init__(self, ring: FrameRing):
+        self.ring = ring
+        self.announced = asyncio.Queue()
+
+    def announce(self, slot: int, sequence: int):
+        self.announced.put_nowait((slot, sequence))
+
+    def end(self):
+        # Frames still announced would be read from a ring that is about to close
+        while not self.announced.empty():
+            self.announced.get_nowait()
+        self.announced.put_nowait(None)
+
+    async def recv(self) -> LocalFrame:
+        while True:
+            announced = await self.announced.get()
+            if announced is None:
+                raise MediaStreamError
+            read = self.ring.read(*announced)
+            if read is not None:
+                return LocalFrame(*read)
+
+class LocalTransportServer:
+    """Unit side of the local transport, listening on a Unix socket for the one client of the unit.
+
+    Args:
+        path: Socket path, see socket_path.
+        on_connect: Called with (track, data_channel, results_channel) once a
+            client has said hello.
+        on_message: Called with (data_channel, message) for every control message.
+        on_close: Called once the client is gone.
+    """
+
+    def __init__(self, path: str, on_connect: Callable, on_message: Callable, on_close: Callable):
+        self.path = path
+        self.on_connect = on_connect
+        self.on_message = on_message
+        self.on_close = on_close
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Left behind by a unit that did not shut down cleanly
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._handle_client, path=self.path, limit=_LINE_LIMIT)
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = await read_message(reader)
+        if hello is None or hello[0] != "hello":
+            print("Local client did not say hello, closing")
+            writer.close()
+            return
+
+        ring = FrameRing.attach(json.loads(hello[1]))
+        track = LocalVideoTrack(ring)
+        data_channel = LocalChannel(writer, "data")
+        self.on_connect(track, data_channel, LocalChannel(writer, "results"))
+        try:
+            while True:
+                message = await read_message(reader)
+                if message is None:
+                    break
+                label, payload = message
+                if label == "frame":
+                    slot, sequence = payload.split(",")
+                    track.announce(int(slot), int(sequence))
+                elif label == "data":
+                    self.on_message(data_channel, payload)
+                else:
+                    print(f"Unknown local message: {label}")
+        finally:
+            track.end()
+            writer.close()
+            self.on_close()
+            ring.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class LocalTransportClient:
+    """Client side of the local transport.
+
+    Args:
+        path: Socket path the unit sent in its accepted_connection message.
+        width: Largest frame width that will be sent.
+        height: Largest frame height that will be sent.
+    """
+
+    def __init__(self, path: str, width: int, height: int):
+        self.path = path
+        self.ring = FrameRing(width, height)
+        self.reader = None
+        self.writer = None
+        self.data_channel = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=_LINE_LIMIT)
+        write_message(self.writer, "hello", json.dumps(self.ring.description()))
+        self.data_channel = LocalChannel(self.writer, "data")
+
+    def send_frame(self, frame: np.ndarray, pts: int) -> Tuple[int, int]:
+        slot, sequence = self.ring.write(frame, pts)
+        write_message(self.writer, "frame", f"{slot},{sequence}")
+        return slot, sequence
+
+    async def receive(self, on_results: Callable, on_data: Callable):
+        """Dispatch what the unit sends until it goes away."""
+        while True:
+            message = await read_message(self.reader)
+            if message is None:
+                break
+            label, payload = message
+            if label == "results":
+                on_results(payload)
+            elif label == "data":
+                on_data(payload)
+            else:
+                print(f"Unknown local message: {label}")
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        self.ring.close()
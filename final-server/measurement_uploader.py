@@ -0,0 +1,229 @@
+import contextlib
+import gzip
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import requests
+
+from api_interface import TEST_API_URL, VERIFY_SSL
+from utils import load_time_sync
+
+SPOOL_PATH = os.getenv("MEASUREMENT_SPOOL", "measurements_spool.jsonl")
+
+# What became of a batch that was posted
+SENT = "sent"
+REJECTED = "rejected"
+FAILED = "failed"
+
+class MeasurementUploader:
+    """Streams measurements to the Tests API while a test runs.
+
+    Measurements are queued by the frame path without blocking and a
+    background thread posts them in batches to /measurement/bulk over one
+    keep-alive connection. Failed batches are retried with exponential
+    backoff and, once the retries run out, appended to a spool file that is
+    sent again the next time an uploader starts. Nothing is lost when the
+    API is down and nothing is left to upload at shutdown. Batches the API
+    rejects would be rejected again, they go to a dead letter file next to
+    the spool that is never sent.
+
+    Args:
+        test_id: The test the measurements belong to.
+        batch_size: Measurements per request.
+        flush_interval: Longest time in seconds a measurement waits for its
+            batch to fill up.
+        max_pending: Measurements queued at most. Past this the API can't
+            keep up and further ones go straight to the spool file.
+        compress: Gzip the request bodies.
+        retries: Attempts per batch before it is spooled.
+        backoff: Delay in seconds before the first retry, doubled on every
+            following one.
+        spool_path: Where batches that could not be sent are kept, rejected
+            ones go to spool_path + ".rejected".
+    """
+
+    def __init__(self, test_id, batch_size: int = 500, flush_interval: float = 1.0, max_pending: int = 100000,
+                 compress: bool = True, retries: int = 5, backoff: float = 0.5, spool_path: str = SPOOL_PATH):
+        self.test_id = test_id
+        # The frame path reads the clock offset for every measurement, it must not hit the filesystem
+        load_time_sync()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.retries = retries
+        self.backoff = backoff
+        self.spool_path = spool_path
+        self.rejected_path = f"{spool_path}.rejected"
+
+        self.url = f"{TEST_API_URL}measurement/bulk"
+        self.session = requests.Session()
+        self.session.verify = VERIFY_SSL
+        self.session.headers["Content-Type"] = "application/json"
+        if compress:
+            self.session.headers["Content-Encoding"] = "gzip"
+
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.overflow = []
+        self.spool_lock = threading.Lock()
+        self.closing = threading.Event()
+        self.sent = 0
+        self.spooled = 0
+        self.rejected = 0
+        # Set after a batch ran out of retries, later batches get one attempt until one goes through
+        self.unreachable = False
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, point: str, value: int, timestamp: float) -> bool:
+        """Queue one measurement, returns False if it had to be spooled instead."""
+        measurement = {"point": f"{{\"{point}\": {value}}}", "timestamp": timestamp}
+        try:
+            self.pending.put_nowait(measurement)
+            return True
+        except queue.Full:
+            with self.spool_lock:
+                self.overflow.append(measurement)
+                overflow = len(self.overflow)
+            if overflow >= self.batch_size:
+                self._spool(self._take_overflow())
+            return False
+
+    def close(self, timeout: float = 10.0):
+        """Send what is still queued, spooling whatever can't go out in time."""
+        self.closing.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print("Measurement upload did not finish in time, spooling the rest")
+        remaining = self._take_overflow()
+        while True:
+            try:
+                remaining.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        if remaining:
+            self._spool(remaining)
+        self.session.close()
+        print(f"Measurements uploaded: {self.sent}, spooled: {self.spooled}, rejected: {self.rejected}")
+
+    def _take_overflow(self) -> list:
+        with self.spool_lock:
+            overflow, self.overflow = self.overflow, []
+        return overflow
+
+    def _run(self):
+        self._resend_spool()
+
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while not (self.closing.is_set() and self.pending.empty()):
+            try:
+                batch.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+                if len(batch) < self.batch_size:
+                    continue
+            except queue.Empty:
+                pass
+            if batch:
+                self._send_or_spool(self.test_id, batch)
+                batch = []
+            deadline = time.monotonic() + self.flush_interval
+        if batch:
+            self._send_or_spool(self.test_id, batch)
+
+    def _post(self, test_id, measurements: list) -> str:
+        """Post one batch, returns SENT, REJECTED by the API or FAILED to get through."""
+        body = json.dumps({"test_id": test_id, "measurements": measurements}).encode()
+        if self.compress:
+            body = gzip.compress(body, compresslevel=1)
+
+        retries = 1 if self.unreachable else self.retries
+        for attempt in range(retries):
+            try:
+                response = self.session.post(self.url, data=body, timeout=10)
+                if response.status_code < 500:
+                    # Client errors won't go away by retrying
+                    response.raise_for_status()
+                    self.unreachable = False
+                    return SENT
+                print(f"Measurement upload failed with status {response.status_code}")
+            except requests.HTTPError as e:
+                print(f"Measurement upload rejected: {e}")
+                return REJECTED
+            except requests.RequestException as e:
+                print(f"Measurement upload failed: {e}")
+            if attempt + 1 < retries and not self.closing.is_set():
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        self.unreachable = True
+        return FAILED
+
+    def _send_or_spool(self, test_id, measurements: list):
+        result = self._post(test_id, measurements)
+        if result == SENT:
+            self.sent += len(measurements)
+        elif result == REJECTED:
+            self._reject(measurements, test_id)
+        else:
+            self._spool(measurements, test_id)
+
+    @contextlib.contextmanager
+    def _locked_spool(self):
+        """Hold the spool files against this uploader's threads and every other process sharing them.
+
+        All the units of a MultiServer and the client may run in the same
+        directory and use the same spool.
+        """
+        with self.spool_lock:
+            with open(f"{self.spool_path}.lock", "w") as lock:
+                if os.name == "posix":
+                    import fcntl
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    def _append(self, path: str, line: str):
+        with open(path, "a") as f:
+            f.write(line + "\n")
+
+    def _spool(self, measurements: list, test_id=None):
+        with self._locked_spool():
+            self._append(self.spool_path, json.dumps({"test_id": test_id or self.test_id, "measurements": measurements}))
+            self.spooled += len(measurements)
+
+    def _reject(self, measurements: list, test_id):
+        with self._locked_spool():
+            self._append(self.rejected_path, json.dumps({"test_id": test_id, "measurements": measurements}))
+            self.rejected += len(measurements)
+
+    def _resend_spool(self):
+        try:
+            with self._locked_spool():
+                if not os.path.exists(self.spool_path):
+                    return
+                # Claimed under the lock, no other uploader appends to or resends these batches
+                spool_path = f"{self.spool_path}.{os.getpid()}.sending"
+                os.replace(self.spool_path, spool_path)
+
+            with open(spool_path, "r") as f:
+                lines = [line.strip() for line in f if line.strip()]
+            print(f"Resending {len(lines)} spooled measurement batches")
+            for line in lines:
+                try:
+                    batch = json.loads(line)
+                    test_id, measurements = batch["test_id"], batch["measurements"]
+                except (ValueError, KeyError, TypeError):
+                    # A line cut short by a crash, keep it out of the spool for good
+                    with self._locked_spool():
+                        self._append(self.rejected_path, line)
+                    continue
+                # Once the API is found unreachable the rest waits for the next uploader
+                if self.unreachable:
+                    self._spool(measurements, test_id)
+                else:
+                    self._send_or_spool(test_id, measurements)
+            os.remove(spool_path)
+        except Exception as e:
+            # The measurements of this test still have to go out
+            print(f"Error resending the measurement spool: {e}")
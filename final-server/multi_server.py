@@ -4,6 +4,8 @@ from dotenv import load_dotenv
 import asyncio
 import websockets
 import json
+from zygote import Zygote
+from core_allocator import CoreAllocator, is_supported as core_allocator_supported
 
 load_dotenv(".env")
 
@@ -15,26 +17,47 @@ SERVER_ID = os.getenv("SERVER_ID")
 
 actual_id = 50000
 
-def summon_processing_unit():
+zygote = None
+
+# Splits the cores between the units, None where affinity is not supported
+allocator = None
+
+async def summon_processing_unit():
     global actual_id
     while actual_id in ids_pool:
         actual_id += 1
     ids_pool.append(actual_id)
 
+    unit_id = SERVER_ID + "-" + str(actual_id)
+
+    if zygote is not None and zygote.is_alive():
+        # Waiting for the fork must not hold up signaling for the other units
+        pid = await asyncio.get_running_loop().run_in_executor(None, zygote.spawn, unit_id, SIGNALING_IP, SIGNALING_PORT)
+        if pid is not None:
+            print(f"Forked Processing Unit {unit_id} from zygote with pid {pid}")
+            if allocator is not None:
+                allocator.add(unit_id, pid)
+            return
+        print("Zygote failed to fork, starting a new interpreter instead")
+
     if os.name == "nt":
-        subprocess.Popen(
-            ["py", "processing_unit.py", "--host", SIGNALING_IP, "--port", SIGNALING_PORT, "--id", SERVER_ID + "-" + str(actual_id)]
+        process = subprocess.Popen(
+            ["py", "processing_unit.py", "--host", SIGNALING_IP, "--port", SIGNALING_PORT, "--id", unit_id]
         )
     else:
-        subprocess.Popen(
-            ["python3", "processing_unit.py", "--host", SIGNALING_IP, "--port", SIGNALING_PORT, "--id", SERVER_ID + "-" + str(actual_id)]
+        process = subprocess.Popen(
+            ["python3", "processing_unit.py", "--host", SIGNALING_IP, "--port", SIGNALING_PORT, "--id", unit_id]
         )
+    if allocator is not None:
+        allocator.add(unit_id, process.pid)
 
 def processing_unit_off(unit_id):
     global ids_pool, actual_id
     id = unit_id.split("-")[-1]
     ids_pool.remove(int(id))
     actual_id = int(id)
+    if allocator is not None:
+        allocator.remove(unit_id)
 
 async def main():
     global actual_id
@@ -59,7 +82,7 @@ async def main():
                         return
 
                 case "request_processing_unit":
-                    summon_processing_unit()
+                    await summon_processing_unit()
                     print(f"Summoned Processing Unit: {actual_id}")
 
                 case "unit_disconnect":
@@ -74,5 +97,27 @@ async def main():
                     print(f"Unknown message type: {data.get('type')}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Calibrate the detector once here, the units then find the choice cached
+    from detector_factory import choose_detector
+    try:
+        choose_detector()
+    except Exception as e:
+        print(f"Detector calibration failed, units will retry: {e}")
+
+    if core_allocator_supported():
+        allocator = CoreAllocator(SERVER_ID)
+
+    # Start the zygote before the event loop so it forks from a clean process
+    if Zygote.is_supported():
+        zygote = Zygote()
+        if not zygote.start():
+            zygote = None
+
+    try:
+        asyncio.run(main())
+    finally:
+        if zygote is not None:
+            zygote.close()
+        if allocator is not None:
+            allocator.close()
 
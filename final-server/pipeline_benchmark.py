@@ -0,0 +1,205 @@
+import argparse
+import asyncio
+import fractions
+import json
+import queue
+import threading
+import time
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+from aiortc import MediaStreamError, RTCPeerConnection, VideoStreamTrack
+from av import VideoFrame
+from mediapipe.tasks.python.components.containers.landmark import NormalizedLandmark
+
+import processing_unit
+from benchmark import synthetic_sequence
+from presentation import RTP_CLOCK_RATE
+
+class StubDetector:
+    """Stands in for a LIVE_STREAM PoseLandmarker with a fixed inference latency.
+
+    Like the real graph it works on one frame at a time and drops frames that
+    arrive while it is busy. Results cycle through a synthetic pose sequence,
+    so the exercises downstream do the same work as with a real person.
+    """
+
+    def __init__(self, options, latency: float):
+        self.callback = options.result_callback
+        self.latency = latency
+        self.poses = [
+            [NormalizedLandmark(**landmark) for landmark in landmarks]
+            for landmarks in synthetic_sequence()
+        ]
+        self.index = 0
+        self.busy = threading.Event()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def detect_async(self, image, timestamp_ms: int):
+        if self.busy.is_set():
+            return
+        self.busy.set()
+        self.requests.put((image, timestamp_ms))
+
+    def _run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            image, timestamp_ms = request
+            time.sleep(self.latency)
+            pose = self.poses[self.index % len(self.poses)]
+            self.index += 1
+            self.callback(SimpleNamespace(pose_landmarks=[pose]), image, timestamp_ms)
+            self.busy.clear()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join(timeout=1)
+
+def synthetic_frames(width: int, height: int, count: int = 60) -> list:
+    """Procedurally generate a short deterministic clip that loops seamlessly."""
+    frames = []
+    gradient = np.linspace(0, 255, width, dtype=np.uint8)
+    for index in range(count):
+        image = np.empty((height, width, 3), dtype=np.uint8)
+        image[:] = np.roll(gradient, index * width // count)[None, :, None]
+        angle = 2 * np.pi * index / count
+        center = (int(width / 2 + width / 4 * np.cos(angle)), int(height / 2 + height / 4 * np.sin(angle)))
+        cv2.circle(image, center, height // 8, (255, 255, 255), -1)
+        cv2.putText(image, str(index), (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+        frames.append(image)
+    return frames
+
+def video_frames(path: str, width: int, height: int, count: int = 300) -> list:
+    """Decode up to count frames of a prerecorded video, resized to width x height."""
+    import av
+    frames = []
+    with av.open(path) as container:
+        for frame in container.decode(video=0):
+            frames.append(cv2.resize(frame.to_ndarray(format="rgb24"), (width, height)))
+            if len(frames) == count:
+                break
+    return frames
+
+class LoopingVideoTrack(VideoStreamTrack):
+    """Sends a clip in a loop at a fixed rate for a fixed number of frames."""
+
+    def __init__(self, frames: list, fps: int, total: int):
+        super().__init__()
+        self.frames = frames
+        self.fps = fps
+        self.total = total
+        self.sent = 0
+        self.start = None
+        self.send_times = {}
+
+    async def recv(self):
+        if self.sent >= self.total:
+            self.stop()
+            raise MediaStreamError
+
+        if self.start is None:
+            self.start = time.monotonic()
+        delay = self.start + self.sent / self.fps - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        pts = self.sent * (RTP_CLOCK_RATE // self.fps)
+        video_frame = VideoFrame.from_ndarray(self.frames[self.sent % len(self.frames)], format="rgb24")
+        video_frame.pts = pts
+        video_frame.time_base = fractions.Fraction(1, RTP_CLOCK_RATE)
+        self.send_times[pts] = time.time()
+        self.sent += 1
+        return video_frame
+
+def percentiles(values) -> str:
+    if not values:
+        return "no samples"
+    p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+    return f"p50 {p50:7.2f} ms  p95 {p95:7.2f} ms  p99 {p99:7.2f} ms  ({len(values)} samples)"
+
+def by_frame(marks, fps: int) -> dict:
+    # The receiver can round pts one tick down, as calculate_times.py also allows for
+    return {(pts + 2) // (RTP_CLOCK_RATE // fps): mark for pts, mark in marks}
+
+def stage_latencies(start: dict, end: dict) -> list:
+    return [end[frame] - start[frame] for frame in end if frame in start]
+
+async def run_benchmark(frames: list, fps: int, total: int):
+    processing_unit.loop = asyncio.get_running_loop()
+    processing_unit.record_times = True
+
+    server = RTCPeerConnection()
+    processing_unit.attach_peer_connection(server)
+
+    client = RTCPeerConnection()
+    track = LoopingVideoTrack(frames, fps, total)
+    client.addTrack(track)
+    client.createDataChannel("data")
+    results_channel = client.createDataChannel("results", ordered=False, maxRetransmits=0)
+
+    receive_times = {}
+
+    @results_channel.on("message")
+    def on_message(message):
+        data = json.loads(message)
+        receive_times[data["frame_count"]] = time.time()
+
+    await client.setLocalDescription(await client.createOffer())
+    await server.setRemoteDescription(client.localDescription)
+    await server.setLocalDescription(await server.createAnswer())
+    await client.setRemoteDescription(server.localDescription)
+
+    # Let the source run out and the last results come back
+    while track.sent < total:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1)
+
+    processing_unit.stop_flag.set()
+    await client.close()
+    await server.close()
+
+    return track, receive_times
+
+def report(track: LoopingVideoTrack, receive_times: dict):
+    fps = track.fps
+    sends = by_frame(track.send_times.items(), fps)
+    arrivals = by_frame(processing_unit.arrival_times, fps)
+    starts = by_frame(processing_unit.start_process_times, fps)
+    ends = by_frame(processing_unit.end_process_times, fps)
+    receives = by_frame(receive_times.items(), fps)
+
+    duration = max(receive_times.values()) - min(receive_times.values()) if len(receive_times) > 1 else 0
+    print(f"Frames sent: {track.sent}, arrived: {len(arrivals)}, processed: {len(ends)}, results received: {len(receive_times)}")
+    print(f"Lost before the unit: {1 - len(arrivals) / track.sent:.1%}, dropped by the unit: {1 - len(ends) / max(len(arrivals), 1):.1%}, end to end: {1 - len(receive_times) / track.sent:.1%}")
+    if duration:
+        print(f"Sustained result rate: {(len(receive_times) - 1) / duration:.1f} fps")
+    print(f"transport  {percentiles(stage_latencies(sends, arrivals))}")
+    print(f"queue      {percentiles(stage_latencies(arrivals, starts))}")
+    print(f"inference  {percentiles(stage_latencies(starts, ends))}")
+    print(f"delivery   {percentiles(stage_latencies(ends, receives))}")
+    print(f"total      {percentiles(stage_latencies(sends, receives))}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="End-to-end processing unit benchmark over a loopback WebRTC connection")
+    parser.add_argument("--detector", choices=["stub", "real"], default="stub", help="Detector to run the frames through")
+    parser.add_argument("--latency", type=float, default=0.02, help="Inference latency of the stub detector in seconds")
+    parser.add_argument("--video", type=str, default=None, help="Prerecorded video to send instead of the synthetic clip")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--seconds", type=float, default=10, help="How long to send for")
+
+    args = parser.parse_args()
+
+    if args.detector == "stub":
+        processing_unit.detector_factory = lambda options: StubDetector(options, args.latency)
+
+    frames = video_frames(args.video, args.width, args.height) if args.video else synthetic_frames(args.width, args.height)
+    track, receive_times = asyncio.run(run_benchmark(frames, args.fps, int(args.seconds * args.fps)))
+    report(track, receive_times)
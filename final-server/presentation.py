@@ -0,0 +1,138 @@
+import asyncio
+import time
+import cv2
+from typing import Optional
+
+import utils
+from frame_history import FrameHistory
+from display import SharedFrameBuffer
+
+RTP_CLOCK_RATE = 90000
+
+class PresentationScheduler:
+    """Pairs captured frames with their results and shows them at a steady rate.
+
+    Captured frames wait in a short jitter buffer. A frame is presented once
+    it is older than the playout delay, with its own result if it arrived in
+    time or with the last known overlay if it did not, so a late or lost
+    result never stalls the display. The playout delay follows the measured
+    result latency the same way RTP jitter buffers do, a smoothed mean plus
+    a multiple of the smoothed deviation, clamped to [min_delay, max_delay].
+    """
+
+    def __init__(self, frames: FrameHistory, frame_buffer: SharedFrameBuffer, fps: int,
+                 min_delay: float = 0.03, max_delay: float = 0.5):
+        self.frames = frames
+        self.frame_buffer = frame_buffer
+        self.renderer = utils.PoseRenderer()
+        self.fps = fps
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+
+        self.latency = None
+        self.jitter = 0.0
+
+        self.results = {}
+        self.last_overlay = None
+        self.last_result_frame = -1
+        self.presented = -1
+        self.reps = 0
+
+        self.on_time = 0
+        self.late = 0
+        self.unmatched = 0
+
+        self.stop_event = asyncio.Event()
+
+    def _update_delay(self, latency: float):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.jitter += (abs(latency - self.latency) - self.jitter) / 16
+            self.latency += (latency - self.latency) / 16
+        self.delay = min(max(self.latency + 4 * self.jitter, self.min_delay), self.max_delay)
+
+    def on_result(self, data: dict, now: Optional[float] = None):
+        """Store a result from the processing unit until its frame is due."""
+        now = time.monotonic() if now is None else now
+
+        timestamp = data.get("frame_count", None)
+        if timestamp is None:
+            return
+
+        # Half a frame interval absorbs any rounding of the timestamp on the way
+        frame_count = self.frames.find(timestamp, RTP_CLOCK_RATE // (2 * self.fps))
+        if frame_count < 0:
+            self.unmatched += 1
+            return
+
+        capture_time = self.frames.capture_time(frame_count)
+        if capture_time is not None:
+            self._update_delay(now - capture_time)
+
+        style_code = data.get("style_code", None)
+        if style_code is None:
+            style_code = utils.encode_style(data.get("style", None))
+        overlay = (data.get("landmarks", None), style_code)
+
+        if frame_count > self.last_result_frame:
+            self.last_result_frame = frame_count
+            self.last_overlay = overlay
+
+        if frame_count > self.presented:
+            self.results[frame_count] = overlay
+        else:
+            self.late += 1
+
+    def present(self, now: Optional[float] = None) -> bool:
+        """Show the newest frame whose playout deadline has passed.
+
+        Returns:
+            True if a frame was handed to the display.
+        """
+        now = time.monotonic() if now is None else now
+
+        frame_count = self.frames.newest_before(now - self.delay)
+        if frame_count <= self.presented:
+            return False
+
+        frame = self.frames.take(frame_count)
+        if frame is None:
+            return False
+
+        overlay = self.results.pop(frame_count, None)
+        if overlay is not None:
+            self.on_time += 1
+        else:
+            overlay = self.last_overlay
+        for stale in [count for count in self.results if count < frame_count]:
+            del self.results[stale]
+
+        slot, image = self.frame_buffer.begin_write(frame)
+        if overlay is not None and overlay[0]:
+            self.renderer.draw(image, overlay[0], overlay[1])
+        cv2.putText(image, f"Repetitions: {self.reps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
+        self.frame_buffer.publish(slot)
+
+        self.presented = frame_count
+        return True
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.fps
+        next_tick = loop.time()
+        while not self.stop_event.is_set():
+            try:
+                self.present()
+            except Exception as e:
+                print(f"Error presenting frame: {e}")
+            next_tick += interval
+            if next_tick < loop.time() - interval:
+                # Fell behind, skip the missed ticks instead of bursting
+                next_tick = loop.time()
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+
+    def stop(self):
+        self.stop_event.set()
+        print(f"Results on time: {self.on_time}, late: {self.late}, unmatched: {self.unmatched}, playout delay: {self.delay * 1000:.1f} ms")
@@ -13,11 +13,17 @@ from dotenv import load_dotenv
 import cv2
 import logging
 
-from api_interface import TestsAPI
-from utils import get_time_offset
+from utils import get_time_offset, build_result
 from exercises.arms_exercise import arms_exercise
 from exercises.legs_exercise import legs_exercise
 from exercises.walk_exercise import walk_exercise
+from session import ExerciseSession
+from landmark_trace import TraceWriter
+from measurement_uploader import MeasurementUploader
+from core_allocator import UnitAffinity
+from detector_factory import create_detector
+import decode_gate
+from local_transport import AVAILABLE as LOCAL_TRANSPORT_AVAILABLE, LocalTransportServer, get_host_id, socket_path
 
 if sys.platform == 'win32':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -43,6 +49,8 @@ test_id = None
 last_frame = None
 results_to_send = None
 data_channel = None
+results_channel = None
+result_seq = 0
 media_track = None
 
 loop = None
@@ -50,44 +58,167 @@ loop = None
 stop_flag = threading.Event()
 last_frame_lock = threading.Lock()
 
+# Load report piggybacked on a result about once per STATS_INTERVAL seconds
+STATS_INTERVAL = 1.0
+stats_lock = threading.Lock()
+stats = {
+    "received": 0,
+    "dropped": 0,
+    "processed": 0,
+    "queue_age": 0.0,
+    "queued": 0,
+}
+last_stats_time = None
+last_frame_arrival = 0.0
+
+# Per-stage (pts, time) marks, only collected when record_times is set
+record_times = False
 arrival_times = []
 start_process_times = []
 end_process_times = []
 send_times = []
 
+# Streams the marks of the running test to the Tests API, set once the client reports a test_id
+uploader = None
+
+# Called with the landmarker options to build the detector, None for the PoseLandmarker calibrated for this machine
+detector_factory = None
+
+# Inference and network cores given by the MultiServer, set in run
+affinity = None
+
+# off, safe or keyframe, see decode_gate. Frames the detector will never see are not decoded
+DECODE_GATE = os.getenv("DECODE_GATE", decode_gate.SAFE)
+gate = None
+
+# When the detector took the frame it is working on, None while it is idle
+inference_started = None
+# Moving average of the detector's time per frame in seconds
+inference_time = 0.0
+INFERENCE_TIME_WEIGHT = 0.2
+
 exercise_function = arms_exercise
 right_leg = True
+session = ExerciseSession("arms")
+
+# Clock rate of the RTP timestamps the frames carry as pts
+VIDEO_CLOCK_RATE = 90000
+
+# Set to a directory to record every session as a landmark trace for replay.py
+TRACE_DIR = os.getenv("TRACE_DIR")
+trace_writer = None
+
+MODEL_PATH = "../models/pose_landmarker_full.task"
 
+# What the unit asks clients to send: the model works on small frames, so
+# anything above this size only costs uplink bandwidth and encode/decode time
+CAPTURE_PROFILE = {
+    "width": int(os.getenv("CAPTURE_WIDTH", 640)),
+    "height": int(os.getenv("CAPTURE_HEIGHT", 480)),
+    "fps": int(os.getenv("CAPTURE_FPS", 30)),
+    "bitrate": int(os.getenv("CAPTURE_BITRATE", 800000)),
+    "keyframe_interval": int(os.getenv("CAPTURE_KEYFRAME_INTERVAL", 120)),
+    "codec": os.getenv("CAPTURE_CODEC", "video/VP8"),
+}
+
+# The delegate and model actually used are picked by detector_factory.create_detector
 base_options = mp.tasks.BaseOptions(
-    model_asset_path="../models/pose_landmarker_full.task", # Path to the model file
-    delegate=mp.tasks.BaseOptions.Delegate.GPU if os.name == "posix" else mp.tasks.BaseOptions.Delegate.CPU,
-    # Use GPU if available (only on Linux)
+    model_asset_path=MODEL_PATH, # Path to the model file
+    delegate=mp.tasks.BaseOptions.Delegate.CPU,
 )
 
+def mark_time(marks, point, frame_pts, timestamp):
+    """Record when a frame passed a measurement point, locally and for the running test."""
+    if record_times:
+        marks.append((frame_pts, timestamp))
+    if uploader is not None:
+        uploader.add(point, frame_pts, timestamp + get_time_offset())
+
 async def send_results(data, frame_pts):
-    global data_channel, send_times
+    global data_channel, results_channel, send_times
     try:
-        #send_times.append((frame_pts, time.time()))
-        if data_channel:
-            data_channel.send(data)
+        mark_time(send_times, "point_e", frame_pts, time.time())
+        # Clients that only open the control channel get their results there
+        channel = results_channel or data_channel
+        if channel:
+            channel.send(data)
             logging.debug(f"Sent frame {frame_pts}")
     except Exception as e:
         print(f"Error in send_results: {e}")
 
+async def send_control(message):
+    global data_channel
+    try:
+        if data_channel:
+            data_channel.send(json.dumps(message))
+    except Exception as e:
+        print(f"Error in send_control: {e}")
+
+def collect_stats(now):
+    """Summarise the load since the last report and reset the counters.
+
+    Rates are in frames per second and queue_age is the mean time in
+    milliseconds a received frame waited before the detector picked it up.
+    """
+    global last_stats_time
+    with stats_lock:
+        elapsed = now - last_stats_time
+        report = {
+            "received_fps": round(stats["received"] / elapsed, 1),
+            "inference_fps": round(stats["processed"] / elapsed, 1),
+            "dropped_fps": round(stats["dropped"] / elapsed, 1),
+            "queue_age": round(1000 * stats["queue_age"] / stats["queued"], 1) if stats["queued"] else 0.0,
+        }
+        for key in stats:
+            stats[key] = 0
+        last_stats_time = now
+    return report
+
+def detector_free_in():
+    """Seconds until the detector is expected to take a new frame, 0 if it is idle."""
+    started = inference_started
+    if started is None:
+        return 0.0
+    return max(0.0, started + inference_time - time.monotonic())
+
+def count_skipped_frame():
+    # Skipped frames still arrived, the client's rate control must see them as dropped
+    with stats_lock:
+        stats["received"] += 1
+        stats["dropped"] += 1
+
 def handle_results(results, _, frame_pts):
-    global end_process_times, exercise_function
-    #end_process_times.append((frame_pts, time.time()))
+    global end_process_times, exercise_function, last_stats_time, result_seq, inference_started, inference_time
+    mark_time(end_process_times, "point_d", frame_pts, time.time())
+
+    if inference_started is not None:
+        elapsed = time.monotonic() - inference_started
+        inference_time = elapsed if inference_time == 0.0 else (1 - INFERENCE_TIME_WEIGHT) * inference_time + INFERENCE_TIME_WEIGHT * elapsed
+        inference_started = None
 
     landmarks = [asdict(landmark) for landmark in results.pose_landmarks[0]] if len(results.pose_landmarks) > 0 else []
+    if trace_writer is not None:
+        trace_writer.record(landmarks, frame_pts, time.time(), session.exercise, right_leg)
     styled_connections, new_rep = exercise_function(landmarks, right_leg)
 
-    data = json.dumps({
-        "landmarks": [(round(landmark["x"],7), round(landmark["y"],7)) for landmark in landmarks], # needed to meet MTU limitations
-        "style": styled_connections,
-        "new_rep": new_rep,
-        "frame_count": frame_pts
-    })
+    result = build_result(landmarks, styled_connections, new_rep, frame_pts, result_seq)
+    result_seq += 1
+
+    now = time.monotonic()
+    with stats_lock:
+        stats["processed"] += 1
+        if last_stats_time is None:
+            last_stats_time = now
+    if now - last_stats_time >= STATS_INTERVAL:
+        # Riding on a result keeps clients that only read results working
+        result["stats"] = collect_stats(now)
+
+    data = json.dumps(result)
     asyncio.run_coroutine_threadsafe(send_results(data, frame_pts), loop)
+    # Results may be lost on the unreliable channel, the session counts must not
+    for event in session.update(styled_connections, new_rep, frame_pts / VIDEO_CLOCK_RATE):
+        if results_channel is not None:
+            asyncio.run_coroutine_threadsafe(send_control(event), loop)
 
 options = vision.PoseLandmarkerOptions(
     base_options=base_options,
@@ -105,12 +236,16 @@ class WebsocketSignalingServer:
         self.websocket = None
         self.id = id
         self.client_id = None
+        self.local_server = None
 
     async def connect(self):
         self.websocket = await websockets.connect(f"ws://{self.host}:{self.port}/ws/processing")
         await self.websocket.send(json.dumps({
             "type": "register",
             "unit_id": self.id,
+            # Lets the signaling server pick the local transport for clients on this host
+            "host_id": get_host_id(),
+            "local_transport": LOCAL_TRANSPORT_AVAILABLE,
         }))
 
     async def send(self, obj):
@@ -152,13 +287,29 @@ class WebsocketSignalingServer:
         await self.send(message)
         print("ICE candidate sent to signaling server")
 
-    async def accept_client(self, client_id):
+    async def accept_client(self, client_id, transport="webrtc"):
         self.client_id = client_id
-        await self.send({
+        message = {
             "type": "accept_connection",
             "client_id": client_id,
-            "message": "Client connection accepted."
-        })
+            "message": "Client connection accepted.",
+            "capture_profile": CAPTURE_PROFILE
+        }
+        if transport == "local" and LOCAL_TRANSPORT_AVAILABLE:
+            try:
+                await self.start_local_transport()
+                message["local_transport"] = {"socket": self.local_server.path}
+            except OSError as e:
+                print(f"Local transport unavailable, falling back to WebRTC: {e}")
+        await self.send(message)
+
+    async def start_local_transport(self):
+        if self.local_server is None:
+            self.local_server = LocalTransportServer(
+                socket_path(self.id), on_local_connect, handle_control_message, on_local_close
+            )
+            await self.local_server.start()
+            print(f"Local transport listening on {self.local_server.path}")
 
     async def receive_offer(self, pc: RTCPeerConnection, message: dict):
         obj = RTCSessionDescription(
@@ -183,8 +334,8 @@ class WebsocketSignalingServer:
                             return
 
                     case "connect":
-                        print(f"Client {message.get('client_id')} wants to connect")
-                        await self.accept_client(message.get("client_id"))
+                        print(f"Client {message.get('client_id')} wants to connect over {message.get('transport', 'webrtc')}")
+                        await self.accept_client(message.get("client_id"), message.get("transport", "webrtc"))
 
                     case "offer":
                         print("Received offer from client")
@@ -241,6 +392,9 @@ class WebsocketSignalingServer:
         
 
     async def close(self):
+        if self.local_server is not None:
+            await self.local_server.close()
+            self.local_server = None
         if self.websocket is not None:
             try:
                 await self.websocket.close()
@@ -249,9 +403,14 @@ class WebsocketSignalingServer:
                 print(f"Error closing WebSocket: {e}")
 
 def process_frame():
-    global last_frame, start_process_times
+    global last_frame, start_process_times, inference_started
 
-    detector = vision.PoseLandmarker.create_from_options(options)
+    if detector_factory is not None:
+        detector = detector_factory(options)
+    else:
+        if affinity is not None:
+            affinity.refresh()
+        detector = create_detector(options, cores=affinity.inference_cores if affinity is not None else None)
 
     while not stop_flag.is_set():
         if last_frame is None:
@@ -260,7 +419,10 @@ def process_frame():
         with last_frame_lock:
             last_frame_pts = last_frame.pts
             logging.debug(f"Processing frame {last_frame_pts}")
-            #start_process_times.append((last_frame_pts, time.time()))
+            with stats_lock:
+                stats["queue_age"] += time.monotonic() - last_frame_arrival
+                stats["queued"] += 1
+            mark_time(start_process_times, "point_c", last_frame_pts, time.time())
 
             try:
                 # Convert frame to numpy array for debugging
@@ -271,6 +433,8 @@ def process_frame():
                     image_format=mp.ImageFormat.SRGB,
                     data=frame_array
                 )
+                if inference_started is None:
+                    inference_started = time.monotonic()
                 detector.detect_async(mp_image, last_frame_pts)
                 last_frame = None  # Clear the last frame after processing
             except Exception as e:
@@ -279,20 +443,27 @@ def process_frame():
     detector.close()
 
 async def handle_track(track):
-    global last_frame, arrival_times, stop_flag
+    global last_frame, arrival_times, stop_flag, last_frame_arrival
     
     threading.Thread(target=process_frame, daemon=True).start()
 
     while not stop_flag.is_set():
         try:
             frame = await track.recv()
-            #arrival_time = time.time()
+            arrival_time = time.time()
+            dropped = True
             if last_frame_lock.acquire(blocking=False):
                 try:
+                    # A frame still waiting here was never processed
+                    dropped = last_frame is not None
                     last_frame = frame
+                    last_frame_arrival = time.monotonic()
                 finally:
                     last_frame_lock.release()
-            #arrival_times.append((frame.pts, arrival_time))
+            with stats_lock:
+                stats["received"] += 1
+                stats["dropped"] += dropped
+            mark_time(arrival_times, "point_b", frame.pts, arrival_time)
         except TypeError as e:
             continue
         except MediaStreamError as e:
@@ -300,11 +471,129 @@ async def handle_track(track):
         except Exception as e:
             print("Error receiving track:", e)
 
+def handle_control_message(channel, message):
+    """Apply a message the client sent on the data channel."""
+    global test_id, uploader
+    print("Message received:", message)
+    if isinstance(message, str):
+        try:
+            data = json.loads(message)
+            if "test_id" in data:
+                test_id = data["test_id"]
+                if test_id is not None and uploader is None:
+                    uploader = MeasurementUploader(test_id)
+            elif "exercise" in data:
+                global exercise_function, right_leg, session
+                match data["exercise"]:
+                    case "arms":
+                        exercise_function = arms_exercise
+                    case "legs":
+                        exercise_function = legs_exercise
+                        right_leg = data.get("right_leg")
+                    case "walk":
+                        exercise_function = walk_exercise
+                    case _:
+                        print(f"Unknown exercise type: {data['exercise']}")
+                        return
+                summary = session.summary()
+                session = ExerciseSession(data["exercise"])
+                if results_channel is not None:
+                    channel.send(json.dumps(summary))
+            elif "status" in data:
+                print(f"Status message: {data['status']}")
+
+        except json.JSONDecodeError:
+            print("Received non-JSON message:", message)
+
+def on_local_connect(track, channel, results):
+    """Wire a client on the local transport into the pipeline, the same way attach_peer_connection does."""
+    global data_channel, results_channel
+    print("Local transport connected")
+    data_channel = channel
+    results_channel = results
+    asyncio.create_task(handle_track(track))
+
+def on_local_close():
+    global data_channel, results_channel
+    print("Local transport closed")
+    data_channel = None
+    results_channel = None
+
+def attach_peer_connection(pc: RTCPeerConnection):
+    """Wire the data channels and the video track of a client connection into the pipeline."""
+
+    @pc.on("datachannel")
+    def on_datachannel(channel):
+        if channel.label == "results":
+            print("Results channel opened")
+            global results_channel
+            results_channel = channel
+
+            @channel.on("close")
+            def on_results_close():
+                print("Results channel closed")
+                global results_channel
+                results_channel = None
+            return
+
+        print("Data channel opened")
+        global data_channel
+        data_channel = channel
+
+        @channel.on("close")
+        def on_close():
+            print("Data channel closed")
+            global data_channel
+            data_channel = None
+
+        @channel.on("stop")
+        def on_stop():
+            print("Data channel stopped")
+            channel.close()
+
+        @channel.on("message")
+        def on_message(message):
+            handle_control_message(channel, message)
+
+    @pc.on("track")
+    def on_track(track):
+        global media_track
+        print("Track received")
+        media_track = track
+        if gate is not None and track.kind == "video":
+            for receiver in pc.getReceivers():
+                if receiver.track is track:
+                    gate.attach(receiver, loop)
+
+    @pc.on("connectionstatechange")
+    async def on_connectionstatechange():
+        print("Connection state is", pc.connectionState)
+        if pc.connectionState == "connected":
+            print("WebRTC connected")
+            asyncio.create_task(handle_track(media_track))
+            
+        elif pc.connectionState in ["closed", "failed", "disconnected"]:
+            print("WebRTC connection ended:", pc.connectionState)
+
 async def run(host, port, identifier):
-    global loop, exercise_function
+    global loop, exercise_function, trace_writer, uploader, affinity, gate
 
     loop = asyncio.get_event_loop()
 
+    if DECODE_GATE != decode_gate.OFF:
+        # Installed before the connection, aiortc creates the decoder on the first frame
+        gate = decode_gate.DecodeGate(detector_free_in, DECODE_GATE, frame_interval=1 / CAPTURE_PROFILE["fps"])
+        gate.on_skip = count_skipped_frame
+        decode_gate.install(gate)
+
+    affinity = UnitAffinity(identifier)
+    if affinity.enabled:
+        loop.create_task(affinity.watch())
+
+    if TRACE_DIR:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        trace_writer = TraceWriter(os.path.join(TRACE_DIR, f"{identifier}_{int(time.time())}.npz"))
+
     signaling = WebsocketSignalingServer(host, port, identifier)
     pc_config = RTCConfiguration(
         iceServers=[
@@ -333,66 +622,7 @@ async def run(host, port, identifier):
         async def on_iceconnectionstatechange():
             print("ICE connection state is", pc.iceConnectionState)
 
-
-        @pc.on("datachannel")
-        def on_datachannel(channel):
-            print("Data channel opened")
-            global data_channel
-            data_channel = channel
-
-            @channel.on("close")
-            def on_close():
-                print("Data channel closed")
-                global data_channel
-                data_channel = None
-
-            @channel.on("stop")
-            def on_stop():
-                print("Data channel stopped")
-                channel.close()
-
-            @channel.on("message")
-            def on_message(message):
-                global test_id
-                print("Message received:", message)
-                if isinstance(message, str):
-                    try:
-                        data = json.loads(message)
-                        if "test_id" in data:
-                            test_id = data["test_id"]
-                        elif "exercise" in data:
-                            global exercise_function, right_leg
-                            match data["exercise"]:
-                                case "arms":
-                                    exercise_function = arms_exercise
-                                case "legs":
-                                    exercise_function = legs_exercise
-                                    right_leg = data.get("right_leg")
-                                case "walk":
-                                    exercise_function = walk_exercise
-                                case _:
-                                    print(f"Unknown exercise type: {data['exercise']}")
-                        elif "status" in data:
-                            print(f"Status message: {data['status']}")
-
-                    except json.JSONDecodeError:
-                        print("Received non-JSON message:", message)
-
-        @pc.on("track")
-        def on_track(track):
-            global media_track
-            print("Track received")
-            media_track = track
-
-        @pc.on("connectionstatechange")
-        async def on_connectionstatechange():
-            print("Connection state is", pc.connectionState)
-            if pc.connectionState == "connected":
-                print("WebRTC connected")
-                asyncio.create_task(handle_track(media_track))
-                
-            elif pc.connectionState in ["closed", "failed", "disconnected"]:
-                print("WebRTC connection ended:", pc.connectionState)
+        attach_peer_connection(pc)
 
         await signaling.handle_messages(pc)
     
@@ -403,82 +633,33 @@ async def run(host, port, identifier):
         print("Exiting...")
     finally:
         print("Closing connection...")
+        print(f"Session summary: {session.summary()}")
+        if gate is not None:
+            print(f"Decode gate: {gate.summary()}")
         
         stop_flag.set()
         await signaling.close()
         await pc.close()
 
+        if trace_writer is not None:
+            # Stop recording before the detector thread gets a chance to add more
+            writer, trace_writer = trace_writer, None
+            frames = len(writer)
+            writer.close()
+            print(f"Trace with {frames} frames written to {writer.path}")
+
+        if uploader is not None:
+            # Stop collecting before flushing what is left
+            running_uploader, uploader = uploader, None
+            running_uploader.close()
 
-def start_processing_unit(identifier, signaling_host, signaling_port):
 
-    time_offset = 0
+def start_processing_unit(identifier, signaling_host, signaling_port):
 
     try:
         asyncio.run(run(signaling_host, signaling_port, identifier))
     except Exception as e:
         print(f"An error occurred: {e}")
-    finally:
-        return
-
-        
-        print("Adding measurements to the test. Please wait...")
-
-        TestsAPI.add_measurement_bulk(
-            results_list= [
-                {
-                    "point": "{\"point_b\": " + str(arrival_time[0]) + "}",
-                    "timestamp": arrival_time[1] + time_offset
-                } for arrival_time in arrival_times
-            ],
-            test_id=test_id,
-        )
-
-        TestsAPI.add_measurement_bulk(
-            results_list= [
-                {
-                    "point": "{\"point_c\": " + str(start_process_time[0]) + "}",
-                    "timestamp": start_process_time[1] + time_offset
-                } for start_process_time in start_process_times
-            ],
-            test_id=test_id,
-        )
-
-        TestsAPI.add_measurement_bulk(
-            results_list= [
-                {
-                    "point": "{\"point_d\": " + str(end_process_time[0]) + "}",
-                    "timestamp": end_process_time[1] + time_offset
-                } for end_process_time in end_process_times
-            ],
-            test_id=test_id,
-        )
-
-        TestsAPI.add_measurement_bulk(
-            results_list= [
-                {
-                    "point": "{\"point_e\": " + str(send_time[0]) + "}",
-                    "timestamp": send_time[1] + time_offset
-                } for send_time in send_times
-            ],
-            test_id=test_id,
-        )
-            
-        print("Test completed and measurements added.")
-        print(f"Test ID: {test_id}")
-
-
-        # traverse arrival_times and calculate the estimated frame rate
-        if arrival_times:
-            first_arrival = arrival_times[0][1]
-            last_arrival = arrival_times[-1][1]
-            estimated_fps = len(arrival_times) / (last_arrival - first_arrival)
-            print(f"Estimated FPS: {estimated_fps:.2f}")
-
-        if end_process_times:
-            first_process = end_process_times[0][1]
-            last_process = end_process_times[-1][1]
-            estimated_processing_fps = len(end_process_times) / (last_process - first_process)
-            print(f"Estimated Processing FPS: {estimated_processing_fps:.2f}")
 
 if __name__ == "__main__":
     
@@ -0,0 +1,73 @@
+from typing import Tuple
+
+class RateController:
+    """Matches the client send rate and resolution to what the unit can use.
+
+    The processing unit reports how many frames per second it received,
+    processed and dropped. Frames the detector drops were encoded and sent for
+    nothing, so the send rate falls straight to the inference rate. Frames
+    lost before reaching the unit mean the link is congested, so the send rate
+    falls to what got through and, once it is already at min_fps, the
+    resolution is stepped down. Recovery is additive and only after a few
+    clean reports in a row, so the rate does not oscillate.
+    """
+
+    SCALES = (1.0, 0.75, 0.5)
+
+    def __init__(self, max_fps: int, min_fps: int = 5, step: int = 2, clean_reports: int = 3):
+        self.max_fps = max_fps
+        self.min_fps = min(min_fps, max_fps)
+        self.step = step
+        self.clean_reports = clean_reports
+        self.fps = max_fps
+        self.scale_index = 0
+        self.clean = 0
+
+    @property
+    def scale(self) -> float:
+        return self.SCALES[self.scale_index]
+
+    def output_size(self, width: int, height: int) -> Tuple[int, int]:
+        # Encoders want even dimensions
+        return (int(width * self.scale) // 2 * 2, int(height * self.scale) // 2 * 2)
+
+    def _set_fps(self, fps: float):
+        self.fps = int(min(max(fps, self.min_fps), self.max_fps))
+
+    def on_stats(self, stats: dict, sent_fps: float) -> bool:
+        """Update the targets from a unit load report.
+
+        Args:
+            stats: The report sent by the processing unit.
+            sent_fps: The rate the client actually sent at over the same period.
+
+        Returns:
+            True if the fps or the resolution changed.
+        """
+        previous = (self.fps, self.scale_index)
+        received_fps = stats.get("received_fps", 0.0)
+        inference_fps = stats.get("inference_fps", 0.0)
+        dropped_fps = stats.get("dropped_fps", 0.0)
+        queue_age = stats.get("queue_age", 0.0) / 1000
+
+        congested = sent_fps > 0 and received_fps < 0.85 * sent_fps
+        overloaded = received_fps > 0 and (dropped_fps > 0.1 * received_fps or queue_age > 1 / self.fps)
+
+        if congested:
+            self.clean = 0
+            if self.fps <= self.min_fps and self.scale_index < len(self.SCALES) - 1:
+                self.scale_index += 1
+            self._set_fps(0.9 * received_fps)
+        elif overloaded:
+            self.clean = 0
+            self._set_fps(inference_fps)
+        else:
+            self.clean += 1
+            if self.clean >= self.clean_reports:
+                self.clean = 0
+                if self.fps < self.max_fps:
+                    self._set_fps(self.fps + self.step)
+                elif self.scale_index > 0:
+                    self.scale_index -= 1
+
+        return (self.fps, self.scale_index) != previous
@@ -0,0 +1,126 @@
+import argparse
+import glob
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from landmark_trace import load_trace, landmark_dicts
+
+EXERCISE_MODULES = {
+    "arms": ("exercises.arms_exercise", "arms_exercise"),
+    "legs": ("exercises.legs_exercise", "legs_exercise"),
+    "walk": ("exercises.walk_exercise", "walk_exercise"),
+}
+
+class ReplayClock:
+    """Stands in for the time module inside the exercises during a replay.
+
+    The exercises time their holds with time.time(), which would make a
+    replay that runs faster than real time behave differently from the
+    recorded session. They see the recorded wall time instead.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+def load_exercises(clock: ReplayClock) -> dict:
+    # The exercises keep their state in module globals, a reload starts them fresh
+    functions = {}
+    for name, (module_name, function_name) in EXERCISE_MODULES.items():
+        module = importlib.reload(importlib.import_module(module_name))
+        if hasattr(module, "time"):
+            module.time = clock
+        functions[name] = getattr(module, function_name)
+    return functions
+
+def replay_trace(path: str) -> dict:
+    """Run a recorded trace through the exercises.
+
+    Returns:
+        A report with the rep count per exercise, the pts of every rep and
+        how many times each exercise changed the state of each segment.
+    """
+    trace = load_trace(path)
+    clock = ReplayClock()
+    functions = load_exercises(clock)
+    exercise_names = [str(name) for name in trace["exercises"]]
+
+    reps = {}
+    rep_pts = []
+    transitions = {}
+    last_styles = {}
+
+    start = time.perf_counter()
+    frames = len(trace["pts"])
+    for row in range(frames):
+        clock.now = float(trace["wall_time"][row])
+        exercise = exercise_names[trace["exercise"][row]]
+        landmarks = landmark_dicts(trace["landmarks"][row], trace["detected"][row])
+        styled_connections, new_rep = functions[exercise](landmarks, bool(trace["right_leg"][row]))
+
+        if new_rep:
+            reps[exercise] = reps.get(exercise, 0) + 1
+            rep_pts.append(int(trace["pts"][row]))
+
+        last_style = last_styles.setdefault(exercise, {})
+        counts = transitions.setdefault(exercise, {})
+        for segment, state in styled_connections.items():
+            if segment in last_style and last_style[segment] != state:
+                counts[segment] = counts.get(segment, 0) + 1
+            last_style[segment] = state
+    elapsed = time.perf_counter() - start
+
+    return {
+        "trace": path,
+        "frames": frames,
+        "reps": reps,
+        "rep_pts": rep_pts,
+        "transitions": transitions,
+        "seconds": elapsed,
+    }
+
+def expand_paths(patterns) -> list:
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.npz")
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    return paths
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay recorded landmark traces through the exercises")
+    parser.add_argument("traces", nargs="+", help="Trace files, directories or glob patterns")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, 0 for one per CPU")
+    parser.add_argument("--output", type=str, default=None, help="Write the full reports as JSON to this file")
+
+    args = parser.parse_args()
+
+    paths = expand_paths(args.traces)
+    start = time.perf_counter()
+    if args.workers == 1:
+        reports = [replay_trace(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers or os.cpu_count()) as executor:
+            reports = list(executor.map(replay_trace, paths, chunksize=max(1, len(paths) // (4 * (args.workers or os.cpu_count())))))
+    elapsed = time.perf_counter() - start
+
+    total_frames = 0
+    total_reps = {}
+    for report in reports:
+        total_frames += report["frames"]
+        for exercise, count in report["reps"].items():
+            total_reps[exercise] = total_reps.get(exercise, 0) + count
+        print(f"{report['trace']}: {report['frames']} frames, reps {report['reps']}, transitions {report['transitions']}")
+
+    print(f"Replayed {len(reports)} traces, {total_frames} frames in {elapsed:.2f} s ({total_frames / max(elapsed, 1e-9):.0f} frames/s)")
+    print(f"Total reps: {total_reps}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
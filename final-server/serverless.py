@@ -1,226 +1,342 @@
-import mediapipe as mp
+import argparse
+import queue
+import threading
+import time
+from dataclasses import asdict
+from multiprocessing import Process
+from typing import Callable, Optional
+
 import cv2
-import utils
+import mediapipe as mp
+from mediapipe.tasks.python import vision
 
-mp_drawing = mp.solutions.drawing_utils
-mp_pose = mp.solutions.pose
-pose = mp_pose.Pose(
-    model_complexity=1,
-    min_detection_confidence=0.9,
-    min_tracking_confidence=0.5)
-
-class Joint:
-    def __init__(self, joint):
-        self.x = joint.x
-        self.y = joint.y
-
-right_arm_state_repetition = 0
-right_arm_state = None
-
-def right_arm_angle(right_shoulder, right_elbow, right_wrist):
-    global right_arm_state_repetition, right_arm_state
-    right_arm = None
-    if right_shoulder.visibility > 0.5 and right_elbow.visibility > 0.5 and right_wrist.visibility > 0.5:
-        new_right_shoulder = Joint(right_shoulder)
-        new_right_shoulder.x = -right_shoulder.x
-        new_right_wrist = Joint(right_wrist)
-        new_right_wrist.x = -right_wrist.x
-        right_arm_angle = utils.get_angle_2_points_x_axis(new_right_shoulder, new_right_wrist)
-        right_elbow_angle = utils.get_angle_3_points(right_shoulder, right_elbow, right_wrist)
-
-        if right_arm_angle < 10 and right_elbow_angle > 140:
-            right_arm = True
-        elif right_arm_angle > 60:
-            right_arm = None
-        else:
-            right_arm = False
-
-    if right_arm != right_arm_state:
-        right_arm_state_repetition -= 1
-
-        if right_arm == False and right_arm_state_repetition < -20:
-            right_arm_state_repetition = 0
-            right_arm_state = right_arm
-        elif right_arm_state_repetition < 0:
-            right_arm_state_repetition = 0
-            right_arm_state = right_arm
-
-    else: 
-        if right_arm_state_repetition < 10:
-            right_arm_state_repetition += 1
-
-    return right_arm_state
-
-left_arm_state_repetition = 0
-left_arm_state = None
-
-def left_arm_angle(left_shoulder, left_elbow, left_wrist):
-    global left_arm_state_repetition, left_arm_state
-    left_arm = None
-
-    if left_shoulder.visibility > 0.5 and left_elbow.visibility > 0.5 and left_wrist.visibility > 0.5:
-        left_arm_angle = utils.get_angle_2_points_x_axis(left_shoulder, left_wrist)
-        left_elbow_angle = utils.get_angle_3_points(left_shoulder, left_elbow, left_wrist)
-        
-        if left_arm_angle < 10 and left_elbow_angle > 140:
-            left_arm = True
-        elif left_arm_angle > 60:
-            left_arm = None
-        else:
-            left_arm = False
-
-    if left_arm != left_arm_state:
-        left_arm_state_repetition -= 1
-
-        if left_arm == False and left_arm_state_repetition < -20:
-            left_arm_state_repetition = 0
-            left_arm_state = left_arm
-        elif left_arm_state_repetition < 0:
-            left_arm_state_repetition = 0
-            left_arm_state = left_arm
-
-    else:   
-        if left_arm_state_repetition < 10:
-            left_arm_state_repetition += 1
-
-    return left_arm_state
-    
-
-def arms_angle(right_shoulder, left_shoulder, right_elbow, left_elbow, right_wrist, left_wrist):
-    right_arm_state = right_arm_angle(right_shoulder, right_elbow, right_wrist) 
-    left_arm_state = left_arm_angle(left_shoulder, left_elbow, left_wrist)
-
-    return right_arm_state, left_arm_state
-
-spine_state_repetition = 0
-spine_state = None
-
-def spine_straight(right_shoulder, left_shoulder, right_hip, left_hip):
-    global spine_state_repetition, spine_state
-    spine = None
-    if right_shoulder.visibility > 0.5 and left_shoulder.visibility > 0.5 and right_hip.visibility > 0.5 and left_hip.visibility > 0.5:
-        angle_shoulder_hip = utils.get_angle_4_points(right_shoulder, left_shoulder, right_hip, left_hip)
-        new_left_shoulder = Joint(left_shoulder)
-        new_left_shoulder.x = -left_shoulder.x
-        new_right_shoulder = Joint(right_shoulder)
-        new_right_shoulder.x = -right_shoulder.x
-        new_right_hip = Joint(right_hip)
-        new_right_hip.x = -right_hip.x
-        angle_left_shoulder_hip = utils.get_angle_3_points(new_left_shoulder, new_right_shoulder, new_right_hip)
-        angle_right_shoulder_hip = utils.get_angle_3_points(right_shoulder, left_shoulder, left_hip)
-        
-        if angle_shoulder_hip < 7 and angle_left_shoulder_hip - angle_right_shoulder_hip < 10:
-            spine = True
+import utils
+from detector_factory import create_detector
+from capture import CaptureThread, select_capture_size
+from display import SharedFrameBuffer, start_display
+from exercises.arms_exercise import arms_exercise
+from exercises.legs_exercise import legs_exercise
+from exercises.walk_exercise import walk_exercise
+from session import ExerciseSession
+
+EXERCISES = {
+    "arms": arms_exercise,
+    "legs": legs_exercise,
+    "walk": walk_exercise,
+}
+
+# What a stage does when a job arrives and its queue is full
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+REPORT_INTERVAL = 5.0
+
+class FrameJob:
+    """A frame on its way through the pipeline and what the stages found out about it."""
+
+    __slots__ = ("sequence", "capture_time", "image", "rgb", "mp_image", "landmarks", "style_code")
+
+    def __init__(self, sequence: int, capture_time: float, image, rgb):
+        self.sequence = sequence
+        self.capture_time = capture_time
+        self.image = image
+        self.rgb = rgb
+        self.mp_image = None
+        self.landmarks = []
+        self.style_code = 0
+
+class Stage:
+    """One step of the pipeline, running on its own thread and fed through a bounded queue.
+
+    Args:
+        name: Shown in the utilization reports.
+        work: Called with every job, returns the job to hand to the next
+            stage or None to stop it here.
+        capacity: Jobs waiting for the stage at most.
+        policy: What put does when the queue is full. BLOCK waits for room,
+            for stages that must see every job. DROP_OLDEST discards the job
+            that waited longest, so a stage that can't keep up always works
+            on the freshest frame. DROP_NEWEST discards the incoming job.
+    """
+
+    def __init__(self, name: str, work: Callable, capacity: int = 1, policy: str = DROP_OLDEST):
+        self.name = name
+        self.work = work
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=capacity)
+        self.next: Optional[Stage] = None
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+        self.stats_lock = threading.Lock()
+        self.busy = 0.0
+        self.processed = 0
+        self.dropped = 0
+
+    def start(self):
+        self.thread.start()
+
+    def put(self, job) -> bool:
+        """Queue a job following the stage's policy, returns False if a job was dropped."""
+        if self.policy == BLOCK:
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(job, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        dropped = False
+        while True:
+            try:
+                self.queue.put_nowait(job)
+                break
+            except queue.Full:
+                dropped = True
+                if self.policy == DROP_NEWEST:
+                    break
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+        if dropped:
+            with self.stats_lock:
+                self.dropped += 1
+        return not dropped
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                job = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            start = time.perf_counter()
+            try:
+                job = self.work(job)
+            except Exception as e:
+                print(f"Error in the {self.name} stage: {e}")
+                job = None
+            elapsed = time.perf_counter() - start
+
+            with self.stats_lock:
+                self.busy += elapsed
+                self.processed += 1
+            if job is not None and self.next is not None:
+                self.next.put(job)
+
+    def report(self, elapsed: float) -> dict:
+        """Utilization and throughput since the last report, then reset the counters.
+
+        utilization is the share of the time the stage spent working, the
+        stage at or near 1.0 is the one limiting the frame rate.
+        """
+        with self.stats_lock:
+            report = {
+                "utilization": round(self.busy / elapsed, 2),
+                "fps": round(self.processed / elapsed, 1),
+                "dropped": self.dropped,
+                "queued": self.queue.qsize(),
+            }
+            self.busy = 0.0
+            self.processed = 0
+            self.dropped = 0
+        return report
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1)
+
+class Pipeline:
+    """Runs the whole exercise locally, without a processing unit, as overlapping stages.
+
+    capture -> preprocess -> detect -> evaluate -> render -> display
+
+    The camera is read by a CaptureThread and the display is the client's
+    display process fed through shared memory, every other stage has its own
+    thread. While the detector works on one frame the next one is already
+    being prepared and the previous one evaluated and drawn, so the frame
+    rate is set by the slowest stage instead of the sum of all of them.
+    OpenCV and MediaPipe release the GIL in their heavy calls, which is
+    what lets the threads overlap.
+
+    Frames are only dropped where it doesn't matter: the detector and the
+    renderer always take the freshest frame, the evaluation sees every
+    detection so no repetition is missed.
+
+    Args:
+        camera: Camera index or path.
+        width: Camera frame width, also the size shown.
+        height: Camera frame height.
+        fps: Camera frame rate.
+        inference_size: (width, height) of the frames given to the detector.
+        exercise: One of EXERCISES.
+        right_leg: Which leg the legs exercise watches.
+        model_path: Pose landmarker model, None for the one calibrated for this machine.
+    """
+
+    def __init__(self, camera, width: int = 1280, height: int = 720, fps: int = 30,
+                 inference_size: tuple = (640, 360), exercise: str = "arms", right_leg: bool = True,
+                 model_path: Optional[str] = None):
+        self.exercise_function = EXERCISES[exercise]
+        self.right_leg = right_leg
+        self.session = ExerciseSession(exercise)
+        self.reps = 0
+
+        width, height = select_capture_size(width, height)
+        self.capture = CaptureThread(camera, width, height, fps, inference_size)
+        self.last_sequence = 0
+        self.last_timestamp_ms = -1
+
+        options = vision.PoseLandmarkerOptions(
+            base_options=mp.tasks.BaseOptions(model_asset_path=model_path or ""),
+            # Frames are given one at a time by the detect stage, which does the dropping itself
+            running_mode=vision.RunningMode.VIDEO,
+            num_poses=1,
+            min_pose_detection_confidence=0.5,
+            min_tracking_confidence=0.5,
+        )
+        if model_path is None:
+            self.detector = create_detector(options)
         else:
-            spine = False
-    
-    if spine != spine_state:
-        spine_state_repetition -= 1
-
-        if spine_state_repetition < 0:
-            spine_state_repetition = 0
-            spine_state = spine
-
-    else:
-        if spine_state_repetition < 10:
-            spine_state_repetition += 1
-
-    return spine_state
-
-arms_exercise_state_repetition = 0
-arms_exercise_state = None
-old_arms_exercise_state = None
-arms_exercise_reps = 0
-
-def arms_exercise(landmarks):
-    global arms_exercise_state_repetition, arms_exercise_state, arms_exercise_reps, old_arms_exercise_state
-
-    spine_state = spine_straight(
-        landmarks.landmark[12],
-        landmarks.landmark[11],
-        landmarks.landmark[24],
-        landmarks.landmark[23]
+            self.detector = vision.PoseLandmarker.create_from_options(options)
+        self.renderer = utils.PoseRenderer()
+        self.frame_buffer = SharedFrameBuffer(width, height)
+        self.display_process = None
+
+        self.latency_lock = threading.Lock()
+        self.latency = 0.0
+        self.presented = 0
+
+        self.stages = [
+            Stage("capture", self.grab, capacity=1, policy=DROP_OLDEST),
+            Stage("preprocess", self.preprocess, capacity=1, policy=DROP_OLDEST),
+            Stage("detect", self.detect, capacity=1, policy=DROP_OLDEST),
+            Stage("evaluate", self.evaluate, capacity=4, policy=BLOCK),
+            Stage("render", self.render, capacity=1, policy=DROP_OLDEST),
+        ]
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+
+    def grab(self, sequence: int) -> Optional[FrameJob]:
+        captured = self.capture.acquire(self.last_sequence)
+        if captured is None:
+            return None
+        try:
+            sequence, image, rgb, capture_time = captured
+            self.last_sequence = sequence
+            # The capture ring reuses its slots, the later stages need their own copy
+            return FrameJob(sequence, capture_time, image.copy(), rgb.copy())
+        finally:
+            self.capture.release()
+
+    def preprocess(self, job: FrameJob) -> FrameJob:
+        job.mp_image = mp.Image(image_format=mp.ImageFormat.SRGB, data=job.rgb)
+        return job
+
+    def detect(self, job: FrameJob) -> FrameJob:
+        # VIDEO mode needs strictly increasing timestamps
+        timestamp_ms = max(int(job.capture_time * 1000), self.last_timestamp_ms + 1)
+        self.last_timestamp_ms = timestamp_ms
+        results = self.detector.detect_for_video(job.mp_image, timestamp_ms)
+        job.mp_image = None
+        job.landmarks = [asdict(landmark) for landmark in results.pose_landmarks[0]] if len(results.pose_landmarks) > 0 else []
+        return job
+
+    def evaluate(self, job: FrameJob) -> FrameJob:
+        styled_connections, new_rep = self.exercise_function(job.landmarks, self.right_leg)
+        job.style_code = utils.encode_style(styled_connections)
+        self.session.update(styled_connections, new_rep, job.capture_time)
+        self.reps = self.session.reps
+        return job
+
+    def render(self, job: FrameJob) -> None:
+        slot, image = self.frame_buffer.begin_write(job.image)
+        if job.landmarks:
+            self.renderer.draw(image, [(landmark["x"], landmark["y"]) for landmark in job.landmarks], job.style_code)
+        cv2.putText(image, f"Repetitions: {self.reps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
+        self.frame_buffer.publish(slot)
+
+        with self.latency_lock:
+            self.latency += time.monotonic() - job.capture_time
+            self.presented += 1
+        return None
+
+    def report(self, elapsed: float) -> dict:
+        report = {stage.name: stage.report(elapsed) for stage in self.stages}
+        with self.latency_lock:
+            report["shown_fps"] = round(self.presented / elapsed, 1)
+            report["latency_ms"] = round(1000 * self.latency / self.presented, 1) if self.presented else None
+            self.latency = 0.0
+            self.presented = 0
+        return report
+
+    def run(self, report_interval: float = REPORT_INTERVAL):
+        """Run until the display window is closed with q or the camera fails."""
+        self.display_process = Process(target=start_display, args=(self.frame_buffer,))
+        self.display_process.start()
+        for stage in self.stages:
+            stage.start()
+
+        capture_stage = self.stages[0]
+        self.capture.on_frame = lambda: capture_stage.put(self.capture.sequence)
+        self.capture.start()
+
+        last_report = time.monotonic()
+        try:
+            while self.display_process.is_alive() and not self.capture.failed:
+                time.sleep(0.1)
+                now = time.monotonic()
+                if now - last_report >= report_interval:
+                    print_report(self.report(now - last_report))
+                    last_report = now
+        except KeyboardInterrupt:
+            print("Exiting...")
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.capture.on_frame = None
+        self.capture.stop()
+        for stage in self.stages:
+            stage.stop()
+        self.detector.close()
+
+        if self.display_process is not None and self.display_process.is_alive():
+            self.display_process.terminate()
+            self.display_process.join()
+        self.frame_buffer.close()
+        self.frame_buffer.unlink()
+        print(f"Session summary: {self.session.summary()}")
+
+def print_report(report: dict):
+    stages = " | ".join(
+        f"{name} {stats['utilization']:.0%} {stats['fps']} fps"
+        + (f" {stats['dropped']} dropped" if stats["dropped"] else "")
+        for name, stats in report.items() if isinstance(stats, dict)
     )
-
-    right_arm_state, left_arm_state = arms_angle(
-        landmarks.landmark[12],
-        landmarks.landmark[11],
-        landmarks.landmark[14],
-        landmarks.landmark[13],
-        landmarks.landmark[16],
-        landmarks.landmark[15]
-    )
-
-    arms_exercise = None
-
-    if right_arm_state is None and left_arm_state is None:
-        arms_exercise = None
-
-    elif right_arm_state and left_arm_state and spine_state:
-        arms_exercise = True
-
-    elif not right_arm_state or not left_arm_state or not spine_state:
-        arms_exercise = False
-
-    if arms_exercise != arms_exercise_state:
-        arms_exercise_state_repetition -= 1
-
-        if arms_exercise_state_repetition < 0:
-            arms_exercise_state_repetition = 0
-            if arms_exercise == True and (old_arms_exercise_state is None or arms_exercise_state is None):
-                arms_exercise_reps += 1
-                
-            old_arms_exercise_state = arms_exercise_state
-            arms_exercise_state = arms_exercise
-    else:
-        if arms_exercise_state_repetition < 5:
-            arms_exercise_state_repetition += 1
-
-    right_arm_style = utils.GREEN_STYLE if left_arm_state else utils.RED_STYLE
-    left_arm_style = utils.GREEN_STYLE if right_arm_state else utils.RED_STYLE
-    torso_style = utils.GREEN_STYLE if spine_state else utils.RED_STYLE
-    
-    styled_connections = utils.get_colored_style(
-        right_arm= None if arms_exercise is None else right_arm_style,
-        left_arm= None if arms_exercise is None is None else left_arm_style,
-        torso= None if arms_exercise is None else torso_style,
+    print(f"{stages} | shown {report['shown_fps']} fps, {report['latency_ms']} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the exercises locally with a pipelined capture, inference and display")
+    parser.add_argument("--camera", type=int, default=0, help="Camera index")
+    parser.add_argument("--width", type=int, default=1280, help="Camera frame width")
+    parser.add_argument("--height", type=int, default=720, help="Camera frame height")
+    parser.add_argument("--fps", type=int, default=30, help="Camera frame rate")
+    parser.add_argument("--inference-width", type=int, default=640, help="Width of the frames given to the detector")
+    parser.add_argument("--inference-height", type=int, default=360, help="Height of the frames given to the detector")
+    parser.add_argument("--exercise", choices=EXERCISES.keys(), default="arms")
+    parser.add_argument("--left-leg", action="store_true", help="Watch the left leg in the legs exercise")
+    parser.add_argument("--model", type=str, default=None, help="Pose landmarker model, calibrated for this machine by default")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(
+        args.camera, args.width, args.height, args.fps,
+        inference_size=(args.inference_width, args.inference_height),
+        exercise=args.exercise, right_leg=not args.left_leg, model_path=args.model,
     )
-    return styled_connections
-
-cap = cv2.VideoCapture(0)
-cap.set(cv2.CAP_PROP_FPS, 30)
-cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-
-while True:
-    ret, frame = cap.read()
-    if not ret:
-        print("Failed to read frame from camera")
-        break
-
-    image = cv2.flip(frame, 1)
-    results = pose.process(image)
-
-    if results.pose_landmarks:
-        landmarks = results.pose_landmarks
-        styled_connections = None #arms_exercise(landmarks)
-
-        if styled_connections:
-            mp_drawing.draw_landmarks(
-                image=image,
-                landmark_list=landmarks,
-                connections=utils._POSE_CONNECTIONS,
-                connection_drawing_spec=styled_connections,
-            )
-        else:
-            mp_drawing.draw_landmarks(
-                image=image,
-                landmark_list=landmarks,
-                connections=utils._POSE_CONNECTIONS,
-            )
-
-    cv2.putText(image, f"Repetitions: {arms_exercise_reps}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2, cv2.LINE_AA)
-    cv2.imshow("MediaPipe Pose", image)
-
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
\ No newline at end of file
+    pipeline.run()
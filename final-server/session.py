@@ -0,0 +1,75 @@
+from typing import Dict, List, Optional
+
+# Longer gaps between results are treated as the user leaving the frame
+MAX_FRAME_GAP = 0.5
+
+class ExerciseSession:
+    """Authoritative counters for one exercise, kept by the processing unit.
+
+    Clients used to count reps by summing per-frame new_rep flags, so a single
+    lost result miscounted. The unit now owns the counts and sends them as
+    reliable events, and the per-frame results only drive the overlay.
+
+    Counters:
+        reps: completed repetitions.
+        time_under_tension: seconds during which the exercise was being
+            performed, i.e. any body segment was styled green or red.
+        violations: per body segment, how many times it turned red.
+    """
+
+    def __init__(self, exercise: str, snapshot_interval: float = 5.0):
+        self.exercise = exercise
+        self.snapshot_interval = snapshot_interval
+        self.reps = 0
+        self.time_under_tension = 0.0
+        self.violations: Dict[str, int] = {}
+        self.segments: Dict[str, Optional[bool]] = {}
+        self.start_time = None
+        self.last_time = None
+        self.last_snapshot = None
+
+    def update(self, styled_connections: dict, new_rep: bool, timestamp: float) -> List[dict]:
+        """Account for one exercise result.
+
+        Args:
+            styled_connections: The segment styles returned by the exercise.
+            new_rep: Whether the exercise completed a repetition on this frame.
+            timestamp: When the frame was captured, in seconds.
+
+        Returns:
+            The events to send to the client, possibly empty.
+        """
+        events = []
+        if self.start_time is None:
+            self.start_time = timestamp
+            self.last_snapshot = timestamp
+
+        engaged = any(state is not None for state in styled_connections.values())
+        if engaged and self.last_time is not None and 0 < timestamp - self.last_time <= MAX_FRAME_GAP:
+            self.time_under_tension += timestamp - self.last_time
+        self.last_time = timestamp
+
+        for segment, state in styled_connections.items():
+            if state is False and self.segments.get(segment) is not False:
+                self.violations[segment] = self.violations.get(segment, 0) + 1
+            self.segments[segment] = state
+
+        if new_rep:
+            self.reps += 1
+            events.append({"event": "rep", "exercise": self.exercise, "reps": self.reps})
+
+        if timestamp - self.last_snapshot >= self.snapshot_interval:
+            self.last_snapshot = timestamp
+            events.append(self.summary("snapshot"))
+
+        return events
+
+    def summary(self, event: str = "session_end") -> dict:
+        return {
+            "event": event,
+            "exercise": self.exercise,
+            "reps": self.reps,
+            "time_under_tension": round(self.time_under_tension, 2),
+            "duration": round(self.last_time - self.start_time, 2) if self.start_time is not None else 0.0,
+            "violations": dict(self.violations),
+        }
@@ -3,7 +3,16 @@ from mediapipe.python.solutions.pose import PoseLandmark
 from mediapipe.python.solutions.drawing_utils import DrawingSpec
 import mediapipe.python.solutions.drawing_styles as mp_drawing_styles
 import math
-from typing import Optional
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import itertools
+import numpy as np
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
 from mediapipe.framework.formats.landmark_pb2 import NormalizedLandmark
 #import ntplib
 
@@ -18,9 +27,87 @@ from mediapipe.framework.formats.landmark_pb2 import NormalizedLandmark
         print("NTP synchronization failed:", e)
         return None"""
     
+# Shared clock state published by clock_sync/daemon.py, see STATE_FORMAT there
+_CLOCK_SYNC_PATH = "/dev/shm/clock_sync" if sys.platform == "linux" else os.path.join(tempfile.gettempdir(), "clock_sync")
+_CLOCK_SYNC_FORMAT = "<Qdddddd"
+_clock_sync_map = None
+_clock_sync_last = None
+# An update takes microseconds, a daemon that died halfway through one leaves seq odd for good
+_CLOCK_SYNC_RETRIES = 500
+# The daemon samples every few seconds, past this its extrapolation is no longer trusted
+_CLOCK_SYNC_MAX_AGE = 60.0
+# One-shot offset written by clock_sync/client.py, used without a running daemon
+_OFFSET_FILE_PATH = "/tmp/ntp_offset.txt"
+_file_offset = None
+
+def load_time_sync():
+    """Open the daemon's clock state and read the one-shot offset file.
+
+    The files are only touched here, so get_time_offset is safe to call on
+    the frame path. Call it when a test starts, a daemon started later is
+    picked up on the next call.
+    """
+    global _clock_sync_map, _file_offset
+    if _clock_sync_map is None:
+        try:
+            with open(_CLOCK_SYNC_PATH, "rb") as f:
+                _clock_sync_map = mmap.mmap(f.fileno(), struct.calcsize(_CLOCK_SYNC_FORMAT), access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            pass
+    try:
+        with open(_OFFSET_FILE_PATH, "r") as f:
+            _file_offset = (float(f.readline().strip()), math.inf)
+    except (OSError, ValueError):
+        # Unsynchronized, the timestamps are local ones
+        _file_offset = (0.0, math.inf)
+
+def _read_clock_sync() -> Optional[tuple]:
+    global _clock_sync_last
+    if _clock_sync_map is None:
+        return None
+
+    # Retry while the daemon is halfway through an update, then settle for the last good state
+    state = _clock_sync_last
+    for _ in range(_CLOCK_SYNC_RETRIES):
+        seq = struct.unpack_from("<Q", _clock_sync_map, 0)[0]
+        if seq & 1:
+            continue
+        read = struct.unpack_from(_CLOCK_SYNC_FORMAT, _clock_sync_map, 0)
+        if read[0] == seq and struct.unpack_from("<Q", _clock_sync_map, 0)[0] == seq:
+            state = _clock_sync_last = read[1:] if seq else None
+            break
+
+    if state is None or time.time() - state[0] > _CLOCK_SYNC_MAX_AGE:
+        return None
+    return state
+
+def get_time_offset_with_error(now: Optional[float] = None) -> Tuple[float, float]:
+    """Get the clock offset to the sync server and how far off it may be.
+
+    Uses the estimate kept by the clock sync daemon, extrapolated with its
+    drift, so reading it costs a few struct unpacks and no file access.
+    Without a running daemon, or with one that stopped updating, it falls
+    back to the one-shot offset file, or to no offset at all if there is
+    none. Both are opened by load_time_sync, on the first call otherwise.
+
+    Args:
+        now: The local time.time() to get the offset at, defaults to now.
+
+    Returns:
+        (offset, error) in seconds. error is inf for the one-shot offset.
+    """
+    if _file_offset is None:
+        load_time_sync()
+    state = _read_clock_sync()
+    if state is None:
+        return _file_offset
+
+    ref_time, offset, skew, error, skew_error, _ = state
+    age = (time.time() if now is None else now) - ref_time
+    return offset + skew * age, error + skew_error * abs(age)
+
 def get_time_offset():
-    with open("/tmp/ntp_offset.txt", "r") as f:
-        return float(f.readline().strip())
+    return get_time_offset_with_error()[0]
 
 _GREEN = (48, 255, 48)
 _RED = (0, 0, 255)
@@ -40,9 +127,9 @@ GREEN_STYLE = DrawingSpec(color=_GREEN, thickness=_THICKNESS_CONTOURS)
 WHITE_STYLE = DrawingSpec(color=_WHITE, thickness=_THICKNESS_CONTOURS)
 RED_STYLE = DrawingSpec(color=_RED, thickness=_THICKNESS_CONTOURS)
 
-_DEFAULT_POSE_LANDMARK_DRAWSPEC = {
+_DEFAULT_POSE_LANDMARK_DRAWSPEC = MappingProxyType({
     connection: WHITE_STYLE for connection in _POSE_CONNECTIONS
-}
+})
 
 _LEFT_ARM_CONNECTIONS = frozenset(
     [(PoseLandmark.LEFT_SHOULDER, PoseLandmark.LEFT_ELBOW),
@@ -123,21 +210,96 @@ _RIGHT_LEG_AND_FOOT_CONNECTIONS = frozenset(
      (PoseLandmark.RIGHT_ANKLE, PoseLandmark.RIGHT_FOOT_INDEX)]
 )
 
-def get_green_arms_and_hands_style() -> dict:
-    """Returns the default pose arms and hands drawing style.
+# Order of the body segments in a style code
+STYLE_SEGMENTS = ("right_arm", "left_arm", "torso", "left_leg", "right_leg")
+
+_STYLE_SEGMENT_CONNECTIONS = (
+    _RIGHT_ARM_AND_HAND_CONNECTIONS,
+    _LEFT_ARM_AND_HAND_CONNECTIONS,
+    _TORSO_CONNECTIONS,
+    _LEFT_LEG_AND_FOOT_CONNECTIONS,
+    _RIGHT_LEG_AND_FOOT_CONNECTIONS,
+)
+
+# Each segment is a trit: 0 default (white), 1 correct (green), 2 wrong (red)
+_STYLE_STATES = (None, True, False)
+_STYLE_STATE_SPECS = (None, GREEN_STYLE, RED_STYLE)
+
+STYLE_CODES = 3 ** len(STYLE_SEGMENTS)
+
+def encode_style(connections_style: Optional[dict]) -> int:
+    """Encode a per segment style dict as a small integer.
+
+    Args:
+        connections_style: Mapping from body segment to True (green), False
+            (red) or None (default). Missing segments count as None.
 
     Returns:
-        A mapping from each pose landmark to its default drawing spec.
+        A code in range(STYLE_CODES), 0 meaning everything default.
     """
-    arms_and_hands_style = _DEFAULT_POSE_LANDMARK_DRAWSPEC
-    
-    for connection in _LEFT_ARM_AND_HAND_CONNECTIONS:
-        arms_and_hands_style[connection] = GREEN_STYLE
+    if not connections_style:
+        return 0
+    code = 0
+    for power, segment in enumerate(STYLE_SEGMENTS):
+        value = connections_style.get(segment)
+        if value is not None:
+            code += (1 if value else 2) * 3 ** power
+    return code
+
+def decode_style(code: int) -> dict:
+    """Inverse of encode_style, returns the style dict for a code."""
+    connections_style = {}
+    for segment in STYLE_SEGMENTS:
+        code, state = divmod(code, 3)
+        connections_style[segment] = _STYLE_STATES[state]
+    return connections_style
+
+def _build_style_table(states: Tuple[int, ...]) -> Mapping:
+    connections = dict(_DEFAULT_POSE_LANDMARK_DRAWSPEC)
+    for segment_connections, state in zip(_STYLE_SEGMENT_CONNECTIONS, states):
+        if state == 0:
+            continue
+        for connection in segment_connections:
+            connections[connection] = _STYLE_STATE_SPECS[state]
+    return MappingProxyType(connections)
+
+def _build_style_groups(table: Mapping) -> tuple:
+    # DrawingSpec is not hashable, group on what actually gets drawn
+    groups = {}
+    for connection, style in table.items():
+        groups.setdefault((style.color, style.thickness), (style, []))[1].append(connection)
+
+    # Default connections first so the coloured segments end up on top
+    return tuple(
+        (style, np.array(sorted(group), dtype=np.intp))
+        for style, group in sorted(groups.values(), key=lambda item: item[0] is not WHITE_STYLE)
+    )
+
+# Read only connection -> DrawingSpec tables, indexed by style code
+STYLE_TABLES = tuple(
+    _build_style_table(tuple(reversed(states)))
+    for states in itertools.product(range(3), repeat=len(STYLE_SEGMENTS))
+)
 
-    return arms_and_hands_style
+# (DrawingSpec, connection index array) groups, indexed by style code
+STYLE_GROUPS = tuple(_build_style_groups(table) for table in STYLE_TABLES)
 
-def get_colored_style(right_arm: DrawingSpec = None, left_arm: DrawingSpec = None, torso: DrawingSpec = None, left_leg: DrawingSpec = None, right_leg: DrawingSpec = None) -> dict:
-    """Returns a mapping from each pose landmark to its default drawing spec.
+def get_green_arms_and_hands_style() -> Mapping:
+    """Returns the default pose style with the left arm and hand in green.
+
+    Returns:
+        A read only mapping from each pose connection to its drawing spec.
+    """
+    return STYLE_TABLES[encode_style({"left_arm": True})]
+
+def _get_spec_state(spec: Optional[DrawingSpec]) -> Optional[int]:
+    for state, state_spec in enumerate(_STYLE_STATE_SPECS):
+        if spec is state_spec:
+            return state
+    return None
+
+def get_colored_style(right_arm: DrawingSpec = None, left_arm: DrawingSpec = None, torso: DrawingSpec = None, left_leg: DrawingSpec = None, right_leg: DrawingSpec = None) -> Mapping:
+    """Returns a mapping from each pose connection to its drawing spec.
 
     Args:
         right_arm: The drawing spec for the right arm.
@@ -147,32 +309,24 @@ def get_colored_style(right_arm: DrawingSpec = None, left_arm: DrawingSpec = Non
         right_leg: The drawing spec for the right leg.
 
     Returns:
-        A mapping from each pose landmark to its default drawing spec.
+        A read only mapping from each pose connection to its drawing spec. The
+        precomputed table is returned when only GREEN_STYLE and RED_STYLE are
+        used.
     """
+    specs = (right_arm, left_arm, torso, left_leg, right_leg)
+    states = tuple(_get_spec_state(spec) for spec in specs)
 
-    colored_style = _DEFAULT_POSE_LANDMARK_DRAWSPEC.copy()
-
-    if right_arm:
-        for connection in _RIGHT_ARM_AND_HAND_CONNECTIONS:
-            colored_style[connection] = right_arm
-
-    if left_arm:
-        for connection in _LEFT_ARM_AND_HAND_CONNECTIONS:
-            colored_style[connection] = left_arm
-
-    if torso:
-        for connection in _TORSO_CONNECTIONS:
-            colored_style[connection] = torso
+    if None not in states:
+        code = sum(state * 3 ** power for power, state in enumerate(states))
+        return STYLE_TABLES[code]
 
-    if left_leg:
-        for connection in _LEFT_LEG_AND_FOOT_CONNECTIONS:
-            colored_style[connection] = left_leg
+    colored_style = dict(_DEFAULT_POSE_LANDMARK_DRAWSPEC)
+    for segment_connections, spec in zip(_STYLE_SEGMENT_CONNECTIONS, specs):
+        if spec:
+            for connection in segment_connections:
+                colored_style[connection] = spec
 
-    if right_leg:
-        for connection in _RIGHT_LEG_AND_FOOT_CONNECTIONS:
-            colored_style[connection] = right_leg
-
-    return colored_style
+    return MappingProxyType(colored_style)
 
 
 def get_angle_4_points(p1: dict, p2: dict, p3: dict, p4: dict) -> Optional[float]:
@@ -246,7 +400,6 @@ def get_distance_2_points(p1: dict, p2: dict) -> float:
     dy = p2['y'] - p1['y']
     return math.sqrt(dx ** 2 + dy ** 2)
 
-import numpy as np
 import cv2
 from typing import List, Tuple, Optional, Union
 from mediapipe.python.solutions.drawing_utils import _normalized_to_pixel_coordinates, _BGR_CHANNELS, _VISIBILITY_THRESHOLD, _PRESENCE_THRESHOLD, _BGR_CHANNELS, RED_COLOR, WHITE_COLOR
@@ -325,62 +478,120 @@ def new_draw_landmarks(
             cv2.circle(image, landmark_px, drawing_spec.circle_radius, drawing_spec.color, drawing_spec.thickness)
 
 
+class PoseRenderer:
+    """Draws the landmarks received from the processing unit onto frames.
+
+    Connection index arrays are resolved once per style key and cached, all
+    landmarks are converted to pixels in a single vectorized step and every
+    colour group is drawn with one cv2.polylines call.
+    """
+
+    def __init__(self, landmark_style: DrawingSpec = WHITE_STYLE):
+        self.landmark_style = landmark_style
+        self.landmark_offsets = self._get_landmark_offsets(landmark_style)
+        self.scale = None
+        self.max_pixel = None
+
+    @staticmethod
+    def _get_landmark_offsets(landmark_style: DrawingSpec) -> np.ndarray:
+        """Rasterize the landmark marker once and return its pixel offsets.
+
+        Thick cv2.circle outlines are slow, stamping these offsets at every
+        landmark gives the exact same pixels in one numpy assignment.
+        """
+        size = 2 * (landmark_style.circle_radius + landmark_style.thickness + 2) + 1
+        center = size // 2
+        canvas = np.zeros((size, size), dtype=np.uint8)
+        cv2.circle(canvas, (center, center), landmark_style.circle_radius + 1, 255, landmark_style.thickness)
+        cv2.circle(canvas, (center, center), landmark_style.circle_radius, 255, landmark_style.thickness)
+        rows, cols = np.nonzero(canvas)
+        return np.stack([cols - center, rows - center], axis=1).astype(np.int32)
+
+    def _set_image_size(self, image_cols: int, image_rows: int):
+        self.scale = np.array([image_cols, image_rows], dtype=np.float64)
+        self.max_pixel = np.array([image_cols - 1, image_rows - 1], dtype=np.int32)
+
+    def to_pixels(self, landmarks, image_cols: int, image_rows: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Convert normalized (x, y) landmarks to pixel coordinates.
+
+        Matches _normalized_to_pixel_coordinates: coordinates outside [0, 1]
+        are invalid and valid ones are floored and clamped to the image.
+
+        Returns:
+            (pixels, valid) where pixels is an (N, 2) int32 array and valid is
+            a boolean mask of the landmarks that can be drawn.
+        """
+        if self.scale is None or self.scale[0] != image_cols or self.scale[1] != image_rows:
+            self._set_image_size(image_cols, image_rows)
+
+        normalized = np.asarray(landmarks, dtype=np.float64)[:, :2]
+        valid = np.all((normalized >= 0) & (normalized <= 1), axis=1)
+        pixels = np.minimum(np.floor(normalized * self.scale).astype(np.int32), self.max_pixel)
+        return pixels, valid
+
+    def draw(self, image: np.ndarray, landmarks, style_code: int = 0):
+        """Draws the landmarks and the styled connections on a BGR image.
+
+        Args:
+            image: A three channel BGR image, drawn on in place.
+            landmarks: A list of normalized (x, y) landmark pairs.
+            style_code: A code as returned by encode_style, anything else is
+                drawn with the default style.
+        """
+        if not landmarks:
+            return
+        if not isinstance(style_code, int) or not 0 <= style_code < len(STYLE_GROUPS):
+            # Codes come off the wire, a bad one must not break rendering
+            style_code = 0
+
+        image_rows, image_cols, _ = image.shape
+        pixels, valid = self.to_pixels(landmarks, image_cols, image_rows)
+        num_landmarks = len(pixels)
+
+        markers = (pixels[valid][:, None, :] + self.landmark_offsets).reshape(-1, 2)
+        inside = (markers[:, 0] >= 0) & (markers[:, 0] < image_cols) & (markers[:, 1] >= 0) & (markers[:, 1] < image_rows)
+        markers = markers[inside]
+        image[markers[:, 1], markers[:, 0]] = WHITE_COLOR
+
+        for style, connections in STYLE_GROUPS[style_code]:
+            if connections.max() >= num_landmarks:
+                connections = connections[np.all(connections < num_landmarks, axis=1)]
+            visible = valid[connections[:, 0]] & valid[connections[:, 1]]
+            if not visible.any():
+                continue
+            segments = pixels[connections[visible]]
+            cv2.polylines(image, list(segments), False, style.color, style.thickness)
+
+_DEFAULT_RENDERER = PoseRenderer()
+
 def draw_from_json(
     image: np.ndarray,
     landmark_json: List[dict],
     connections_style: Optional[dict] = None
 ):
-    
-    image_rows, image_cols, _ = image.shape
-    idx_to_coordinates = {}
-    connections = _DEFAULT_POSE_LANDMARK_DRAWSPEC.copy()
-    
-    if connections_style:
-        for key, value in connections_style.items():
-            match key:
-                case 'left_arm':
-                    if value == None:
-                        continue
-                    for connection in _LEFT_ARM_AND_HAND_CONNECTIONS:
-                        connections[connection] = GREEN_STYLE if value else RED_STYLE
-                case 'right_arm':
-                    if value == None:
-                        continue
-                    for connection in _RIGHT_ARM_AND_HAND_CONNECTIONS:
-                        connections[connection] = GREEN_STYLE if value else RED_STYLE
-                case 'torso':
-                    if value == None:
-                        continue
-                    for connection in _TORSO_CONNECTIONS:
-                        connections[connection] = GREEN_STYLE if value else RED_STYLE
-                case 'left_leg':
-                    if value == None:
-                        continue
-                    for connection in _LEFT_LEG_CONNECTIONS:
-                        connections[connection] = GREEN_STYLE if value else RED_STYLE
-                case 'right_leg':
-                    if value == None:
-                        continue
-                    for connection in _RIGHT_LEG_CONNECTIONS:
-                        connections[connection] = GREEN_STYLE if value else RED_STYLE
-                case _:
-                    pass
-
-    for idx, landmark in enumerate(landmark_json):
-        
-        landmark_px = _normalized_to_pixel_coordinates(landmark[0], landmark[1],image_cols, image_rows)
+    """Draws landmarks received as JSON on the image.
 
-        if landmark_px:
-            idx_to_coordinates[idx] = landmark_px
-            cv2.circle(image, landmark_px, WHITE_STYLE.circle_radius + 1, WHITE_COLOR, WHITE_STYLE.thickness)
-            cv2.circle(image, landmark_px, WHITE_STYLE.circle_radius, WHITE_COLOR, WHITE_STYLE.thickness)
+    Kept for existing callers, it goes through a shared PoseRenderer.
+    """
+    _DEFAULT_RENDERER.draw(image, landmark_json, encode_style(connections_style))
 
-    for connection, style in connections.items():
-        
-        start_idx = connection[0]
-        end_idx = connection[1]
+def build_result(landmarks: List[dict], styled_connections: dict, new_rep: bool, frame_pts: int, seq: int) -> dict:
+    """Build the per-frame result the processing unit sends to the client.
 
-        if start_idx not in idx_to_coordinates or end_idx not in idx_to_coordinates:
-            continue
-        
-        cv2.line(image, idx_to_coordinates[start_idx], idx_to_coordinates[end_idx], style.color, style.thickness)
+    Args:
+        landmarks: The detected landmarks as dicts, empty if no pose was found.
+        styled_connections: The segment styles returned by the exercise.
+        new_rep: Whether the exercise completed a repetition on this frame.
+        frame_pts: The pts of the frame the result belongs to.
+        seq: The sequence number of the result.
+
+    Returns:
+        The result, ready to be serialized as JSON.
+    """
+    return {
+        "landmarks": [(round(landmark["x"],7), round(landmark["y"],7)) for landmark in landmarks], # needed to meet MTU limitations
+        "style_code": encode_style(styled_connections),
+        "new_rep": new_rep,
+        "frame_count": frame_pts,
+        "seq": seq
+    }
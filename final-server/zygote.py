@@ -0,0 +1,173 @@
+import os
+import sys
+import mmap
+import signal
+import threading
+from multiprocessing import get_context
+
+# Models the zygote keeps mapped so every forked unit finds them in the page cache
+MODEL_PATHS = [
+    "../models/pose_landmarker_full.task",
+    "../models/pose_landmarker_lite.task",
+    "../models/pose_landmarker_heavy.task",
+]
+
+def preload_model(path: str):
+    """Memory-map a model file read-only and fault its pages in.
+
+    The mapping is file-backed and shared, so every process forked after this
+    call reads the same physical pages instead of loading its own copy.
+    """
+    with open(path, "rb") as f:
+        model_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if hasattr(mmap, "MADV_WILLNEED"):
+        model_map.madvise(mmap.MADV_WILLNEED)
+
+    # Touch one byte per page so the model is resident before the first fork
+    for offset in range(0, len(model_map), mmap.PAGESIZE):
+        model_map[offset]
+
+    return model_map
+
+def _run_unit(processing_unit, identifier, host, port):
+    status = 0
+    try:
+        processing_unit.start_processing_unit(identifier, host, port)
+    except BaseException as e:
+        print(f"Processing unit {identifier} crashed: {e}")
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+def _zygote_main(conn):
+    # Forked units are reaped by the kernel, the zygote never waits for them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # Pay the heavy imports (mediapipe, aiortc, cv2, av, websockets) once
+    import processing_unit
+
+    model_maps = []
+    for path in MODEL_PATHS:
+        if not os.path.exists(path):
+            continue
+        try:
+            model_maps.append(preload_model(path))
+        except (OSError, ValueError) as e:
+            print(f"Error preloading model {path}: {e}")
+
+    conn.send(("ready", os.getpid()))
+
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+
+        if request is None:
+            break
+
+        identifier, host, port = request
+        try:
+            pid = os.fork()
+        except OSError as e:
+            print(f"Error forking processing unit {identifier}: {e}")
+            conn.send(None)
+            continue
+
+        if pid == 0:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            conn.close()
+            # Each unit still builds its own detector inside process_frame
+            _run_unit(processing_unit, identifier, host, port)
+
+        conn.send(pid)
+
+    for model_map in model_maps:
+        model_map.close()
+    conn.close()
+
+class Zygote:
+    """A preloaded process that forks processing units on demand.
+
+    Only available where os.fork exists; callers fall back to spawning a fresh
+    interpreter per unit otherwise.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.pid = None
+        # spawn runs on executor threads, one request and its answer at a time on the pipe
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_supported() -> bool:
+        return hasattr(os, "fork")
+
+    def start(self, timeout: float = 60) -> bool:
+        """Start the zygote and wait until the heavy modules are loaded."""
+        context = get_context("fork")
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_zygote_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+
+        if not self.conn.poll(timeout):
+            print("Zygote did not become ready in time")
+            self.close()
+            return False
+
+        try:
+            status, self.pid = self.conn.recv()
+        except EOFError:
+            print("Zygote exited during startup")
+            self.close()
+            return False
+
+        print(f"Zygote ready with pid {self.pid}")
+        return status == "ready"
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def spawn(self, identifier: str, host: str, port: str, timeout: float = 10):
+        """Fork a new processing unit from the zygote.
+
+        Blocks until the zygote answers, callers on an event loop run it in
+        an executor. A zygote that does not answer within timeout is
+        stopped, its late answer would be taken for the next unit's.
+
+        Returns:
+            The pid of the new unit, or None if the zygote could not fork it.
+        """
+        with self.lock:
+            if not self.is_alive():
+                return None
+            try:
+                self.conn.send((identifier, host, port))
+                if self.conn.poll(timeout):
+                    return self.conn.recv()
+            except (EOFError, OSError) as e:
+                print(f"Error spawning processing unit from zygote: {e}")
+                return None
+            print(f"Zygote did not answer in {timeout} s, stopping it")
+            self.process.terminate()
+            return None
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.send(None)
+            except (OSError, ValueError):
+                pass
+            self.conn.close()
+            self.conn = None
+        if self.process is not None:
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.terminate()
+            self.process = None
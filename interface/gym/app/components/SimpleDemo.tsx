@@ -4,7 +4,7 @@ import { useEffect, useRef, useState, useCallback } from 'react';
 import { WebSocketSignalingClient } from '../classes/websocket'
 import { ExerciseType } from '../utils/enums';
 import { DrawingUtils } from '@mediapipe/tasks-vision'
-import { BodyDrawer } from '../utils/bodydrawer';
+import { BodyDrawer, decodeStyle } from '../utils/bodydrawer';
 import { useVoice } from '../contexts/VoiceContext';
 import { motion, AnimatePresence } from "framer-motion";
 
@@ -146,7 +146,8 @@ export default function SimpleDemo() {
                     const data = JSON.parse(event.data);
 
                     const landmarks = data.landmarks;
-                    const style = data.style;
+                    // Units only send the style code, the dict is kept for older ones
+                    const style = data.style ?? decodeStyle(data.style_code ?? 0);
                     if (landmarks && landmarks.length > 0) {
                         bodyDrawer.drawFromJson(style, landmarks);
                     }
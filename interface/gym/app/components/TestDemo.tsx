@@ -4,7 +4,7 @@ import { useEffect, useRef, useState, useCallback, use } from 'react';
 import { WebSocketSignalingClient } from '../classes/websocket'
 import { ExerciseType } from '../utils/enums';
 import { DrawingUtils } from '@mediapipe/tasks-vision'
-import { BodyDrawer } from '../utils/bodydrawer';
+import { BodyDrawer, decodeStyle } from '../utils/bodydrawer';
 import { useVoice } from '../contexts/VoiceContext';
 
 const SIGNALING_SERVER_HOST: string = process.env.SIGNALING_SERVER_HOST ?? "";
@@ -139,7 +139,8 @@ export default function TestDemo() {
                     const data = JSON.parse(event.data);
 
                     const landmarks = data.landmarks;
-                    const style = data.style;
+                    // Units only send the style code, the dict is kept for older ones
+                    const style = data.style ?? decodeStyle(data.style_code ?? 0);
                     if (landmarks && landmarks.length > 0) {
                         bodyDrawer.drawFromJson(style, landmarks);
                     }
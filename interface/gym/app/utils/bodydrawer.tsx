@@ -32,6 +32,21 @@ const RIGHT_LEG_CONNECTIONS = [
   { start: 26, end: 28 },
 ];
 
+// Order of the body segments in the style_code the processing unit sends, see STYLE_SEGMENTS in utils.py
+const STYLE_SEGMENTS = ["right_arm", "left_arm", "torso", "left_leg", "right_leg"];
+
+// Each segment is a base 3 digit: 0 default, 1 correct, 2 wrong
+const STYLE_STATES = [null, true, false];
+
+export function decodeStyle(code: number): { [key: string]: boolean | null } {
+  const style: { [key: string]: boolean | null } = {};
+  for (const segment of STYLE_SEGMENTS) {
+    style[segment] = STYLE_STATES[code % 3] ?? null;
+    code = Math.floor(code / 3);
+  }
+  return style;
+}
+
 export class BodyDrawer {
 
   drawingUtils : DrawingUtils;
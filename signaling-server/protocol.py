@@ -49,13 +49,14 @@ class Protocol:
         await Protocol.send(websocket, message)
 
     @staticmethod
-    async def send_client_connection_message_to_unit(websocket: WebSocket, client_id: str) -> None:
+    async def send_client_connection_message_to_unit(websocket: WebSocket, client_id: str, transport: str = "webrtc") -> None:
         """
-        Send a connection message for the client.
+        Send a connection message for the client, with the transport the unit should offer it.
         """
         message = {
             "type": "connect",
             "client_id": client_id,
+            "transport": transport,
             "message": "The client wants to connect."
         }
         await Protocol.send(websocket, message)
@@ -166,15 +167,20 @@ class Protocol:
         await Protocol.send(websocket, message)
 
     @staticmethod
-    async def send_accept_connection_message(websocket: WebSocket, unit_id: str) -> None:
+    async def send_accept_connection_message(websocket: WebSocket, unit_id: str, capture_profile: dict = None, local_transport: dict = None) -> None:
         """
-        Send an accept connection message to the client.
+        Send an accept connection message to the client, forwarding the capture profile advertised by the unit
+        and, when the unit offers it, where to reach its local transport.
         """
         message = {
             "type": "accepted_connection",
             "unit_id": unit_id,
             "message": "The connection was accepted."
         }
+        if capture_profile:
+            message["capture_profile"] = capture_profile
+        if local_transport:
+            message["local_transport"] = local_transport
         await Protocol.send(websocket, message)
 
     @staticmethod
@@ -12,10 +12,13 @@ logger = logging.getLogger(__name__)
 
 class Client:
 
-    def __init__(self, id: str, unit: ProcessingUnit, websocket: WebSocket):
+    def __init__(self, id: str, unit: ProcessingUnit, websocket: WebSocket, host_id: str = None, local_transport: bool = False):
         self.id = id
         self.unit = unit
         self.websocket = websocket
+        # Reported by the client, a unit on the same host can skip WebRTC
+        self.host_id = host_id
+        self.local_transport = local_transport
 
     async def disconnect(self):
         """Disconnect the client from the unit."""
@@ -64,11 +67,21 @@ class Client:
 
 class ProcessingUnit:
 
-    def __init__(self, id: str, signaling_server: SignalingServer, websocket: WebSocket = None):
+    def __init__(self, id: str, signaling_server: SignalingServer, websocket: WebSocket = None,
+                 host_id: str = None, local_transport: bool = False):
         self.id = id
         self.websocket = websocket
         self.signaling_server = signaling_server
         self.client: Client = None
+        self.host_id = host_id
+        self.local_transport = local_transport
+
+    def is_local_to(self, client: Client) -> bool:
+        """Whether the client runs on the same host and both ends can use the local transport."""
+        return (
+            self.local_transport and client.local_transport
+            and self.host_id is not None and self.host_id == client.host_id
+        )
 
     def add_client(self, client: Client):
         """Add a client to the processing unit."""
@@ -116,7 +129,9 @@ class ProcessingUnit:
                 logger.warning(f"Client {client_id} is not the current client for Processing Unit {self.id}.")
                 return
 
-            await Protocol.send_accept_connection_message(self.client.websocket, self.id)
+            await Protocol.send_accept_connection_message(
+                self.client.websocket, self.id, message.get("capture_profile"), message.get("local_transport")
+            )
             logger.info(f"Accepted connection from client {self.client.id} on Processing Unit {self.id}.")
 
         except Exception as e:
@@ -260,12 +275,13 @@ class SignalingServer:
             logger.warning(f"No waiting clients to assign to Processing Unit {unit.id}.")
             return
 
-        await Protocol.send_client_connection_message_to_unit(unit.websocket, client.id)
+        transport = "local" if unit.is_local_to(client) else "webrtc"
+        await Protocol.send_client_connection_message_to_unit(unit.websocket, client.id, transport)
         await Protocol.send_unit_connection_message_to_client(client.websocket, unit.id)
 
         unit.add_client(client)
 
-        logger.info(f"Client {client.id} is connecting to Processing Server {unit.id}.")
+        logger.info(f"Client {client.id} is connecting to Processing Server {unit.id} over {transport}.")
         return True
     
     async def register_processing_unit(self, unit: ProcessingUnit, server: MultiServer):
@@ -309,7 +325,10 @@ class SignalingServer:
             await websocket.close()
             raise ValueError("unit_id is required")
 
-        unit = ProcessingUnit(id=unit_id, websocket=websocket, signaling_server=signaling_server)
+        unit = ProcessingUnit(
+            id=unit_id, websocket=websocket, signaling_server=signaling_server,
+            host_id=message.get("host_id"), local_transport=bool(message.get("local_transport")),
+        )
         server = signaling_server.servers.get(server_id)
 
         if not server:
@@ -348,7 +367,10 @@ class SignalingServer:
             await websocket.close()
             raise ValueError("client_id is required")
         
-        client = Client(id=client_id, unit=None, websocket=websocket)
+        client = Client(
+            id=client_id, unit=None, websocket=websocket,
+            host_id=message.get("host_id"), local_transport=bool(message.get("local_transport")),
+        )
         ret = await self.register_client(client)
         
         return client, ret
@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+# Measurements are split into one partition per hour of timestamps
+PARTITION_SECONDS = 3600
+
+VALUE_DTYPE = np.dtype("<i8")
+TIME_DTYPE = np.dtype("<f8")
+
+def parse_point(point: str) -> tuple:
+    """Split a '{"point_x": N}' measurement point into ("point_x", N)."""
+    # Slicing is much faster than json.loads at bulk ingest rates
+    if point.startswith('{"') and point.endswith("}"):
+        end = point.find('": ', 2)
+        if end != -1:
+            try:
+                return point[2:end], int(point[end + 3:-1])
+            except ValueError:
+                pass
+    data = json.loads(point)
+    if not isinstance(data, dict) or len(data) != 1:
+        raise ValueError(f"Invalid measurement point: {point}")
+    ((key, value),) = data.items()
+    return key, int(value)
+
+class MeasurementStore:
+    """Append-only columnar store for test measurements.
+
+    Every test has a directory with one directory per point type, holding
+    one partition per hour of timestamps. A partition is a pair of column
+    files, the values and the timestamps, that only ever grow by appending
+    fixed-width records, so ingest is a couple of writes per batch and a
+    range query only reads the partitions that overlap the range.
+
+    Test metadata is small and kept in tests.json next to the test
+    directories.
+
+    Layout:
+        root/tests.json
+        root/<test_id>/<point>/<partition start>.values
+        root/<test_id>/<point>/<partition start>.times
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+        self.tests: Dict[str, dict] = {}
+        # Ids are never reused, measurements spooled for a deleted test must not land in a new one
+        self.next_id = 1
+        self.metadata_path = os.path.join(root, "tests.json")
+        if os.path.exists(self.metadata_path):
+            with open(self.metadata_path, "r") as f:
+                metadata = json.load(f)
+            self.tests = metadata["tests"]
+            self.next_id = metadata["next_id"]
+
+        # test_id -> point -> sorted partition starts
+        self.partitions: Dict[str, Dict[str, list]] = {}
+        for test_id in self.tests:
+            test_dir = os.path.join(root, test_id)
+            if not os.path.isdir(test_dir):
+                continue
+            for point in os.listdir(test_dir):
+                starts = {int(name.split(".")[0]) for name in os.listdir(os.path.join(test_dir, point))}
+                self.partitions.setdefault(test_id, {})[point] = sorted(starts)
+
+    def _save_metadata(self):
+        path = f"{self.metadata_path}.tmp"
+        with open(path, "w") as f:
+            json.dump({"next_id": self.next_id, "tests": self.tests}, f)
+        os.replace(path, self.metadata_path)
+
+    def _partition_path(self, test_id: str, point: str, start: int) -> str:
+        return os.path.join(self.root, test_id, point, str(start))
+
+    def create_test(self, test_type: str, house_id: str, division: str) -> str:
+        with self.lock:
+            test_id = f"test{self.next_id:04d}"
+            self.next_id += 1
+            self.tests[test_id] = {
+                "test_id": test_id,
+                "test_type": test_type,
+                "houseID": house_id,
+                "division": division,
+                "notes": "",
+                "start_time": None,
+                "created": time.time(),
+            }
+            self._save_metadata()
+        return test_id
+
+    def update_test(self, test_id: str, **fields) -> bool:
+        with self.lock:
+            if test_id not in self.tests:
+                return False
+            self.tests[test_id].update({key: value for key, value in fields.items() if value is not None})
+            self._save_metadata()
+        return True
+
+    def delete_test(self, test_id: str) -> bool:
+        with self.lock:
+            if self.tests.pop(test_id, None) is None:
+                return False
+            self.partitions.pop(test_id, None)
+            shutil.rmtree(os.path.join(self.root, test_id), ignore_errors=True)
+            self._save_metadata()
+        return True
+
+    def find_tests(self, test_id: Optional[str] = None, house_id: Optional[str] = None) -> list:
+        # Copies, the endpoints serialize them while other requests may update the tests
+        with self.lock:
+            return [
+                dict(test) for test in self.tests.values()
+                if (test_id is None or test["test_id"] == test_id) and (house_id is None or test["houseID"] == house_id)
+            ]
+
+    def append(self, test_id: str, points: Iterable[str], timestamps: Iterable[float]) -> int:
+        """Store a batch of measurements.
+
+        Args:
+            test_id: The test they belong to.
+            points: The '{"point_x": N}' strings.
+            timestamps: When each point was reached, in seconds since the epoch.
+
+        Returns:
+            How many measurements were stored.
+        """
+        if test_id not in self.tests:
+            raise KeyError(test_id)
+
+        parsed = [parse_point(point) for point in points]
+        if not parsed:
+            return 0
+        names = np.array([name for name, _ in parsed])
+        values = np.fromiter((value for _, value in parsed), dtype=VALUE_DTYPE, count=len(parsed))
+        times = np.asarray(timestamps, dtype=TIME_DTYPE)
+        starts = (times // PARTITION_SECONDS).astype(np.int64) * PARTITION_SECONDS
+
+        with self.lock:
+            test_partitions = self.partitions.setdefault(test_id, {})
+            for name in np.unique(names):
+                point_mask = names == name
+                point_partitions = test_partitions.setdefault(str(name), [])
+                os.makedirs(os.path.join(self.root, test_id, str(name)), exist_ok=True)
+                for start in np.unique(starts[point_mask]):
+                    mask = point_mask & (starts == start)
+                    path = self._partition_path(test_id, str(name), int(start))
+                    # Values first, a partial write leaves extra values that readers ignore
+                    with open(f"{path}.values", "ab") as f:
+                        f.write(values[mask].tobytes())
+                    with open(f"{path}.times", "ab") as f:
+                        f.write(times[mask].tobytes())
+                    if int(start) not in point_partitions:
+                        point_partitions.append(int(start))
+                        point_partitions.sort()
+        return len(parsed)
+
+    def query(self, test_id: str, points: Optional[Iterable[str]] = None,
+              start: Optional[float] = None, end: Optional[float] = None) -> Dict[str, tuple]:
+        """Read the measurements of a test, optionally limited to some points and a time range.
+
+        Returns:
+            A dict of point -> (values, timestamps), ordered by timestamp.
+        """
+        # Partitions only grow by appending, once listed they can be read without the lock
+        with self.lock:
+            test_partitions = {point: list(starts) for point, starts in self.partitions.get(test_id, {}).items()}
+        if points is None:
+            points = list(test_partitions)
+
+        results = {}
+        for point in points:
+            values, times = [], []
+            for partition in test_partitions.get(point, []):
+                if (start is not None and partition + PARTITION_SECONDS <= start) or (end is not None and partition > end):
+                    continue
+                path = self._partition_path(test_id, point, partition)
+                partition_times = np.fromfile(f"{path}.times", dtype=TIME_DTYPE)
+                partition_values = np.fromfile(f"{path}.values", dtype=VALUE_DTYPE, count=len(partition_times))
+                partition_times = partition_times[:len(partition_values)]
+                if start is not None or end is not None:
+                    mask = np.ones(len(partition_times), dtype=bool)
+                    if start is not None:
+                        mask &= partition_times >= start
+                    if end is not None:
+                        mask &= partition_times <= end
+                    partition_values, partition_times = partition_values[mask], partition_times[mask]
+                values.append(partition_values)
+                times.append(partition_times)
+            if not values:
+                continue
+            values, times = np.concatenate(values), np.concatenate(times)
+            order = np.argsort(times, kind="stable")
+            results[point] = (values[order], times[order])
+        return results
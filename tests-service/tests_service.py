@@ -0,0 +1,161 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import zlib
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from measurement_store import MeasurementStore
+
+load_dotenv(".env")
+
+logging.basicConfig(
+    filename='tests_service.log',
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.getenv("TESTS_DATA_DIR", "data")
+PORT = int(os.getenv("SERVICES_API_PORT", 8300))
+
+store = MeasurementStore(DATA_DIR)
+
+app = FastAPI(
+    title="Tests Service",
+    description="Local stand-in for the Tests API, stores test measurements on disk",
+    version="1.0.0",
+)
+
+class TestCreate(BaseModel):
+    test_type: str
+    houseID: str
+    division: str
+
+class TestUpdate(BaseModel):
+    test_id: str
+    notes: Optional[str] = None
+    start_time: Optional[float] = None
+
+class Measurement(BaseModel):
+    test_id: str
+    timestamp: float | str
+    point: str
+
+def to_seconds(timestamp) -> float:
+    if isinstance(timestamp, str):
+        return datetime.fromisoformat(timestamp).timestamp()
+    return float(timestamp)
+
+def to_iso(times: np.ndarray) -> list:
+    return np.datetime_as_string((times * 1e6).astype("datetime64[us]"), unit="us").tolist()
+
+async def read_json(request: Request):
+    # The measurement uploader gzips its batches
+    body = await request.body()
+    try:
+        if request.headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+    except (OSError, EOFError, zlib.error):
+        # Retrying a corrupt body won't help, the uploader drops what gets a 4xx
+        raise HTTPException(status_code=400, detail="Invalid gzip body")
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON body")
+
+def store_measurements(test_id: str, measurements: list) -> int:
+    if test_id not in store.tests:
+        raise HTTPException(status_code=404, detail=f"Test {test_id} not found")
+    try:
+        return store.append(
+            test_id,
+            [measurement["point"] for measurement in measurements],
+            [to_seconds(measurement["timestamp"]) for measurement in measurements],
+        )
+    except (KeyError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid measurement: {e}")
+
+@app.get("/health", tags=["Health"])
+async def health_check():
+    """Health check endpoint to verify server status."""
+    return {"status": "ok"}
+
+@app.post("/v1/tests/", tags=["Tests"])
+def create_test(test: TestCreate):
+    test_id = store.create_test(test.test_type, test.houseID, test.division)
+    logger.info(f"Created test {test_id}")
+    return {"test_id": test_id}
+
+@app.patch("/v1/tests/", tags=["Tests"])
+def update_test(test: TestUpdate):
+    if not store.update_test(test.test_id, notes=test.notes, start_time=test.start_time):
+        raise HTTPException(status_code=404, detail=f"Test {test.test_id} not found")
+    return {"status": "ok"}
+
+@app.get("/v1/tests/", tags=["Tests"])
+def get_tests(test_id: Optional[str] = None, houseID: Optional[str] = None, point: Optional[str] = None,
+              start: Optional[float] = None, end: Optional[float] = None, columnar: bool = False):
+    """List tests with their measurements.
+
+    point, start and end limit the measurements returned to one point type
+    and a time range in seconds since the epoch. With columnar the
+    measurements come as one array of values and one of timestamps per
+    point instead of one object per measurement.
+    """
+    tests = []
+    for test in store.find_tests(test_id, houseID):
+        columns = store.query(test["test_id"], [point] if point else None, start, end)
+        test = dict(test)
+        if columnar:
+            test["measurements"] = {
+                name: {"values": values.tolist(), "timestamps": times.tolist()}
+                for name, (values, times) in columns.items()
+            }
+        else:
+            test["measurements"] = [
+                {"point": f"{{\"{name}\": {value}}}", "timestamp": timestamp}
+                for name, (values, times) in columns.items()
+                for value, timestamp in zip(values.tolist(), to_iso(times))
+            ]
+        tests.append(test)
+    # Serialized directly, the generic encoder is slow on tens of thousands of measurements
+    return Response(content=json.dumps(tests), media_type="application/json")
+
+@app.delete("/v1/tests/", tags=["Tests"])
+def delete_test(test_id: str):
+    if not store.delete_test(test_id):
+        raise HTTPException(status_code=404, detail=f"Test {test_id} not found")
+    return {"status": "ok"}
+
+@app.post("/v1/tests/measurement", tags=["Measurements"])
+def add_measurement(measurement: Measurement):
+    store_measurements(measurement.test_id, [measurement.model_dump()])
+    return {"status": "ok"}
+
+@app.post("/v1/tests/measurement/bulk", tags=["Measurements"])
+async def add_measurement_bulk(request: Request):
+    data = await read_json(request)
+    if not isinstance(data, dict) or "test_id" not in data or not isinstance(data.get("measurements"), list):
+        raise HTTPException(status_code=400, detail="Expected test_id and a list of measurements")
+    stored = await run_in_threadpool(store_measurements, data["test_id"], data["measurements"])
+    return {"status": "ok", "stored": stored}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Tests API")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Host to bind the server")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to bind the server")
+    parser.add_argument("--certfile", type=str, default=None, help="TLS certificate, the Tests API clients expect HTTPS")
+    parser.add_argument("--keyfile", type=str, default=None, help="TLS key")
+    args = parser.parse_args()
+
+    uvicorn.run(app, host=args.host, port=args.port, ssl_certfile=args.certfile, ssl_keyfile=args.keyfile)
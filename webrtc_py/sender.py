@@ -8,8 +8,9 @@ import fractions
 class CustomVideoStreamTrack(VideoStreamTrack):
     def __init__(self, path):
         super().__init__()
-        width = 3840
-        height = 2160
+        # Only 640x480 is ever sent, capturing more just to resize it away is wasted work
+        width = 640
+        height = 480
         self.cap = cv2.VideoCapture(path)
         self.cap.set(3, width)
         self.cap.set(4, height)
@@ -24,7 +25,8 @@ class CustomVideoStreamTrack(VideoStreamTrack):
             print("Failed to read frame from camera")
             return None
 
-        frame = cv2.resize(frame, (640, 480))
+        if frame.shape[:2] != (480, 640):
+            frame = cv2.resize(frame, (640, 480))
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         video_frame = VideoFrame.from_ndarray(frame, format="rgb24")
         video_frame.pts = self.frame_count